@@ -14,10 +14,12 @@ import gtk
 
 from application import application
 from base_window import BaseWindow
+from global_settings import global_settings
 from library_editor import LibraryEditor
 from notebook import LibraryFile, NotebookFile, WorksheetFile
 from window_builder import WindowBuilder
 from worksheet_editor import WorksheetEditor
+from worksheet_scheduler import WorksheetScheduler
 
 class BaseNotebookWindow(BaseWindow):
     def __init__(self, notebook):
@@ -35,6 +37,7 @@ class BaseNotebookWindow(BaseWindow):
         self.path = notebook.folder
 
         self.editors = []
+        self.__calculate_all_scheduler = None
 
         self.nb_widget = gtk.Notebook()
         self.nb_widget.connect_after('switch-page', self.on_page_switched)
@@ -232,9 +235,21 @@ class BaseNotebookWindow(BaseWindow):
         self.__new_library()
 
     def on_calculate_all(self, action):
+        # Worksheets are calculated several at a time (see WorksheetScheduler),
+        # as set up by the preferences; if a previous Calculate All is still going,
+        # we just add to it
+        if self.__calculate_all_scheduler is None or self.__calculate_all_scheduler.complete:
+            self.__calculate_all_scheduler = WorksheetScheduler(global_settings.calculate_all_jobs or None)
+
         for editor in self.editors:
             if editor.needs_calculate:
-                editor.calculate()
+                if isinstance(editor, WorksheetEditor):
+                    self.__calculate_all_scheduler.add_worksheet(editor.buf.worksheet, editor.calculate)
+                else:
+                    editor.calculate()
+
+        if not self.__calculate_all_scheduler.started:
+            self.__calculate_all_scheduler.start()
 
     def on_page_switched(self, notebook, _, page_num):
         widget = self.nb_widget.get_nth_page(page_num)
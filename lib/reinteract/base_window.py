@@ -97,6 +97,9 @@ class BaseWindow:
             ('about',   gtk.STOCK_ABOUT,     None,         None,              None, self.on_about),
             ('calculate', gtk.STOCK_REFRESH, "Ca_lculate", '<control>Return', None,  self.on_calculate),
             ('break',   gtk.STOCK_CANCEL,    "_Break",     '<control>Break',  None,  self.on_break),
+            ('profile', None,                "_Profile Statement",  None,     None,  self.on_profile),
+            ('profile-calculation', None,    "Profile Ca_lculation", None,    None,  self.on_profile_calculation),
+            ('clear-snapshots', None,        "Clear _Snapshots",     None,    None,  self.on_clear_snapshots),
             ('preferences', gtk.STOCK_PREFERENCES, "Prefere_nces",     None,  None,  self.on_preferences),
         ])
 
@@ -194,7 +197,7 @@ class BaseWindow:
 
     def on_save(self, action):
         if self.current_editor:
-            self.current_editor.save()
+            self.current_editor.save(wait=False)
 
     def on_rename(self, action):
         if self.current_editor:
@@ -242,6 +245,18 @@ class BaseWindow:
         if self.current_editor:
             self.current_editor.buf.worksheet.interrupt()
 
+    def on_profile(self, action):
+        if self.current_editor and self.current_editor.state != NotebookFile.EXECUTING:
+            self.current_editor.profile()
+
+    def on_profile_calculation(self, action):
+        if self.current_editor and self.current_editor.state != NotebookFile.EXECUTING:
+            self.current_editor.profile(whole_calculation=True)
+
+    def on_clear_snapshots(self, action):
+        if self.current_editor:
+            self.current_editor.clear_snapshots()
+
     def on_preferences(self, action):
         show_preferences(parent=self.window)
 
@@ -284,6 +299,10 @@ class BaseWindow:
     def update_sensitivity(self):
         self._set_action_sensitive('calculate', self.current_editor is not None and self.current_editor.needs_calculate)
         self._set_action_sensitive('break', self.current_editor is not None and self.current_editor.state == NotebookFile.EXECUTING)
+        can_profile = self.current_editor is not None and self.current_editor.state != NotebookFile.EXECUTING
+        self._set_action_sensitive('profile', can_profile)
+        self._set_action_sensitive('profile-calculation', can_profile)
+        self._set_action_sensitive('clear-snapshots', self.current_editor is not None)
 
         # This seems more annoying than useful. gedit doesn't desensitize save
         # self._set_action_sensitive('save', self.current_editor is not None and self.current_editor.modified)
@@ -0,0 +1,442 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+# Implementation of reinteract-run, which calculates worksheets without a user
+# interface and reports the results. Nothing here (or in the modules used to
+# calculate worksheets) may import gtk, so that it works without a display.
+
+import gobject
+import logging
+from optparse import OptionParser
+import os
+import sys
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from chunks import StatementChunk
+from notebook import Notebook, HelpResult, WorksheetFile
+from repr_result import ReprResult
+from statement import Statement, WarningResult
+import stdout_capture
+from worksheet import Worksheet
+from worksheet_scheduler import WorksheetScheduler
+
+gobject.threads_init()
+stdout_capture.init()
+
+# Exit codes of reinteract-run
+EXIT_SUCCESS = 0
+EXIT_ERROR = 1    # a worksheet failed to calculate
+EXIT_USAGE = 2    # bad arguments, or a worksheet could not be loaded
+
+_STATE_NAMES = {
+    Statement.NEW : 'new',
+    Statement.COMPILE_SUCCESS : 'not-executed',
+    Statement.COMPILE_ERROR : 'compile-error',
+    Statement.EXECUTING : 'executing',
+    Statement.EXECUTE_SUCCESS : 'success',
+    Statement.EXECUTE_ERROR : 'error',
+    Statement.INTERRUPTED : 'interrupted',
+}
+
+class BatchError(Exception):
+    """Exception raised when the worksheets to run can't be found or loaded"""
+    pass
+
+def find_notebook_path(path):
+    """Find the notebook folder containing a path.
+
+    This is the same search as Application.find_notebook_path(), without the
+    dependency on the user interface. If the path isn't inside a notebook, the
+    path itself if it is a folder, or otherwise the folder containing it, is
+    used as the notebook.
+
+    @param path: absolute path to a notebook folder or a worksheet
+    @returns: the notebook folder
+
+    """
+    tmp = path
+    while True:
+        if os.path.isdir(tmp) and os.path.exists(os.path.join(tmp, "index.rnb")):
+            return tmp
+        parent = os.path.dirname(tmp)
+        if parent == tmp: # At the root
+            break
+        tmp = parent
+
+    if os.path.isdir(path):
+        return path
+    else:
+        return os.path.dirname(path)
+
+def load_worksheets(paths):
+    """Load the worksheets to run
+
+    @param paths: paths to worksheet files or notebook folders. For a folder, all
+      the worksheets in the notebook are loaded.
+    @returns: a list of L{Worksheet} objects
+    @raises BatchError: if a path doesn't exist or a worksheet couldn't be read
+
+    """
+    notebooks = {}
+    filenames = []
+    for path in paths:
+        path = os.path.abspath(path)
+        if not os.path.exists(path):
+            raise BatchError("'%s' does not exist" % path)
+
+        folder = find_notebook_path(path)
+        if not folder in notebooks:
+            notebooks[folder] = Notebook(folder)
+        notebook = notebooks[folder]
+
+        if os.path.isdir(path):
+            for relative in sorted(notebook.files):
+                absolute = os.path.join(folder, relative)
+                if isinstance(notebook.files[relative], WorksheetFile) and absolute.startswith(path):
+                    filenames.append((notebook, absolute))
+        else:
+            filenames.append((notebook, path))
+
+    worksheets = []
+    seen = set()
+    for notebook, filename in filenames:
+        if filename in seen:
+            continue
+        seen.add(filename)
+
+        worksheet = Worksheet(notebook)
+        try:
+            # There is no one to ask what to do about invalid characters
+            worksheet.load(filename, escape=True)
+        except IOError, e:
+            raise BatchError("Cannot load '%s': %s" % (filename, e.strerror))
+        worksheets.append(worksheet)
+
+    return worksheets
+
+def run_worksheets(worksheets, jobs=1, timeout=None, snapshots=False, clear_snapshots=False):
+    """Calculate worksheets, waiting until they are all done
+
+    @param worksheets: the worksheets to calculate
+    @param jobs: maximum number of worksheets to calculate at once. If more than 1,
+      each worksheet is calculated in a separate process.
+    @param timeout: maximum time in seconds that executing each statement may take,
+      or None for no limit. See Worksheet.statement_timeout
+    @param snapshots: if True, save and restore the results of slow statements.
+      See Worksheet.save_snapshots. Snapshots aren't used with more than one job.
+    @param clear_snapshots: if True, remove the snapshots saved for the worksheets
+      before calculating them. See Worksheet.clear_snapshots()
+
+    """
+    for worksheet in worksheets:
+        if clear_snapshots:
+            worksheet.clear_snapshots()
+        worksheet.statement_timeout = timeout
+        worksheet.save_snapshots = snapshots
+
+    # Worksheets only calculate faster at the same time in separate processes
+    scheduler = WorksheetScheduler(max_jobs=jobs, execute_in_subprocess=jobs > 1)
+    for worksheet in worksheets:
+        scheduler.add_worksheet(worksheet)
+
+    loop = gobject.MainLoop()
+    scheduler.connect('complete', lambda scheduler: loop.quit())
+    scheduler.start()
+    if not scheduler.complete:
+        loop.run()
+
+def _encode_result(result):
+    if isinstance(result, basestring):
+        return result
+    elif isinstance(result, WarningResult):
+        return { 'type': 'warning', 'message': result.message }
+    elif isinstance(result, HelpResult):
+        return { 'type': 'help', 'name': getattr(result.arg, '__name__', None) }
+    elif isinstance(result, ReprResult):
+        return { 'type': 'summary', 'text': result.summary }
+    else:
+        return { 'type': 'custom', 'class': type(result).__name__ }
+
+def get_report(worksheet):
+    """Get the results of a calculated worksheet
+
+    @returns: a dictionary, in the form written out by reinteract-run --format=json,
+      with the filename, overall state ('success' or 'error') and a list of
+      statements. Each statement has its first and last lines (counting from 1),
+      text, state, results, error, timings in seconds, whether it was interrupted
+      because it took longer than the timeout, and whether its results were reused
+      from the last execution, restored from a snapshot or memoized.
+
+    """
+    statements = []
+    success = True
+    for chunk in worksheet.iterate_chunks():
+        if not isinstance(chunk, StatementChunk) or chunk.statement is None:
+            continue
+
+        statement = chunk.statement
+        if statement.state in (Statement.COMPILE_ERROR, Statement.EXECUTE_ERROR, Statement.INTERRUPTED):
+            success = False
+
+        if chunk.error_message is not None:
+            # Rewritten statements are compiled without line numbers, so we only
+            # know the line of a compilation error
+            if statement.state == Statement.COMPILE_ERROR and chunk.error_line is not None:
+                error_line = chunk.start + chunk.error_line
+            else:
+                error_line = None
+            error = { 'message': chunk.error_message, 'line': error_line }
+        else:
+            error = None
+
+        if chunk.results is not None:
+            results = [_encode_result(result) for result in chunk.results]
+        else:
+            results = None
+
+        statements.append({
+            'start': chunk.start + 1,
+            'end': chunk.end,
+            'text': chunk.tokenized.get_text(),
+            'state': _STATE_NAMES[statement.state],
+            'results': results,
+            'error': error,
+            'reused': statement.reused,
+            'restored': statement.restored,
+            'memoized': statement.memoized,
+            'compile_time': statement.compile_time,
+            'execute_time': statement.execute_time,
+            'execute_cpu_time': statement.execute_cpu_time,
+            'timed_out': statement.timed_out,
+        })
+
+    if success:
+        state = 'success'
+    else:
+        state = 'error'
+
+    return {
+        'filename': worksheet.filename,
+        'state': state,
+        'statements': statements,
+    }
+
+def _format_time(t):
+    if t is None:
+        return "-"
+    else:
+        return "%.3fs" % t
+
+def format_text(reports):
+    """Format worksheet reports (see get_report()) as readable text
+
+    @returns: a unicode string
+
+    """
+    lines = []
+    for report in reports:
+        lines.append(u"== %s: %s" % (report['filename'], report['state']))
+        for statement in report['statements']:
+            lines.append(u"-- line %d: %s (compile %s, execute %s)" %
+                         (statement['start'], statement['state'],
+                          _format_time(statement['compile_time']),
+                          _format_time(statement['execute_time'])))
+            lines.extend(u">>> " + line for line in statement['text'].split("\n"))
+            if statement['error'] is not None:
+                lines.append(statement['error']['message'])
+            elif statement['results'] is not None:
+                for result in statement['results']:
+                    if isinstance(result, basestring):
+                        lines.append(result)
+                    elif result['type'] == 'warning':
+                        lines.append(u"Warning: " + result['message'])
+                    elif result['type'] == 'help':
+                        lines.append(u"<help for %s>" % result['name'])
+                    elif result['type'] == 'summary':
+                        lines.append(result['text'])
+                    else:
+                        lines.append(u"<%s>" % result['class'])
+        lines.append(u"")
+
+    return u"\n".join(lines)
+
+def main(args=None):
+    """Entry point for reinteract-run
+
+    @param args: command line arguments, not including the program name. Defaults to sys.argv[1:]
+    @returns: the exit code
+
+    """
+    parser = OptionParser(usage="%prog [options] NOTEBOOK_OR_WORKSHEET...",
+                          description="Calculate Reinteract worksheets and report the results, "
+                                      "errors and the time taken by each statement.")
+    parser.add_option("-f", "--format", choices=("text", "json"), default="text",
+                      help="the output format (text or json)")
+    parser.add_option("-o", "--output", metavar="FILE",
+                      help="write the report to FILE rather than standard output")
+    parser.add_option("-j", "--jobs", type="int", default=1,
+                      help="number of worksheets to calculate at once, each in a separate process")
+    parser.add_option("-t", "--timeout", type="float", metavar="SECONDS",
+                      help="interrupt statements that take longer than SECONDS to execute, "
+                           "unless they set a limit with a '# timeout: SECONDS' comment")
+    parser.add_option("-s", "--snapshots", action="store_true",
+                      help="save the results of slow statements next to each worksheet, "
+                           "and restore them instead of executing the statements the next time")
+    parser.add_option("--clear-snapshots", action="store_true",
+                      help="remove the saved results of statements before calculating")
+    parser.add_option("-d", "--debug", action="store_true",
+                      help="enable internal debug messages")
+    options, args = parser.parse_args(args)
+
+    if len(args) == 0:
+        parser.error("no notebook or worksheet specified")
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if options.timeout is not None and options.timeout <= 0:
+        parser.error("--timeout must be positive")
+
+    if options.debug:
+        logging.basicConfig(level=logging.DEBUG)
+
+    user_ext_path = os.path.expanduser(os.path.join('~', '.reinteract', 'modules'))
+    if os.path.exists(user_ext_path):
+        sys.path[0:0] = [user_ext_path]
+
+    try:
+        worksheets = load_worksheets(args)
+    except BatchError, e:
+        print >>sys.stderr, "reinteract-run: %s" % e
+        return EXIT_USAGE
+
+    try:
+        run_worksheets(worksheets, options.jobs, options.timeout, options.snapshots,
+                       options.clear_snapshots)
+        reports = [get_report(worksheet) for worksheet in worksheets]
+    finally:
+        for worksheet in worksheets:
+            worksheet.close()
+
+    if options.format == 'json':
+        output = json.dumps(reports, indent=2)
+    else:
+        output = format_text(reports).encode("UTF-8")
+
+    if options.output is not None:
+        f = open(options.output, "w")
+    else:
+        f = sys.stdout
+    try:
+        f.write(output)
+        f.write("\n")
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+    for report in reports:
+        if report['state'] != 'success':
+            return EXIT_ERROR
+
+    return EXIT_SUCCESS
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    import shutil
+    import tempfile
+
+    from test_utils import assert_equals
+
+    base = tempfile.mkdtemp("", "batch_run")
+    try:
+        def write_file(name, contents):
+            f = open(os.path.join(base, name), "w")
+            f.write(contents)
+            f.close()
+
+        write_file("index.rnb", "[Notebook]\n")
+        write_file("helper.py", "def double(x):\n    return 2 * x\n")
+        write_file("good.rws", "import helper\na = helper.double(21)\nprint 'hello'\na\nrange(0, 100000)\n")
+        write_file("bad.rws", "a = 1\nb = c\nd = 2\n")
+        write_file("syntax.rws", "a = 1\nif True:\n    b = (\n")
+
+        # Worksheets can import modules from the notebook
+        worksheets = load_worksheets([os.path.join(base, "good.rws")])
+        run_worksheets(worksheets)
+        report = get_report(worksheets[0])
+        assert_equals(report['state'], 'success')
+        assert_equals([s['results'] for s in report['statements']][0:4], [[], [], ['hello'], ['42']])
+        assert_equals(report['statements'][4]['results'][0]['type'], 'summary')
+        assert_equals(report['statements'][3]['start'], 4)
+        assert report['statements'][1]['execute_time'] is not None
+        worksheets[0].close()
+
+        # Loading a folder loads all the worksheets in the notebook
+        worksheets = load_worksheets([base])
+        assert_equals([os.path.basename(w.filename) for w in worksheets], ["bad.rws", "good.rws", "syntax.rws"])
+        run_worksheets(worksheets, jobs=2)
+        report = get_report(worksheets[0])
+        assert_equals(report['state'], 'error')
+        assert_equals([s['state'] for s in report['statements']], ['success', 'error', 'not-executed'])
+        assert_equals(report['statements'][1]['error']['line'], None)
+        assert "NameError" in report['statements'][1]['error']['message']
+        assert_equals(get_report(worksheets[1])['statements'][3]['results'], ['42'])
+        report = get_report(worksheets[2])
+        assert_equals(report['statements'][1]['state'], 'compile-error')
+        assert_equals(report['statements'][1]['error']['line'], 3)
+
+        text = format_text([get_report(worksheets[0])])
+        assert text.startswith(u"== %s: error\n" % os.path.join(base, "bad.rws"))
+        assert u">>> b = c\n" in text
+        for worksheet in worksheets:
+            worksheet.close()
+
+        # The exit code reflects errors, and the report is valid JSON
+        output = os.path.join(base, "report.json")
+        assert_equals(main(["--format=json", "--output=" + output, os.path.join(base, "good.rws")]), EXIT_SUCCESS)
+        f = open(output)
+        assert_equals(json.load(f)[0]['statements'][3]['results'], ['42'])
+        f.close()
+        assert_equals(main(["--output=" + output, base]), EXIT_ERROR)
+        assert_equals(main([os.path.join(base, "missing.rws")]), EXIT_USAGE)
+
+        # Statements that take too long are interrupted
+        write_file("slow.rws", "a = 1\nwhile True: pass\nb = 2\n")
+        worksheets = load_worksheets([os.path.join(base, "slow.rws")])
+        run_worksheets(worksheets, timeout=0.5)
+        report = get_report(worksheets[0])
+        assert_equals([s['state'] for s in report['statements']], ['success', 'interrupted', 'not-executed'])
+        assert_equals([s['timed_out'] for s in report['statements']], [False, True, False])
+        assert_equals(report['statements'][1]['error']['message'], "Timed out after 0.5 seconds")
+        worksheets[0].close()
+
+        # A statement can set its own timeout with a comment
+        write_file("slow.rws", "a = 1\nwhile True: pass # timeout: 0.2\nb = 2\n")
+        worksheets = load_worksheets([os.path.join(base, "slow.rws")])
+        run_worksheets(worksheets)
+        report = get_report(worksheets[0])
+        assert_equals([s['timed_out'] for s in report['statements']], [False, True, False])
+        worksheets[0].close()
+
+        # Snapshots are restored the next time, unless they are cleared
+        write_file("snapshot.rws", "a = 1\nb = a + 1\n")
+        def run_snapshots(clear_snapshots):
+            worksheets = load_worksheets([os.path.join(base, "snapshot.rws")])
+            worksheets[0].snapshot_min_time = 0
+            run_worksheets(worksheets, snapshots=True, clear_snapshots=clear_snapshots)
+            report = get_report(worksheets[0])
+            worksheets[0].close()
+            return [s['restored'] for s in report['statements']]
+        assert_equals(run_snapshots(False), [False, False])
+        assert_equals(run_snapshots(False), [True, True])
+        assert_equals(run_snapshots(True), [False, False])
+    finally:
+        shutil.rmtree(base)
@@ -0,0 +1,293 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+# Chunks are kept in blocks of up to _MAX_BLOCK_SIZE chunks, and their
+# start and end are stored relative to the 'delta' of the block (see
+# Chunk.start). Inserting or deleting lines then only has to fix up the
+# chunks in one block and the deltas of the following blocks, rather than
+# every chunk after the change.
+_MAX_BLOCK_SIZE = 128
+
+# Blocks smaller than this are merged with the previous block
+_MIN_BLOCK_SIZE = 16
+
+class _Block(object):
+    __slots__ = ('chunks', 'delta')
+
+    def __init__(self, chunks, delta):
+        self.chunks = chunks
+        self.delta = delta
+
+        for chunk in chunks:
+            chunk._block = self
+
+    def normalize(self):
+        # Fold the delta into the chunks, so they can be moved to another block
+        if self.delta != 0:
+            for chunk in self.chunks:
+                chunk._start += self.delta
+                chunk._end += self.delta
+            self.delta = 0
+
+class ChunkIndex(object):
+    """
+    The ChunkIndex class holds the chunks of a worksheet in order, and finds the
+    chunk at a particular line.
+
+    The chunks don't overlap, but while the chunks are being updated there may be
+    lines that aren't in any chunk. Finding the chunk at a line, adding and removing
+    chunks and shifting the chunks after a line take time proportional to the log
+    of the number of chunks (plus a small cost for each block of chunks), rather than
+    to the number of lines.
+
+    """
+
+    def __init__(self, chunks=()):
+        """Initialize the ChunkIndex object
+
+        @param chunks: chunks to start with, in order. This is faster than
+           adding the chunks one at a time.
+
+        """
+        chunks = list(chunks)
+        size = _MAX_BLOCK_SIZE // 2
+        self.__blocks = [_Block(chunks[i:i + size], 0) for i in xrange(0, len(chunks), size)]
+        self.__count = len(chunks)
+
+    def __len__(self):
+        return self.__count
+
+    def __find_block(self, line):
+        # Index of the last block whose first chunk starts at or before line, or 0
+        blocks = self.__blocks
+        lo = 0
+        hi = len(blocks)
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if blocks[mid].chunks[0].start <= line:
+                lo = mid
+            else:
+                hi = mid
+
+        return lo
+
+    def __find_in_block(self, block, line):
+        # Index in the block of the first chunk ending after line
+        chunks = block.chunks
+        line -= block.delta
+        lo = 0
+        hi = len(chunks)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if chunks[mid]._end <= line:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def __find(self, line):
+        # Returns (block index, chunk index) of the first chunk ending after line;
+        # the chunk index may be the length of the block
+        if self.__count == 0:
+            return 0, 0
+
+        block_index = self.__find_block(line)
+        block = self.__blocks[block_index]
+        i = self.__find_in_block(block, line)
+        if i == len(block.chunks) and block_index + 1 < len(self.__blocks):
+            return block_index + 1, 0
+        else:
+            return block_index, i
+
+    def get_chunk(self, line):
+        """Return the chunk containing the given line, or None"""
+
+        block_index, i = self.__find(line)
+        if block_index < len(self.__blocks):
+            chunks = self.__blocks[block_index].chunks
+            if i < len(chunks) and chunks[i].start <= line:
+                return chunks[i]
+
+        return None
+
+    def iterate(self, start_line=0, end_line=None):
+        """
+        Iterate over the chunks that include lines in the range [start_line, end_line)
+
+        The index must not be modified while iterating.
+
+        @param start_line: the first line
+        @param end_line: the line after the last line, or None to iterate to the end
+
+        """
+        block_index, i = self.__find(start_line)
+        blocks = self.__blocks
+        while block_index < len(blocks):
+            chunks = blocks[block_index].chunks
+            while i < len(chunks):
+                chunk = chunks[i]
+                if end_line is not None and chunk.start >= end_line:
+                    return
+                yield chunk
+                i += 1
+            block_index += 1
+            i = 0
+
+    def add(self, chunk):
+        """Add a chunk. It must not overlap any chunk already in the index"""
+
+        self.__count += 1
+
+        if len(self.__blocks) == 0:
+            self.__blocks.append(_Block([chunk], 0))
+            return
+
+        start = chunk.start
+        block_index = self.__find_block(start)
+        block = self.__blocks[block_index]
+        i = self.__find_in_block(block, start)
+
+        chunk._start = start - block.delta
+        chunk._end -= block.delta
+        chunk._block = block
+        block.chunks.insert(i, chunk)
+
+        if len(block.chunks) > _MAX_BLOCK_SIZE:
+            half = len(block.chunks) // 2
+            new_block = _Block(block.chunks[half:], block.delta)
+            del block.chunks[half:]
+            self.__blocks.insert(block_index + 1, new_block)
+
+    def remove(self, chunk):
+        """Remove a chunk from the index"""
+
+        block = chunk._block
+        block.chunks.remove(chunk)
+        start = chunk.start
+        end = chunk.end
+        chunk._block = None
+        chunk._start = start
+        chunk._end = end
+
+        self.__count -= 1
+
+        if len(block.chunks) < _MIN_BLOCK_SIZE:
+            block_index = self.__blocks.index(block)
+            if len(block.chunks) == 0:
+                del self.__blocks[block_index]
+            elif block_index > 0:
+                previous = self.__blocks[block_index - 1]
+                if len(previous.chunks) + len(block.chunks) <= _MAX_BLOCK_SIZE:
+                    previous.normalize()
+                    block.normalize()
+                    for c in block.chunks:
+                        c._block = previous
+                    previous.chunks.extend(block.chunks)
+                    del self.__blocks[block_index]
+
+    def __shift_from(self, block_index, i, count):
+        blocks = self.__blocks
+        if block_index >= len(blocks):
+            return
+
+        # For the rest of the first block, adjust the chunks themselves
+        for chunk in blocks[block_index].chunks[i:]:
+            chunk._start += count
+            chunk._end += count
+
+        for j in xrange(block_index + 1, len(blocks)):
+            blocks[j].delta += count
+
+    def shift(self, line, count):
+        """Move all chunks starting at or after the given line by count lines"""
+
+        block_index, i = self.__find(line)
+        if block_index < len(self.__blocks):
+            chunks = self.__blocks[block_index].chunks
+            if i < len(chunks) and chunks[i].start < line:
+                i += 1
+
+        self.__shift_from(block_index, i, count)
+
+    def shift_after(self, chunk, count):
+        """Move all chunks after the given chunk by count lines"""
+
+        block = chunk._block
+        block_index = self.__blocks.index(block)
+        self.__shift_from(block_index, block.chunks.index(chunk) + 1, count)
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    from chunks import BlankChunk, CommentChunk
+    from test_utils import assert_equals
+
+    _MAX_BLOCK_SIZE = 4
+    _MIN_BLOCK_SIZE = 2
+
+    index = ChunkIndex()
+    assert_equals(index.get_chunk(0), None)
+    assert_equals(list(index.iterate()), [])
+
+    # Chunks of two lines each, added out of order
+    chunks = [BlankChunk(2 * i, 2 * i + 2) for i in xrange(0, 20)]
+    for i in range(0, 20, 2) + range(1, 20, 2):
+        index.add(chunks[i])
+    assert_equals(len(index), 20)
+    assert_equals(list(index.iterate()), chunks)
+    for line in xrange(0, 40):
+        assert index.get_chunk(line) is chunks[line // 2]
+    assert_equals(index.get_chunk(40), None)
+    assert_equals(list(index.iterate(5, 9)), chunks[2:5])
+
+    def expect_ranges(expected):
+        assert_equals([(c.start, c.end) for c in index.iterate()], expected)
+
+    # Shifting
+    index.shift(36, 10)
+    assert_equals((chunks[18].start, chunks[18].end), (46, 48))
+    assert index.get_chunk(36) is None
+    assert index.get_chunk(47) is chunks[18]
+    index.shift(36, -10)
+    index.shift_after(chunks[0], 1)
+    chunks[0].end += 1
+    expect_ranges([(0, 3)] + [(2 * i + 1, 2 * i + 3) for i in xrange(1, 20)])
+    index.shift_after(chunks[0], -1)
+    chunks[0].end -= 1
+
+    # Creating the index from chunks in order
+    other_chunks = [BlankChunk(i, i + 1) for i in xrange(0, 10)]
+    other = ChunkIndex(other_chunks)
+    assert_equals(len(other), 10)
+    assert_equals(list(other.iterate()), other_chunks)
+    assert other.get_chunk(9) is other_chunks[9]
+
+    # Removing, and leaving a gap
+    for chunk in chunks[4:16]:
+        index.remove(chunk)
+    assert_equals(len(index), 8)
+    assert index.get_chunk(10) is None
+    assert index.get_chunk(32) is chunks[16]
+    assert_equals(list(index.iterate(6, 34)), [chunks[3], chunks[16]])
+
+    # Filling the gap
+    comment = CommentChunk(8, 32)
+    index.add(comment)
+    assert index.get_chunk(10) is comment
+    assert_equals(list(index.iterate()), chunks[0:4] + [comment] + chunks[16:])
+
+    # Changing the range of a chunk in the index
+    comment.end = 30
+    chunks[16].start = 30
+    assert index.get_chunk(31) is chunks[16]
+
+    for chunk in list(index.iterate()):
+        index.remove(chunk)
+    assert_equals(len(index), 0)
+    assert_equals(list(index.iterate()), [])
@@ -6,12 +6,39 @@
 #
 ########################################################################
 
+import re
 import traceback
 
 from change_range import ChangeRange
 from statement import Statement, WarningResult
+from retokenize import TOKEN_COMMENT
 from tokenized_statement import TokenizedStatement;
 
+# Number of executions of a statement that we keep the execution times of
+MAX_EXECUTE_TIMES = 10
+
+# A statement can set the time its execution may take with a comment, for
+# example 'data = fetch(url) # timeout: 30'; 0 or 'none' means no limit
+_TIMEOUT_COMMENT_RE = re.compile(r'#\s*timeout\s*[:=]\s*(none\b|\d+(?:\.\d*)?)', re.IGNORECASE)
+
+def _get_timeout(tokenized):
+    for i, line in enumerate(tokenized.lines):
+        # Checking the text first avoids tokenizing most statements before
+        # they are needed
+        if not 'timeout' in line.lower():
+            continue
+
+        for token_type, start, end, _ in tokenized.get_tokens(i):
+            if token_type == TOKEN_COMMENT:
+                m = _TIMEOUT_COMMENT_RE.match(line, start, end)
+                if m:
+                    if m.group(1).lower() == 'none':
+                        return 0.
+                    else:
+                        return float(m.group(1))
+
+    return None
+
 class Chunk(object):
 
     """
@@ -22,11 +49,40 @@ class Chunk(object):
     """
 
     def __init__(self, start=-1, end=-1):
-        self.start = start
-        self.end = end
+        # While the chunk is in a ChunkIndex, _start and _end are relative to
+        # the block of the index that holds it; see chunk_index.py
+        self._block = None
+        self._start = start
+        self._end = end
         self.changes = ChangeRange()
         self.newly_inserted = True
 
+    def __get_start(self):
+        if self._block is None:
+            return self._start
+        return self._start + self._block.delta
+
+    def __set_start(self, start):
+        if self._block is None:
+            self._start = start
+        else:
+            self._start = start - self._block.delta
+
+    start = property(__get_start, __set_start)
+
+    def __get_end(self):
+        if self._block is None:
+            return self._end
+        return self._end + self._block.delta
+
+    def __set_end(self, end):
+        if self._block is None:
+            self._end = end
+        else:
+            self._end = end - self._block.delta
+
+    end = property(__get_end, __set_end)
+
     def set_range(self, start, end):
         if start < self.start:
             self.changes.insert(0, self.start - start)
@@ -79,6 +135,9 @@ class StatementChunk(Chunk):
 
         self.status_changed = False
         self.results_changed = False
+        #: results added at the end of self.results since the last notification. If
+        #: results_changed is set, results need to be redisplayed from scratch anyways
+        self.results_appended = []
 
         self.executing = False
         self.needs_compile = False
@@ -91,6 +150,21 @@ class StatementChunk(Chunk):
         self.error_line = None
         self.error_offset = None
 
+        #: time taken by the last compilation, in seconds, or None
+        self.compile_time = None
+        #: (wall-clock time, CPU time, timed out) of the most recent executions, oldest
+        #: first. See Statement.execute_time and Statement.timed_out
+        self.execute_times = []
+        #: maximum time that executing the statement may take, in seconds, set by a
+        #: '# timeout: <seconds>' comment in the statement; 0 for no limit. If None,
+        #: Worksheet.statement_timeout applies
+        self.timeout = None
+        # Statement and execution time that we last recorded, since update_statement()
+        # may be called more than once for the same execution
+        self.__recorded = None
+        # True if self.results holds the output so far of the executing statement
+        self.__streaming = False
+
     def __repr__(self):
         return "StatementChunk(%d,%d,%r,%r,%r)" % (self.start, self.end, self.needs_compile, self.needs_execute, self.tokenized.get_text())
 
@@ -108,6 +182,7 @@ class StatementChunk(Chunk):
         self.needs_execute = False
 
         self.statement = None
+        self.timeout = _get_timeout(self.tokenized)
 
         return True
 
@@ -127,8 +202,64 @@ class StatementChunk(Chunk):
 
         return self.statement
 
+    def get_cost(self):
+        """Get the wall-clock time taken by the last execution of the statement, in seconds
+
+        @returns: the time, or None if the statement has not been executed
+
+        """
+        if len(self.execute_times) == 0:
+            return None
+
+        return self.execute_times[-1][0]
+
+    def __record_execute_time(self):
+        if self.statement.reused or self.statement.execute_time is None:
+            return
+        if self.__recorded == (self.statement, self.statement.execute_time):
+            return
+
+        self.__recorded = (self.statement, self.statement.execute_time)
+        self.execute_times.append((self.statement.execute_time, self.statement.execute_cpu_time,
+                                   self.statement.timed_out))
+        if len(self.execute_times) > MAX_EXECUTE_TIMES:
+            del self.execute_times[0]
+
+    def __append_results(self, results):
+        self.results.extend(results)
+        if not self.results_changed:
+            self.results_appended.extend(results)
+
+    def update_output(self):
+        """Pick up the output that the executing statement has produced so far"""
+
+        results = self.statement.results
+        if self.statement.state != Statement.EXECUTING or results is None:
+            return
+
+        # Copy the results once, since the executing thread may append to them
+        results = results[:]
+        if self.__streaming:
+            if len(results) > len(self.results):
+                self.__append_results(results[len(self.results):])
+        elif len(results) > 0:
+            # The first output replaces whatever we were showing from the last execution
+            self.__streaming = True
+            self.results = results
+            self.results_changed = True
+            if self.error_message is not None:
+                self.error_message = None
+                self.error_line = None
+                self.error_offset = None
+                self.status_changed = True
+
     def update_statement(self):
         self.status_changed = True
+        self.compile_time = self.statement.compile_time
+
+        streaming = self.__streaming
+        if self.statement.state != Statement.EXECUTING:
+            self.__streaming = False
 
         if self.statement.state == Statement.COMPILE_SUCCESS:
             self.needs_compile = False
@@ -139,9 +270,14 @@ class StatementChunk(Chunk):
             self.executing = False
             self.needs_compile = False
             self.needs_execute = False
-            if self.results != self.statement.results:
+            self.__record_execute_time()
+            results = self.statement.results
+            if streaming and results[0:len(self.results)] == self.results:
+                # Only the output produced since we last looked needs to be added
+                self.__append_results(results[len(self.results):])
+            elif self.results != results:
                 self.results_changed = True
-            self.results = self.statement.results
+            self.results = results
             self.error_message = None
             self.error_line = None
             self.error_offset = None
@@ -157,19 +293,25 @@ class StatementChunk(Chunk):
             self.executing = False
             self.needs_compile = False
             self.needs_execute = True
+            self.__record_execute_time()
             self.error_message = self.statement.error_message
             self.error_line = self.statement.error_line
             self.error_offset = self.statement.error_offset
-            self.results = None
+            # Normally None, but a profile can be added after the error
+            self.results = self.statement.results
             self.results_changed = True
         elif self.statement.state == Statement.INTERRUPTED:
             self.executing = False
             self.needs_compile = False
             self.needs_execute = True
-            self.error_message = "Interrupted"
+            self.__record_execute_time()
+            if self.statement.timed_out:
+                self.error_message = "Timed out after %g seconds" % self.statement.timeout
+            else:
+                self.error_message = "Interrupted"
             self.error_line = None
             self.error_offset = None
-            self.results = None
+            self.results = self.statement.results
             self.results_changed = True
         else:
             # NEW/EXECUTING should not be hit here
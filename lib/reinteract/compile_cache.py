@@ -0,0 +1,274 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import imp
+import logging
+import marshal
+import os
+import sys
+
+try:
+    from hashlib import sha1
+except ImportError: # Python 2.4
+    from sha import new as sha1
+
+from file_writer import replace_file
+
+_debug = logging.getLogger("CompileCache").debug
+
+# Bump if the format of cache entries or the output of the Rewriter changes
+_FORMAT_VERSION = 2
+
+# Name of the cache directory within the notebook folder. Notebook ignores
+# files and directories starting with '.'
+CACHE_DIRECTORY = ".reinteract-cache"
+
+DEFAULT_MAX_SIZE = 16 * 1024 * 1024 # 16M
+
+class CompileCache(object):
+    """Class to store the results of compiling statements on disk
+
+    Rewriting and compiling a statement is expensive, so when a notebook is reopened
+    we'd prefer not to redo it for every statement. CompileCache is a content-addressed
+    store of compiled statements, keyed on the text of the statement, the features
+    imported from __future__ by previous statements, and the version of Python. The
+    size of the cache is bounded by removing the least-recently used entries.
+
+    Errors reading or writing the cache are ignored, so it is fine for the cache
+    directory to be unwritable.
+
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        """Initialize the CompileCache object
+
+        @param directory: the directory to store cache entries in. Created when needed
+        @param max_size: the maximum total size of the entries in the cache, in bytes
+
+        """
+        self.directory = directory
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+
+        # Maps filename => size. Loaded on demand
+        self.__sizes = None
+        self.__total_size = 0
+
+    def __get_key(self, text, encoding, future_features):
+        if isinstance(text, unicode):
+            text = text.encode("utf8")
+            encoding = "utf8"
+
+        h = sha1()
+        h.update("%d\0%s\0%r\0%s\0%s\0" % (_FORMAT_VERSION, sys.version, imp.get_magic(),
+                                            encoding, future_features and ",".join(future_features)))
+        h.update(text)
+
+        return h.hexdigest()
+
+    def __load_sizes(self):
+        if self.__sizes is not None:
+            return
+
+        self.__sizes = {}
+        self.__total_size = 0
+        try:
+            filenames = os.listdir(self.directory)
+        except OSError:
+            return
+
+        for filename in filenames:
+            if filename.endswith(".tmp"):
+                continue
+            try:
+                size = os.stat(os.path.join(self.directory, filename)).st_size
+            except OSError:
+                continue
+            self.__sizes[filename] = size
+            self.__total_size += size
+
+    def __remove(self, filename):
+        try:
+            os.remove(os.path.join(self.directory, filename))
+        except OSError:
+            pass
+
+        if self.__sizes is not None and filename in self.__sizes:
+            self.__total_size -= self.__sizes[filename]
+            del self.__sizes[filename]
+
+    def __evict(self):
+        # Remove the least recently used entries until we are within max_size;
+        # lookup() updates the modification time of entries as they are used
+        if self.__total_size <= self.max_size:
+            return
+
+        entries = []
+        for filename in self.__sizes:
+            try:
+                entries.append((os.stat(os.path.join(self.directory, filename)).st_mtime, filename))
+            except OSError:
+                entries.append((0, filename))
+        entries.sort()
+
+        for _, filename in entries:
+            if self.__total_size <= self.max_size:
+                break
+            _debug("Evicting %s", filename)
+            self.__remove(filename)
+
+    def lookup(self, text, encoding="utf8", future_features=None):
+        """Look up the compiled form of a statement
+
+        @param text: the text of the statement
+        @param encoding: the encoding of text, if it isn't unicode
+        @param future_features: a list of names from the __future__ module
+
+        @returns: None if not found, otherwise a tuple of (compiled, mutated, imports, reads, writes,
+           calls), where compiled and mutated are as returned by L{Rewriter.rewrite_and_compile},
+           imports is as returned by L{Rewriter.get_imports}, reads and writes are as returned by
+           L{Rewriter.get_names} and calls is as returned by L{Rewriter.get_calls}.
+
+        """
+        filename = self.__get_key(text, encoding, future_features)
+        path = os.path.join(self.directory, filename)
+
+        try:
+            f = open(path, "rb")
+        except IOError:
+            self.misses += 1
+            return None
+
+        try:
+            try:
+                result = marshal.load(f)
+            finally:
+                f.close()
+            if not (isinstance(result, tuple) and len(result) == 6):
+                raise ValueError("Bad cache entry")
+        except (EOFError, ValueError, TypeError):
+            # A corrupt entry, get rid of it
+            self.__remove(filename)
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return result
+
+    def store(self, text, encoding, future_features, compiled, mutated, imports, reads, writes, calls):
+        """Store the compiled form of a statement. See lookup() for the parameters."""
+
+        filename = self.__get_key(text, encoding, future_features)
+        try:
+            data = marshal.dumps((compiled, mutated, imports, reads, writes, calls))
+        except ValueError: # unmarshallable constant; shouldn't happen
+            return
+
+        self.__load_sizes()
+
+        path = os.path.join(self.directory, filename)
+        tmpname = path + ".tmp"
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            f = open(tmpname, "wb")
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            replace_file(tmpname, path)
+        except (IOError, OSError):
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+            return
+
+        if filename in self.__sizes:
+            self.__total_size -= self.__sizes[filename]
+        self.__sizes[filename] = len(data)
+        self.__total_size += len(data)
+
+        self.__evict()
+
+    def clear(self):
+        """Remove all entries from the cache"""
+
+        self.__load_sizes()
+        for filename in list(self.__sizes):
+            self.__remove(filename)
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    import shutil
+    import tempfile
+
+    from rewrite import Rewriter
+    from test_utils import assert_equals
+
+    base = tempfile.mkdtemp("", "compile_cache")
+    try:
+        cache = CompileCache(os.path.join(base, CACHE_DIRECTORY))
+
+        def compile_and_store(text, future_features=None):
+            rewriter = Rewriter(text, future_features=future_features)
+            compiled, mutated = rewriter.rewrite_and_compile(output_func_name='reinteract_output')
+            reads, writes = rewriter.get_names()
+            cache.store(text, "utf8", future_features, compiled, mutated, rewriter.get_imports(), reads, writes,
+                        rewriter.get_calls())
+
+        assert_equals(cache.lookup(u"a = [1]; a.append(2)"), None)
+        compile_and_store(u"a = [1]; a.append(2)")
+
+        compiled, mutated, imports, reads, writes, calls = cache.lookup(u"a = [1]; a.append(2)")
+        scope = { 'reinteract_output': lambda *args: None }
+        exec compiled in scope
+        assert_equals(scope['a'], [1, 2])
+        assert_equals([(root, description) for root, description, _ in mutated], [('a', 'a')])
+        assert_equals(imports, None)
+        assert_equals(writes, set(['a']))
+        assert_equals(calls, set([None]))
+        assert_equals((cache.hits, cache.misses), (1, 1))
+
+        # The features imported from __future__ are part of the key
+        assert_equals(cache.lookup(u"a = [1]; a.append(2)", future_features=['division']), None)
+
+        # A new cache object on the same directory finds the stored entries
+        cache = CompileCache(os.path.join(base, CACHE_DIRECTORY))
+        assert cache.lookup(u"a = [1]; a.append(2)") is not None
+
+        # Corrupt entries are treated as missing
+        for filename in os.listdir(cache.directory):
+            f = open(os.path.join(cache.directory, filename), "wb")
+            f.write("garbage")
+            f.close()
+        assert_equals(cache.lookup(u"a = [1]; a.append(2)"), None)
+
+        # So are entries that marshal fine but aren't in the expected form
+        compile_and_store(u"a = [1]; a.append(2)")
+        for filename in os.listdir(cache.directory):
+            f = open(os.path.join(cache.directory, filename), "wb")
+            marshal.dump((1, 2), f)
+            f.close()
+        assert_equals(cache.lookup(u"a = [1]; a.append(2)"), None)
+        assert_equals(os.listdir(cache.directory), [])
+
+        # Least recently used entries are evicted when the cache gets too big
+        cache = CompileCache(os.path.join(base, CACHE_DIRECTORY), max_size=1)
+        compile_and_store(u"b = 1")
+        assert_equals(cache.lookup(u"b = 1"), None)
+    finally:
+        shutil.rmtree(base)
@@ -8,8 +8,13 @@
 
 from ConfigParser import RawConfigParser, ParsingError, NoOptionError, NoSectionError
 import gobject
-import os
+import logging
 import re
+from StringIO import StringIO
+
+from file_writer import FileWriter
+
+_debug = logging.getLogger("ConfigFile").debug
 
 _FLUSH_INTERVAL = 1000 # 1 second
 
@@ -48,8 +53,9 @@ class ConfigFile(object):
 
     ConfigFile provides a high-evel interface around ConfigParser. It handles loading and
     saving the file (saving is automatically done in a timeout once a modification has been
-    made, it auto-creates sections on demand, it handles quoting and has type-specific
-    get and set functions with a the provision to pass a default to the get functions.
+    made, and the file is written in a separate thread), it auto-creates sections on demand,
+    it handles quoting and has type-specific get and set functions with a the provision to
+    pass a default to the get functions.
 
     """
 
@@ -57,6 +63,7 @@ class ConfigFile(object):
         self.location = location
         self.flush_timeout = 0
         self.parser = RawConfigParser()
+        self.__writer = None
 
         try:
             f = open(location, "r")
@@ -139,32 +146,45 @@ class ConfigFile(object):
             self.parser.remove_option(section, option)
             self.queue_flush()
 
-    def flush(self):
+    def __on_written(self, writer):
+        if writer is self.__writer:
+            self.__writer = None
+
+        if writer.error is not None:
+            _debug("Can't write %s: %s", self.location, writer.error)
+
+    def flush(self, wait=True):
+        """Write out the file
+
+        @param wait: if True, wait until the file has been written, and raise an
+           IOError or OSError if that failed. If False, write the file in a
+           separate thread; errors are ignored.
+
+        """
         if self.flush_timeout != 0:
             gobject.source_remove(self.flush_timeout)
             self.flush_timeout = 0
 
-        tmpname = self.location + ".tmp"
-        f = open(tmpname, "w")
-        success = False
-        try:
-            self.parser.write(f)
-            f.close()
-            if os.path.exists(self.location):
-                os.remove(self.location)
-            os.rename(tmpname, self.location)
-            success = True
-        finally:
-            if not success:
-                f.close()
-                try:
-                    os.remove(tmpname)
-                except:
-                    pass
+        if self.__writer is not None:
+            self.__writer.wait()
+
+        f = StringIO()
+        self.parser.write(f)
+        data = f.getvalue()
+
+        writer = self.__writer = FileWriter(self.location, lambda: data, self.__on_written)
+        if wait:
+            writer.wait()
+            if writer.error is not None:
+                raise writer.error
+
+    def __flush_timeout(self):
+        self.flush(wait=False)
+        return False
 
     def queue_flush(self):
         if self.flush_timeout == 0:
-            self.flush_timeout = gobject.timeout_add(_FLUSH_INTERVAL, self.flush)
+            self.flush_timeout = gobject.timeout_add(_FLUSH_INTERVAL, self.__flush_timeout)
 
 ######################################################################
 
@@ -194,3 +214,17 @@ if __name__ == '__main__': #pragma: no cover
     test_quote_list(['foo bar'], '"foo bar"')
     test_quote_list(['foo', 'bar'], 'foo bar')
     test_quote_list(['foo', 'bar baz'], 'foo "bar baz"')
+
+    # Writing and reading back the file
+    import os
+
+    handle, fname = tempfile.mkstemp(".conf", "reinteract_config")
+    os.close(handle)
+
+    try:
+        config = ConfigFile(fname)
+        config.set_list('section', 'names', ['foo', 'bar baz'])
+        config.flush()
+        assert_equals(ConfigFile(fname).get_list('section', 'names'), ['foo', 'bar baz'])
+    finally:
+        os.remove(fname)
@@ -0,0 +1,157 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+# When a statement modifies an object in place ('a.append(1)', 'a[0] = 1'),
+# the object is copied first, so the results of previous statements stay
+# unchanged. This module decides how an object is copied; by default this is
+# copy.copy(), but the way objects of a particular type are copied can be
+# replaced with register_copy_strategy().
+#
+# (An object that only the previous statement refers to may not be copied at
+# all; see Statement.keep_result_scope.)
+
+import copy
+import sys
+
+# Lists longer than this are copied a piece at a time, so that copying
+# a huge list can be interrupted
+_LIST_CHUNK_SIZE = 1000000
+
+# Likewise for numpy arrays bigger than this
+_ARRAY_CHUNK_BYTES = 64 * 1024 * 1024
+
+# Maps type => function to copy objects of exactly that type
+_strategies = {}
+
+# True once the strategies for numpy types have been registered. We don't
+# import numpy ourselves; an array can only show up once it has been imported
+_numpy_registered = False
+
+def register_copy_strategy(type, strategy):
+    """Register how to copy objects of a type before a statement modifies them
+
+    The strategy only applies to objects of exactly that type; objects of
+    subclasses of the type are copied with copy.copy() unless a strategy is
+    registered for the subclass as well.
+
+    @param type: the type of the objects
+    @param strategy: function taking an object and returning a shallow copy of
+       it that can be modified without affecting the original, or None
+       to go back to using copy.copy()
+
+    """
+    if strategy is None:
+        _strategies.pop(type, None)
+    else:
+        _strategies[type] = strategy
+
+def copy_for_mutation(obj):
+    """Copy an object that a statement is about to modify in place, using the
+    strategy registered for its type"""
+
+    if not _numpy_registered and 'numpy' in sys.modules:
+        _register_numpy_strategies()
+
+    strategy = _strategies.get(type(obj))
+    if strategy is not None:
+        return strategy(obj)
+    else:
+        return copy.copy(obj)
+
+def _copy_list(l):
+    if len(l) <= _LIST_CHUNK_SIZE:
+        return l[:]
+
+    # The interpreter can't be interrupted in the middle of copying a list
+    # with a single slice operation
+    result = []
+    for i in xrange(0, len(l), _LIST_CHUNK_SIZE):
+        result.extend(l[i:i + _LIST_CHUNK_SIZE])
+
+    return result
+
+def _copy_ndarray(a):
+    if a.ndim == 0 or a.nbytes <= _ARRAY_CHUNK_BYTES:
+        return a.copy(order='K')
+
+    # As for lists, copy a range of rows at a time
+    import numpy
+    result = numpy.empty_like(a)
+    rows = max(1, len(a) * _ARRAY_CHUNK_BYTES // a.nbytes)
+    for i in xrange(0, len(a), rows):
+        result[i:i + rows] = a[i:i + rows]
+
+    return result
+
+def _register_numpy_strategies():
+    global _numpy_registered
+
+    _numpy_registered = True
+    try:
+        import numpy
+    except ImportError:
+        return
+
+    register_copy_strategy(numpy.ndarray, _copy_ndarray)
+
+register_copy_strategy(list, _copy_list)
+register_copy_strategy(dict, dict.copy)
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    from test_utils import assert_equals
+
+    # Lists are copied in one piece or in chunks
+    l = range(0, 10)
+    l2 = copy_for_mutation(l)
+    assert_equals(l2, l)
+    assert l2 is not l
+
+    _LIST_CHUNK_SIZE = 3
+    l2 = copy_for_mutation(l)
+    assert_equals(l2, l)
+    assert l2 is not l
+
+    # Subclasses don't use the strategy of the base class
+    class MyList(list):
+        pass
+    l = MyList([1, 2])
+    assert_equals(type(copy_for_mutation(l)), MyList)
+
+    # Registering and unregistering a strategy
+    class Big(object):
+        pass
+    copied = []
+    def copy_big(obj):
+        copied.append(obj)
+        return Big()
+    register_copy_strategy(Big, copy_big)
+    b = Big()
+    assert copy_for_mutation(b) is not b
+    assert_equals(copied, [b])
+    register_copy_strategy(Big, None)
+    copy_for_mutation(b)
+    assert_equals(len(copied), 1)
+
+    # Numpy arrays are copied in one piece or by rows
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+    if numpy is not None:
+        a = numpy.arange(0, 10).reshape((5, 2))
+        a2 = copy_for_mutation(a)
+        assert_equals(a2.tolist(), a.tolist())
+        assert not numpy.may_share_memory(a, a2)
+
+        _ARRAY_CHUNK_BYTES = a.itemsize * 4
+        a2 = copy_for_mutation(a)
+        assert_equals(a2.tolist(), a.tolist())
+        assert not numpy.may_share_memory(a, a2)
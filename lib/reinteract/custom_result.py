@@ -6,7 +6,8 @@
 #
 ########################################################################
 
-import gtk
+# gtk is imported where it is used, so that statements producing custom results
+# can be executed without a display; see batch_run.py
 
 class CustomResult(object):
     def create_widget(self):
@@ -15,6 +16,8 @@ class CustomResult(object):
 def show_menu(widget, event, save_callback=None):
     """Convenience function to create a right-click menu with a Save As option"""
 
+    import gtk
+
     toplevel = widget.get_toplevel()
         
     menu = gtk.Menu()
@@ -6,10 +6,10 @@
 #
 ########################################################################
 
+import heapq
 import re
 import inspect
 import pydoc
-import gtk
 from cStringIO import StringIO
 
 #
@@ -40,6 +40,13 @@ _MAX_WRAPPED_ITEM_LINES = 5
 # max line width when line-wrapping
 _MAX_WIDTH = 80
 
+# format_result() summarizes containers with more items than this, counting
+# the items of nested containers, rather than calling repr()
+_MAX_RESULT_ITEMS = 10000
+
+# format_result() summarizes objects with a repr() longer than this
+_MAX_RESULT_LENGTH = 100000
+
 # Common parameters to the functions below:
 #
 #  open: opening delimeter
@@ -158,8 +165,16 @@ def __format_wrapped(sequence, open, close, nl):
 def __format_dict(obj, nl, object_stack):
     nl = nl + " "
 
+    # Each item takes at least one line, so we never show more than _MAX_LINES
+    # items, plus one to know that we need an ellipsis; avoid sorting the
+    # whole of a large dictionary
+    if len(obj) > _MAX_LINES + 1:
+        items = heapq.nsmallest(_MAX_LINES + 1, obj.iteritems())
+    else:
+        items = sorted(obj.items())
+
     def iter():
-        for key, value in sorted(obj.items()):
+        for key, value in items:
             key_str, key_lines = __format(key, nl, object_stack)
             value_str, value_lines = __format(value, nl, object_stack)
 
@@ -168,7 +183,7 @@ def __format_dict(obj, nl, object_stack):
     return __format_separate(iter(), "{", "}", nl)
 
 def __format_sequence(obj, open, close, nl, object_stack):
-    nl = nl + " "
+    nl = nl + " " * len(open)
     
     seq = (__format(x, nl, object_stack) for x in obj)
     result = __format_wrapped(seq, open, close, nl)
@@ -193,6 +208,9 @@ def __format(obj, nl, object_stack):
         return __format_sequence(obj, '[', ']', nl, object_stack)
     elif issubclass(t, tuple) and repr_attr is tuple.__repr__:
         return __format_sequence(obj, '(', ')', nl, object_stack)
+    elif (issubclass(t, set) and repr_attr is set.__repr__ or
+          issubclass(t, frozenset) and repr_attr is frozenset.__repr__):
+        return __format_sequence(obj, t.__name__ + '([', '])', nl, object_stack)
     else:
         s = repr(obj)
         return s.replace("\n", nl),  1 + s.count("\n")
@@ -207,6 +225,126 @@ def format(obj):
     """
     
     return __format(obj, "\n", ())[0]
+
+def __is_summarized(obj):
+    # Check if format() formats the items of obj itself, showing only the
+    # first ones, rather than calling repr(); the same tests as __format()
+    t = type(obj)
+    repr_attr = getattr(t, '__repr__', None)
+    return (issubclass(t, dict) and repr_attr is dict.__repr__ or
+            issubclass(t, list) and repr_attr is list.__repr__ or
+            issubclass(t, tuple) and repr_attr is tuple.__repr__ or
+            issubclass(t, set) and repr_attr is set.__repr__ or
+            issubclass(t, frozenset) and repr_attr is frozenset.__repr__)
+
+def __count_items(obj, limit):
+    # Count the items in obj, and in the containers within it that format()
+    # summarizes, stopping once the count is more than limit
+    count = 0
+    seen = set()
+    pending = [obj]
+    while pending and count <= limit:
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+
+        if not __is_summarized(obj):
+            continue
+
+        if isinstance(obj, dict):
+            count += len(obj)
+            if count <= limit:
+                pending.extend(obj.iterkeys())
+                pending.extend(obj.itervalues())
+        else:
+            count += len(obj)
+            if count <= limit:
+                pending.extend(obj)
+
+    return count
+
+def format_result(obj):
+    """Format the result of a statement, limiting the time taken and the length of the text
+
+    Small objects are formatted with repr(). Containers with many items
+    (including the items of containers within them) are summarized with
+    format() instead, without calling repr(). Either way, long text is
+    truncated; format() calls repr() on objects that it doesn't summarize,
+    such as subclasses of dict with their own repr().
+
+    @returns: a tuple of (text, complete); complete is False if the text is a summary
+
+    """
+    if __count_items(obj, _MAX_RESULT_ITEMS) > _MAX_RESULT_ITEMS:
+        s = format(obj)
+        complete = False
+    else:
+        s = repr(obj)
+        complete = True
+
+    if len(s) > _MAX_RESULT_LENGTH:
+        return s[0:_MAX_RESULT_LENGTH] + "...", False
+    else:
+        return s, complete
+
+def __iter_repr(obj, object_stack):
+    for o in object_stack:
+        if obj is o:
+            if isinstance(obj, dict):
+                yield "{...}"
+            else:
+                yield "[...]"
+            return
+
+    t = type(obj)
+    repr_attr = getattr(t, '__repr__', None)
+    if issubclass(t, dict) and repr_attr is dict.__repr__:
+        object_stack += (obj,)
+        yield "{"
+        first = True
+        for key, value in obj.iteritems():
+            if not first:
+                yield ", "
+            first = False
+            for s in __iter_repr(key, object_stack):
+                yield s
+            yield ": "
+            for s in __iter_repr(value, object_stack):
+                yield s
+        yield "}"
+    elif (issubclass(t, list) and repr_attr is list.__repr__ or
+          issubclass(t, tuple) and repr_attr is tuple.__repr__):
+        object_stack += (obj,)
+        if isinstance(obj, list):
+            yield "["
+        else:
+            yield "("
+        first = True
+        for item in obj:
+            if not first:
+                yield ", "
+            first = False
+            for s in __iter_repr(item, object_stack):
+                yield s
+        if isinstance(obj, list):
+            yield "]"
+        elif len(obj) == 1:
+            yield ",)"
+        else:
+            yield ")"
+    else:
+        yield repr(obj)
+
+def iter_repr(obj):
+    """Generate the text of repr(obj) a piece at a time
+
+    Dictionaries, lists and tuples are generated an item at a time, so that
+    generating the text for a large container can be spread out or stopped
+    part way through.
+
+    """
+    return __iter_repr(obj, ())
     
 def insert_formatted(buf, iter, obj, heading_type_tag, inline_type_tag, value_tag):
     """Insert a nicely-formatted display of obj into a gtk.TextBuffer
@@ -339,3 +477,43 @@ if __name__ == "__main__":
     a.append(a)
 
     do_test(a, "[1, <Recursion>]")
+
+    # Only the first items of a large dictionary are sorted
+    do_test(dict(((x, x) for x in range(100, 0, -1))),
+            """
+            {1: 1,
+             2: 2,
+             3: 3,
+             4: 4,
+             ...}
+            """)
+
+    # Limiting the size of results
+    _MAX_RESULT_ITEMS = 10
+    _MAX_RESULT_LENGTH = 20
+    assert format_result(range(5)) == ("[0, 1, 2, 3, 4]", True)
+    assert format_result(range(11)) == (format(range(11))[0:20] + "...", False)
+    assert format_result([range(5), range(6)])[1] == False
+    assert format_result(tuple(range(12))) == (format(tuple(range(12)))[0:20] + "...", False)
+
+    # Containers that format() doesn't summarize have their repr() truncated
+    from collections import OrderedDict
+    ordered = OrderedDict((x, x) for x in range(100))
+    assert format_result(ordered) == (repr(ordered)[0:20] + "...", False)
+    assert format_result([ordered]) == (repr([ordered])[0:20] + "...", False)
+    assert format_result("a" * 30) == ("'" + "a" * 19 + "...", False)
+    do_test(set(range(40)),
+            """
+            set([0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10,
+                 11, 12, 13, 14, 15, 16, 17, 18, 19,
+                 20, 21, 22, 23, 24, 25, 26, ...])
+            """)
+
+    # Generating repr() incrementally
+    for obj in ([], (1,), (1, 2), { 1: [2, (3, 4)], 'a': {} }, a, ["a", u"b", 1.5]):
+        result = "".join(iter_repr(obj))
+        if result != repr(obj):
+            print "For %s,\nGot:\n%s\nExpected:\n%s" % (repr(obj), result, repr(obj))
+    d = {}
+    d[1] = d
+    assert "".join(iter_repr(d)) == repr(d)
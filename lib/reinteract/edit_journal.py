@@ -0,0 +1,384 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import logging
+import os
+import re
+import thread
+import threading
+
+try:
+    from hashlib import sha1
+except ImportError: # Python 2.4
+    from sha import new as sha1
+
+from file_writer import replace_file, sync_directory
+from undo_stack import InsertOp, DeleteOp
+
+_debug = logging.getLogger("EditJournal").debug
+
+# A journal file starts with this line, then a line 'B <key>' with the key of
+# the text of the worksheet file it applies to (see get_journal_key()). Then
+# come the records of the edits made to that text, each of which is one of:
+#
+#  I <line> <offset> <length>\n<text>\n   - insert text; length is of the UTF-8 text
+#  D <start_line> <start_offset> <end_line> <end_offset>\n  - delete a range
+#  T <length>\n<text>\n                   - replace the whole text
+#
+# If the program crashes while a record is being written, the journal ends
+# with an incomplete record, which is ignored.
+_MAGIC = "reinteract-journal 1\n"
+
+# Same as worksheet.NEW_LINE_RE
+_NEW_LINE_RE = re.compile(r'\n|\r|\r\n')
+
+# Default for EditJournal.max_size
+DEFAULT_MAX_SIZE = 1024 * 1024 # bytes
+
+def get_journal_filename(filename):
+    """Get the filename of the journal for a worksheet file. It is next to the
+    worksheet file, and starts with '.', so it is ignored by Notebook"""
+
+    folder, basename = os.path.split(filename)
+    return os.path.join(folder, "." + basename + ".journal")
+
+def get_journal_key(text):
+    """Compute the key identifying the text of a worksheet file, so that a journal
+    is only replayed onto the text it was recorded against
+
+    @param text: the text of the file, as a unicode string
+
+    """
+    if isinstance(text, unicode):
+        text = text.encode("utf8")
+
+    return sha1(text).hexdigest()
+
+def _encode(text):
+    if isinstance(text, unicode):
+        return text.encode("utf8")
+    else:
+        return text
+
+def _encode_op(op):
+    if isinstance(op, InsertOp):
+        data = _encode(op.text)
+        return "I %d %d %d\n%s\n" % (op.start[0], op.start[1], len(data), data)
+    elif isinstance(op, DeleteOp):
+        return "D %d %d %d %d\n" % (op.start[0], op.start[1], op.end[0], op.end[1])
+    else:
+        raise ValueError("Can't journal %r" % op)
+
+def _check_position(lines, line, offset):
+    if line < 0 or line >= len(lines) or offset < 0 or offset > len(lines[line]):
+        raise ValueError("Position %d,%d is outside the text" % (line, offset))
+
+def _read_text(f, length):
+    data = f.read(length + 1)
+    if len(data) != length + 1 or data[-1] != "\n":
+        raise ValueError("Incomplete record")
+
+    return data[:-1].decode("utf8")
+
+def read_journal(filename, text):
+    """Replay a journal onto the text of a worksheet file
+
+    @param filename: the journal file
+    @param text: the text of the worksheet file, as a unicode string
+    @returns: the text of the worksheet with the edits in the journal, or None if
+      there is no journal, it doesn't apply to the file, or has no edits.
+
+    """
+    try:
+        f = open(filename, "rb")
+    except IOError:
+        return None
+
+    try:
+        if f.readline() != _MAGIC or f.readline() != "B %s\n" % get_journal_key(text):
+            _debug("Journal %s is for a different file", filename)
+            return None
+
+        lines = _NEW_LINE_RE.split(text)
+        have_edits = False
+        while True:
+            header = f.readline()
+            if header == "":
+                break
+
+            # Everything is checked before changing lines, so an incomplete or
+            # bad record at the end is ignored
+            try:
+                if not header.endswith("\n"):
+                    raise ValueError("Incomplete record")
+                fields = header.split()
+                if fields[0] == 'T' and len(fields) == 2:
+                    lines = _NEW_LINE_RE.split(_read_text(f, int(fields[1])))
+                elif fields[0] == 'I' and len(fields) == 4:
+                    line, offset = int(fields[1]), int(fields[2])
+                    text = _read_text(f, int(fields[3]))
+                    _check_position(lines, line, offset)
+                    new_lines = _NEW_LINE_RE.split(text)
+                    new_lines[0] = lines[line][:offset] + new_lines[0]
+                    new_lines[-1] += lines[line][offset:]
+                    lines[line:line + 1] = new_lines
+                elif fields[0] == 'D' and len(fields) == 5:
+                    start_line, start_offset, end_line, end_offset = [int(x) for x in fields[1:]]
+                    _check_position(lines, start_line, start_offset)
+                    _check_position(lines, end_line, end_offset)
+                    lines[start_line:end_line + 1] = [lines[start_line][:start_offset] +
+                                                      lines[end_line][end_offset:]]
+                else:
+                    raise ValueError("Bad record %r" % header)
+            except (ValueError, IndexError, UnicodeDecodeError), e:
+                _debug("Ignoring the end of journal %s: %s", filename, e)
+                break
+
+            have_edits = True
+    finally:
+        f.close()
+
+    if not have_edits:
+        return None
+
+    return u"\n".join(lines)
+
+class EditJournal(object):
+    """Class to record the edits made to a worksheet since it was last saved
+
+    The edits are appended to a journal file next to the worksheet file, so that
+    they can be recovered with read_journal() if the program crashes. The journal
+    is written in a separate thread, so recording an edit doesn't wait for the disk.
+
+    The journal records the InsertOp and DeleteOp operations that the undo stack
+    records, starting from the text of the worksheet file. Once the edits take up
+    more than max_size, and more than the text, the journal should be started
+    again with the whole text (see checkpoint()), so it doesn't grow without
+    limit. That's much cheaper than saving the worksheet file, which is only
+    written when the user saves it.
+
+    Errors writing the journal are logged and otherwise ignored.
+
+    """
+
+    def __init__(self, filename, key, max_size=DEFAULT_MAX_SIZE):
+        """Initialize the EditJournal object. Nothing is written until the first edit
+
+        @param filename: the journal file, see get_journal_filename()
+        @param key: the key of the text of the worksheet file, see get_journal_key()
+        @param max_size: see needs_checkpoint()
+
+        """
+        self.filename = filename
+        self.max_size = max_size
+
+        self.__header = _MAGIC + "B %s\n" % key
+        self.__started = False
+        self.__checkpoint_size = 0
+        #: bytes of edits recorded since the last checkpoint
+        self.size = 0
+
+        self.__lock = thread.allocate_lock()
+        self.__condition = threading.Condition(self.__lock)
+        # List of (restart, data); if restart is True, the file is started again
+        self.__pending = []
+        self.__writing = False
+        self.__file = None
+        self.__failed = False
+
+    def __run(self):
+        while True:
+            self.__lock.acquire()
+            pending = self.__pending
+            self.__pending = []
+            if len(pending) == 0:
+                self.__writing = False
+                self.__condition.notifyAll()
+            self.__lock.release()
+
+            if len(pending) == 0:
+                return
+
+            for restart, data in pending:
+                self.__write(restart, data)
+
+            if self.__file is not None and not self.__failed:
+                try:
+                    self.__file.flush()
+                    os.fsync(self.__file.fileno())
+                except (IOError, OSError), e:
+                    _debug("Can't write journal %s: %s", self.filename, e)
+                    self.__failed = True
+
+    def __write(self, restart, data):
+        if restart:
+            self.__close_file()
+            self.__failed = False
+
+        if self.__failed:
+            return
+
+        try:
+            if restart:
+                # Writing to a temporary file and renaming it means that there is
+                # always a complete journal, even if we crash while starting again
+                tmpname = self.filename + ".tmp"
+                f = open(tmpname, "wb")
+                try:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                finally:
+                    f.close()
+                replace_file(tmpname, self.filename)
+                sync_directory(self.filename)
+                self.__file = open(self.filename, "ab")
+            else:
+                self.__file.write(data)
+        except (IOError, OSError), e:
+            _debug("Can't write journal %s: %s", self.filename, e)
+            self.__failed = True
+
+    def __close_file(self):
+        if self.__file is not None:
+            try:
+                self.__file.close()
+            except IOError:
+                pass
+            self.__file = None
+
+    def __queue(self, restart, data):
+        self.__lock.acquire()
+        if restart:
+            # Anything not yet written is replaced
+            self.__pending = []
+        self.__pending.append((restart, data))
+        if not self.__writing:
+            self.__writing = True
+            thread.start_new_thread(self.__run, ())
+        self.__lock.release()
+
+    def checkpoint(self, text):
+        """Start the journal again with the whole text of the worksheet
+
+        @param text: the current text of the worksheet
+
+        """
+        data = _encode(text)
+        self.__started = True
+        self.__checkpoint_size = len(data)
+        self.size = 0
+        self.__queue(True, self.__header + "T %d\n%s\n" % (len(data), data))
+
+    def append_op(self, op):
+        """Record an edit
+
+        @param op: the InsertOp or DeleteOp for the edit
+
+        """
+        data = _encode_op(op)
+        self.size += len(data)
+        if self.__started:
+            self.__queue(False, data)
+        else:
+            self.__started = True
+            self.__queue(True, self.__header + data)
+
+    def needs_checkpoint(self):
+        """Return True if the edits since the last checkpoint take up more than
+        max_size and more than the text of the checkpoint"""
+
+        return self.size > max(self.max_size, self.__checkpoint_size)
+
+    def wait(self):
+        """Wait until everything recorded so far has been written"""
+
+        self.__lock.acquire()
+        while self.__writing:
+            self.__condition.wait()
+        self.__lock.release()
+
+    def close(self, remove=False):
+        """Finish writing the journal
+
+        @param remove: if True, the journal file is removed, since the edits
+           have been saved or discarded
+
+        """
+        self.wait()
+        self.__close_file()
+
+        if remove:
+            try:
+                os.remove(self.filename)
+            except OSError:
+                pass
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    import shutil
+    import tempfile
+
+    from test_utils import assert_equals
+
+    base = tempfile.mkdtemp("", "edit_journal")
+    try:
+        filename = get_journal_filename(os.path.join(base, "test.rws"))
+        assert_equals(os.path.basename(filename), ".test.rws.journal")
+        key = get_journal_key(u"a = 1")
+
+        assert_equals(read_journal(filename, u"a = 1"), None)
+
+        journal = EditJournal(filename, key)
+        journal.append_op(InsertOp((0, 5), (2, 1), u"\n\u00e9\nb"))
+        journal.append_op(DeleteOp((0, 0), (0, 1), u"a"))
+        journal.append_op(DeleteOp((0, 3), (1, 0), u"1\n"))
+        journal.wait()
+        assert_equals(read_journal(filename, u"a = 1"), u" = \u00e9\nb")
+
+        # A journal for different text isn't used
+        assert_equals(read_journal(filename, u"a = 2"), None)
+
+        # An incomplete record at the end is ignored
+        journal.append_op(InsertOp((1, 1), (1, 4), u"cde"))
+        journal.close()
+        f = open(filename, "rb")
+        contents = f.read()
+        f.close()
+
+        def write_journal(data):
+            f = open(filename, "wb")
+            f.write(data)
+            f.close()
+
+        write_journal(contents + "I 1 4 10\nfg")
+        assert_equals(read_journal(filename, u"a = 1"), u" = \u00e9\nbcde")
+
+        # So is an edit that doesn't fit the text
+        write_journal(contents + "D 0 0 5 0\n")
+        assert_equals(read_journal(filename, u"a = 1"), u" = \u00e9\nbcde")
+        write_journal(contents + "X\n")
+        assert_equals(read_journal(filename, u"a = 1"), u" = \u00e9\nbcde")
+
+        # Starting again with a checkpoint
+        journal = EditJournal(filename, key, max_size=10)
+        journal.checkpoint(u"x")
+        assert not journal.needs_checkpoint()
+        for i in xrange(0, 3):
+            journal.append_op(InsertOp((0, i + 1), (0, i + 2), u"y"))
+        assert journal.needs_checkpoint()
+        journal.checkpoint(u"xyyy")
+        assert not journal.needs_checkpoint()
+        journal.wait()
+        assert_equals(read_journal(filename, u"a = 1"), u"xyyy")
+
+        journal.close(remove=True)
+        assert_equals(os.listdir(base), [])
+    finally:
+        shutil.rmtree(base)
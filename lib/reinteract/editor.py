@@ -30,6 +30,19 @@ class Editor(gobject.GObject):
     # Utility
     #######################################################
 
+    def _on_saved(self, worksheet, filename, error):
+        # Connected to Worksheet::saved by subclasses, to report errors writing
+        # the file; saves started from the Save action finish in the background
+        if error is None:
+            return
+
+        dialog = gtk.MessageDialog(parent=self.widget.get_toplevel(), buttons=gtk.BUTTONS_OK,
+                                   type=gtk.MESSAGE_ERROR)
+        dialog.set_markup(format_escaped("<big><b>Cannot save '%s'</b></big>", os.path.basename(filename)))
+        dialog.format_secondary_text("Error saving '%s': %s" % (filename, getattr(error, 'strerror', None) or error))
+        dialog.run()
+        dialog.destroy()
+
     def _clear_unsaved(self):
         if self._unsaved_index is not None:
             application.free_unsaved_index(self._unsaved_index)
@@ -82,7 +95,7 @@ class Editor(gobject.GObject):
     def _get_extension(self):
         return NotImplementedError()
 
-    def _save(self, filename):
+    def _save(self, filename, wait=True):
         return NotImplementedError()
 
     #######################################################
@@ -150,7 +163,14 @@ class Editor(gobject.GObject):
         """
         raise NotImplementedError()
 
-    def save(self, filename=None):
+    def save(self, filename=None, wait=True):
+        """Save the file, prompting for a filename if it doesn't have one yet
+
+        @param filename: the file to save to, or None for the current filename
+        @param wait: if False, the file may be written in the background, see
+           Worksheet.save(). Errors are then reported to the user when done.
+
+        """
         if filename is None:
             filename = self._get_filename()
 
@@ -162,7 +182,7 @@ class Editor(gobject.GObject):
 
             self.__prompt_for_name(title="Save As...", save_button_text="_Save", action=action)
         else:
-            self._save(filename)
+            self._save(filename, wait)
 
     def rename(self):
         if self._get_filename() is None:
@@ -194,6 +214,12 @@ class Editor(gobject.GObject):
     def calculate(self):
         pass
 
+    def profile(self, whole_calculation=False):
+        pass
+
+    def clear_snapshots(self):
+        pass
+
     def undo(self):
         pass
 
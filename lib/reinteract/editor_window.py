@@ -40,6 +40,9 @@ class EditorWindow(BaseWindow):
          <separator/>
          <menuitem action="calculate"/>
          <menuitem action="break"/>
+         <menuitem action="profile"/>
+         <menuitem action="profile-calculation"/>
+         <menuitem action="clear-snapshots"/>
          <separator/>
          <menuitem action="preferences"/>
       </menu>
@@ -114,7 +117,7 @@ class EditorWindow(BaseWindow):
         if self.current_editor.filename is None:
             self.__save_as()
         else:
-            self.current_editor.save()
+            self.current_editor.save(wait=False)
 
     def on_save_as(self, action):
         self.__save_as()
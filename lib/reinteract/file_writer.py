@@ -0,0 +1,222 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import gobject
+import os
+import thread
+import threading
+import time
+
+def replace_file(tmpname, filename):
+    """Rename a file over another file. On POSIX systems, the rename replaces
+    the file atomically; Windows can't rename over an existing file, so there
+    the file is removed first.
+
+    Can raise OSError.
+
+    @param tmpname: the file to rename
+    @param filename: the file to replace
+
+    """
+    if os.name == 'nt' and os.path.exists(filename):
+        os.unlink(filename)
+    os.rename(tmpname, filename)
+
+def sync_directory(filename):
+    """Make sure that the entry for a file in its directory is on disk, for
+    example after replace_file(). Does nothing where that isn't possible, as
+    on Windows.
+
+    @param filename: the file whose directory to sync
+
+    """
+    if os.name == 'nt':
+        return
+
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        try:
+            os.fsync(fd)
+        except OSError: # Not supported by some file systems
+            pass
+    finally:
+        os.close(fd)
+
+def write_file(filename, data):
+    """Replace the contents of a file. The data is written to a temporary file,
+    which is synced to disk and renamed over the file, so if something goes
+    wrong, the old contents of the file are left alone. The directory is synced
+    after the rename, so the new contents are there after a crash.
+
+    Can raise IOError or OSError.
+
+    @param filename: the file to write
+    @param data: the new contents of the file, as a string
+
+    """
+    tmpname = filename + ".tmp"
+
+    # We use binary mode, since we don't want to munge line endings to the system default
+    # on a load-save cycle
+    f = open(tmpname, "wb")
+
+    success = False
+    try:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        replace_file(tmpname, filename)
+        sync_directory(filename)
+        success = True
+    finally:
+        if not success:
+            f.close()
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+
+class FileWriter(object):
+    """Class to write a file with write_file() in a separate thread
+
+    The callback is called from the main loop once the file has been written,
+    or from wait() if that is called first. The attributes of the writer are
+    then set:
+
+     - error: the exception raised writing the file (IOError or OSError, unless
+       get_data() failed), or None
+     - size: the number of bytes written
+     - duration: the time taken to compute the data and write it, in seconds
+
+    """
+
+    def __init__(self, filename, get_data, callback):
+        """Initialize the FileWriter object and start writing the file
+
+        @param filename: the file to write
+        @param get_data: function returning the contents of the file as a
+           string. It is called in the writing thread, so it can take a while,
+           but must not touch anything the main thread may be changing.
+        @param callback: function called as callback(writer) when done
+
+        """
+        self.filename = filename
+        self.error = None
+        self.size = 0
+        self.duration = 0
+
+        self.__callback = callback
+        self.__lock = thread.allocate_lock()
+        self.__condition = threading.Condition(self.__lock)
+        self.__done = False
+        self.__idle_id = 0
+
+        thread.start_new_thread(self.__run, (get_data,))
+
+    def __run(self, get_data):
+        start = time.time()
+        try:
+            data = get_data()
+            self.size = len(data)
+            write_file(self.filename, data)
+        except Exception, e:
+            # Normally an IOError or OSError, but the main thread must hear about
+            # anything that goes wrong, or it could wait forever
+            self.error = e
+        self.duration = time.time() - start
+
+        self.__lock.acquire()
+        self.__done = True
+        self.__idle_id = gobject.idle_add(self.__run_idle)
+        self.__condition.notifyAll()
+        self.__lock.release()
+
+    def __take_idle(self):
+        self.__lock.acquire()
+        idle_id = self.__idle_id
+        self.__idle_id = 0
+        self.__lock.release()
+
+        return idle_id
+
+    def __run_idle(self):
+        if self.__take_idle() != 0:
+            self.__callback(self)
+
+        return False
+
+    def wait(self):
+        """Wait until the file has been written, and call the callback if it
+        hasn't been called yet"""
+
+        self.__lock.acquire()
+        while not self.__done:
+            self.__condition.wait()
+        self.__lock.release()
+
+        idle_id = self.__take_idle()
+        if idle_id != 0:
+            gobject.source_remove(idle_id)
+            self.__callback(self)
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    import shutil
+    import tempfile
+
+    from test_utils import assert_equals
+
+    gobject.threads_init()
+
+    base = tempfile.mkdtemp("", "file_writer")
+    try:
+        filename = os.path.join(base, "test.txt")
+
+        write_file(filename, "a\r\nb")
+        f = open(filename, "rb")
+        assert_equals(f.read(), "a\r\nb")
+        f.close()
+
+        # Writing again replaces the file
+        write_file(filename, "c")
+        f = open(filename, "rb")
+        assert_equals(f.read(), "c")
+        f.close()
+
+        # Writing in a thread, and getting called back from the main loop
+        completed = []
+        loop = gobject.MainLoop()
+        def callback(writer):
+            completed.append(writer)
+            loop.quit()
+        writer = FileWriter(filename, lambda: "hello", callback)
+        loop.run()
+        assert_equals(completed, [writer])
+        assert_equals((writer.error, writer.size), (None, 5))
+        f = open(filename, "rb")
+        assert_equals(f.read(), "hello")
+        f.close()
+
+        # Waiting calls the callback immediately, and only once
+        writer = FileWriter(os.path.join(base, "missing", "test.txt"), lambda: "hello", callback)
+        writer.wait()
+        assert_equals(len(completed), 2)
+        assert isinstance(writer.error, IOError)
+        writer.wait()
+        gobject.timeout_add(10, loop.quit)
+        loop.run()
+        assert_equals(len(completed), 2)
+
+        assert_equals(sorted(os.listdir(base)), ["test.txt"])
+    finally:
+        shutil.rmtree(base)
@@ -13,6 +13,7 @@ import os
 import sys
 
 from config_file import ConfigFile
+from undo_stack import DEFAULT_MAX_MEMORY
 
 def _bool_property(name, default):
     def getter(self):
@@ -23,6 +24,15 @@ def _bool_property(name, default):
 
     return gobject.property(getter=getter, setter=setter, type=bool, default=default)
 
+def _int_property(name, default=0):
+    def getter(self):
+        return self.config.get_int('Reinteract', name, default)
+
+    def setter(self, value):
+        self.config.set_int('Reinteract', name, value)
+
+    return gobject.property(getter=getter, setter=setter, type=int, default=default)
+
 def _string_property(name, default=None):
     def getter(self):
         return self.config.get_string('Reinteract', name, default)
@@ -50,6 +60,33 @@ class GlobalSettings(gobject.GObject):
 
     autocomplete = _bool_property('autocomplete', default=True)
 
+    execute_in_subprocess = _bool_property('execute_in_subprocess', default=False)
+    # Maximum number of worksheets to calculate at once for Calculate All; 0 means
+    # the number of processors
+    calculate_all_jobs = _int_property('calculate_all_jobs', default=0)
+    # Show the time taken by each statement in the margin of worksheets
+    show_execution_times = _bool_property('show_execution_times', default=False)
+    # Use the statistical profiler rather than cProfile for the profile actions
+    profile_by_sampling = _bool_property('profile_by_sampling', default=False)
+    # Maximum number of independent statements of a worksheet to execute at once
+    parallel_statements = _int_property('parallel_statements', default=1)
+    # Maximum number of times a second to update worksheets as statements complete;
+    # 0 means no limit
+    max_update_rate = _int_property('max_update_rate', default=20)
+    # Maximum time in seconds that executing a single statement may take before it
+    # is interrupted; 0 means no limit
+    statement_timeout = _int_property('statement_timeout', default=0)
+    # Save the results of slow statements to disk, to restore them when a worksheet is reopened
+    save_snapshots = _bool_property('save_snapshots', default=False)
+    # Reuse the results of statements executed again with the same values for the names they
+    # read, instead of executing them. See Worksheet.memo_cache
+    memoize_statements = _bool_property('memoize_statements', default=False)
+    # Record unsaved edits to worksheets next to the worksheet file, to recover them after a crash
+    save_journal = _bool_property('save_journal', default=True)
+    # Number of characters of the undo history of each worksheet to keep in memory before
+    # moving the oldest edits to disk; 0 means no limit. See Worksheet.undo_memory_budget
+    undo_memory_budget = _int_property('undo_memory_budget', default=DEFAULT_MAX_MEMORY)
+
     def __init__(self):
         gobject.GObject.__init__(self)
 
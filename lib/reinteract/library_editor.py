@@ -76,7 +76,8 @@ class LibraryEditor(Editor):
     def _get_extension(self):
         return "py"
 
-    def _save(self, filename):
+    def _save(self, filename, wait=True):
+        # The module is reloaded from the file, so it must be written first
         self.buf.worksheet.save(filename)
         self.notebook.reset_module_by_filename(filename)
 
@@ -0,0 +1,397 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import os
+import re
+import sys
+import thread
+import types
+
+try:
+    from hashlib import sha1
+except ImportError: # Python 2.4
+    from sha import new as sha1
+
+from scope import estimate_size
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024 # 64M
+
+# Statements that mention any of these names are assumed to give different
+# results each time they are executed, or to have side effects, so aren't memoized
+DEFAULT_IMPURE_NAMES = frozenset([
+    'datetime', 'file', 'glob', 'input', 'open', 'os', 'rand', 'randint', 'random',
+    'raw_input', 'shutil', 'socket', 'subprocess', 'sys', 'tempfile', 'time',
+    'urllib', 'urllib2', 'uuid'
+])
+
+# A statement can also be marked as impure with a comment
+_IMPURE_COMMENT_RE = re.compile(r'#\s*impure\b')
+
+_WORD_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+# Fingerprinting gives up on values bigger than this, since hashing them
+# could take longer than executing the statement
+_MAX_FINGERPRINT_BYTES = 256 * 1024 * 1024
+_MAX_FINGERPRINT_ITEMS = 1000000
+_MAX_FINGERPRINT_DEPTH = 32
+
+# Marker for a name that wasn't found in a scope
+_MISSING = object()
+
+class _Unfingerprintable(Exception):
+    pass
+
+def _get_module_mtime(module):
+    try:
+        return os.path.getmtime(module.__file__)
+    except (AttributeError, OSError):
+        return None
+
+class _Fingerprinter(object):
+    # Feeds a description of the content of values to a hash object
+
+    def __init__(self, impure_names=()):
+        self.hash = sha1()
+        self.__impure_names = impure_names
+        self.__bytes = 0
+        self.__items = 0
+        # Functions being fingerprinted, to handle recursion
+        self.__functions = []
+
+    def __update(self, s):
+        self.__bytes += len(s)
+        if self.__bytes > _MAX_FINGERPRINT_BYTES:
+            raise _Unfingerprintable()
+        self.hash.update(s)
+
+    def __get_sub_digest(self, value, depth):
+        sub = _Fingerprinter(self.__impure_names)
+        sub.__bytes = self.__bytes
+        sub.__items = self.__items
+        sub.__functions = self.__functions
+        sub.add(value, depth)
+        self.__bytes = sub.__bytes
+        self.__items = sub.__items
+
+        return sub.hash.digest()
+
+    def __add_array(self, value):
+        # numpy arrays and scalars; the data of arrays of Python objects is pointers
+        dtype = value.dtype
+        if dtype.hasobject:
+            raise _Unfingerprintable()
+        self.__update("a%s:%r:" % (dtype.str, getattr(value, 'shape', ())))
+        if type(value).__name__ == 'ndarray' and value.flags['C_CONTIGUOUS']:
+            # Hash the data in place, without copying it
+            self.__update(buffer(value))
+        else:
+            self.__update(value.tostring())
+
+    def __add_function(self, f, depth):
+        if f in self.__functions:
+            self.__update("r%d:" % self.__functions.index(f))
+            return
+
+        self.__functions.append(f)
+        try:
+            code = f.func_code
+            names = self.__get_code_names(code)
+            # Calling the function may have side effects, like the statement itself
+            if not names.isdisjoint(self.__impure_names):
+                raise _Unfingerprintable()
+            self.__update("f%s:" % f.__name__)
+            self.__add_code(code, depth)
+            self.add(f.func_defaults, depth)
+            if f.func_closure is not None:
+                self.add(tuple(cell.cell_contents for cell in f.func_closure), depth)
+            # The global names that the function reads
+            for name in sorted(names):
+                value = f.func_globals.get(name, _MISSING)
+                if value is not _MISSING and name != '__builtins__':
+                    self.__update("g%s:" % name)
+                    self.add(value, depth)
+        finally:
+            self.__functions.pop()
+
+    def __get_code_names(self, code):
+        names = set(code.co_names)
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                names.update(self.__get_code_names(const))
+
+        return names
+
+    def __add_code(self, code, depth):
+        self.__update("c%d:" % len(code.co_code))
+        self.__update(code.co_code)
+        self.__update(repr(code.co_names))
+        self.__update(repr(code.co_varnames))
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                self.__add_code(const, depth + 1)
+            else:
+                self.add(const, depth + 1)
+
+    def add(self, value, depth=0):
+        self.__items += 1
+        if self.__items > _MAX_FINGERPRINT_ITEMS or depth > _MAX_FINGERPRINT_DEPTH:
+            raise _Unfingerprintable()
+
+        t = type(value)
+        if value is None or value is _MISSING or t in (bool, int, long, float, complex):
+            if value is _MISSING:
+                self.__update("m")
+            else:
+                self.__update("%s:%r\0" % (t.__name__, value))
+        elif t is str:
+            self.__update("s%d:" % len(value))
+            self.__update(value)
+        elif t is unicode:
+            value = value.encode("utf8")
+            self.__update("u%d:" % len(value))
+            self.__update(value)
+        elif t is tuple or t is list:
+            self.__update("%s%d:" % (t.__name__[0], len(value)))
+            for item in value:
+                self.add(item, depth + 1)
+        elif t is dict:
+            digests = sorted(self.__get_sub_digest(key, depth + 1) + self.__get_sub_digest(item, depth + 1)
+                             for key, item in value.iteritems())
+            self.__update("d%d:" % len(value))
+            self.__update("".join(digests))
+        elif t is set or t is frozenset:
+            digests = sorted(self.__get_sub_digest(item, depth + 1) for item in value)
+            self.__update("%s%d:" % (t.__name__, len(value)))
+            self.__update("".join(digests))
+        elif t is types.ModuleType:
+            # We don't look inside modules; a module that is reloaded after being
+            # edited is a new module object, and a module file that is edited
+            # without being reloaded has a different modification time
+            self.__update("M%s:%d:%r:" % (value.__name__, id(value), _get_module_mtime(value)))
+        elif t is types.BuiltinFunctionType:
+            self.__update("B%s.%s:" % (value.__module__, value.__name__))
+        elif t is types.FunctionType:
+            self.__add_function(value, depth + 1)
+        elif t.__module__ == 'numpy' and hasattr(value, 'dtype') and hasattr(value, 'flags'):
+            self.__add_array(value)
+        else:
+            raise _Unfingerprintable()
+
+def get_memo_key(text, future_features, names, scope, impure_names=()):
+    """Compute the key identifying an execution of a statement
+
+    The key combines the text of the statement with a fingerprint of the content
+    of the values that the statement reads. Scalars, strings, and standard
+    containers, numpy arrays and functions made of those can be fingerprinted.
+    Modules are identified by the module object and the modification time of
+    the module file, not by their content.
+
+    @param text: the text of the statement
+    @param future_features: a list of names from the __future__ module
+    @param names: the names that the statement reads
+    @param scope: the scope the statement is executed in
+    @param impure_names: see is_impure(); functions that use any of these names
+       can't be fingerprinted
+    @returns: the key, or None if a value can't be fingerprinted or is too big
+
+    """
+    fingerprinter = _Fingerprinter(impure_names)
+    fingerprinter.add(text)
+    fingerprinter.add(future_features and tuple(future_features))
+    try:
+        for name in sorted(names):
+            fingerprinter.add(name)
+            fingerprinter.add(scope.get(name, _MISSING))
+    except _Unfingerprintable:
+        return None
+
+    return fingerprinter.hash.hexdigest()
+
+def is_impure(text, impure_names):
+    """Check whether a statement shouldn't be memoized
+
+    @param text: the text of the statement
+    @param impure_names: names of functions and modules with side effects or
+       that give different results each time they are called
+    @returns: True if the text mentions a name in impure_names, or has a '# impure' comment
+
+    """
+    if _IMPURE_COMMENT_RE.search(text):
+        return True
+
+    for word in _WORD_RE.findall(text):
+        if word in impure_names:
+            return True
+
+    return False
+
+class MemoCache(object):
+    """Class to remember the results of executing statements in memory
+
+    When a statement is executed again with the same text and the same values
+    for the names it reads, the results and the names it bound can be reused
+    from the last time. (See get_memo_key()) The entries of the cache are kept
+    in order of use, and the least recently used entries are dropped to keep the
+    estimated size of the cache below max_size.
+
+    A MemoCache may be used from several threads at once.
+
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        """Initialize the MemoCache object
+
+        @param max_size: the maximum estimated memory use of the values in the cache, in bytes
+
+        """
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+
+        self.__lock = thread.allocate_lock()
+        # Maps key => [last use, size, (results, bindings, deleted)]
+        self.__entries = {}
+        self.__total_size = 0
+        self.__counter = 0
+
+    def __evict(self):
+        # Must be called with the lock held
+        if self.__total_size <= self.max_size:
+            return
+
+        entries = sorted((entry[0], key) for key, entry in self.__entries.iteritems())
+        for _, key in entries:
+            if self.__total_size <= self.max_size:
+                break
+            self.__total_size -= self.__entries[key][1]
+            del self.__entries[key]
+
+    def lookup(self, key):
+        """Look up the results of executing a statement
+
+        @param key: the key of the execution, see get_memo_key()
+        @returns: None if not found, otherwise a tuple of (results, bindings, deleted)
+           as passed to store()
+
+        """
+        self.__lock.acquire()
+        try:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.__counter += 1
+            entry[0] = self.__counter
+            self.hits += 1
+
+            return entry[2]
+        finally:
+            self.__lock.release()
+
+    def store(self, key, results, bindings, deleted):
+        """Remember the results of executing a statement
+
+        @param key: the key of the execution, see get_memo_key()
+        @param results: the results of the statement
+        @param bindings: dictionary of the names bound by the statement
+        @param deleted: names deleted by the statement
+
+        """
+        size = estimate_size(results) + sum(estimate_size(value) for value in bindings.itervalues())
+        if size > self.max_size:
+            return
+
+        self.__lock.acquire()
+        try:
+            old = self.__entries.get(key)
+            if old is not None:
+                self.__total_size -= old[1]
+
+            self.__counter += 1
+            self.__entries[key] = [self.__counter, size, (results, bindings, deleted)]
+            self.__total_size += size
+            self.__evict()
+        finally:
+            self.__lock.release()
+
+    def clear(self):
+        """Remove all entries from the cache"""
+
+        self.__lock.acquire()
+        self.__entries = {}
+        self.__total_size = 0
+        self.__lock.release()
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    from test_utils import assert_equals
+
+    scope = { 'a': [1, 2.5, u"x", ("y", None)], 'b': { 1: set([2, 3]) }, 'sys': sys, 'len': len }
+    key = get_memo_key(u"c = a", None, ['a', 'b', 'sys', 'len', 'missing'], scope)
+    assert key is not None
+
+    # Equal values give the same key, different values or text a different key
+    scope2 = { 'a': [1, 2.5, u"x", ("y", None)], 'b': { 1: set([3, 2]) }, 'sys': sys, 'len': len }
+    assert_equals(get_memo_key(u"c = a", None, ['a', 'b', 'sys', 'len', 'missing'], scope2), key)
+    scope2['b'] = { 1: frozenset([2, 3]) }
+    assert get_memo_key(u"c = a", None, ['a', 'b', 'sys', 'len', 'missing'], scope2) != key
+    scope2['b'] = { 1: set([2, 3]) }
+    scope2['a'] = [1, 2.5, u"x", ("y", 0)]
+    assert get_memo_key(u"c = a", None, ['a', 'b', 'sys', 'len', 'missing'], scope2) != key
+    assert get_memo_key(u"c = b", None, ['a', 'b', 'sys', 'len', 'missing'], scope) != key
+    assert get_memo_key(u"c = a", ['division'], ['a', 'b', 'sys', 'len', 'missing'], scope) != key
+
+    # Functions are fingerprinted by their code and the globals they read
+    def make_function(offset):
+        globals = { 'offset': offset }
+        exec "def f(x):\n    return x + offset" in globals
+        return globals['f']
+    assert_equals(get_memo_key(u"f(1)", None, ['f'], { 'f': make_function(1) }),
+                  get_memo_key(u"f(1)", None, ['f'], { 'f': make_function(1) }))
+    assert get_memo_key(u"f(1)", None, ['f'], { 'f': make_function(1) }) != \
+        get_memo_key(u"f(1)", None, ['f'], { 'f': make_function(2) })
+
+    # Functions that use impure names can't be fingerprinted
+    globals = {}
+    exec "def load_data():\n    return open('data.txt').read()" in globals
+    assert_equals(get_memo_key(u"x = load_data()", None, ['load_data'], globals, DEFAULT_IMPURE_NAMES), None)
+    assert get_memo_key(u"x = load_data()", None, ['load_data'], globals) is not None
+
+    # Modules are identified by the module object, not the name
+    import imp
+    module1 = imp.new_module('helper')
+    module2 = imp.new_module('helper')
+    assert get_memo_key(u"helper.f()", None, ['helper'], { 'helper': module1 }) != \
+        get_memo_key(u"helper.f()", None, ['helper'], { 'helper': module2 })
+
+    # Other objects can't be fingerprinted
+    assert_equals(get_memo_key(u"c = a", None, ['a'], { 'a': object() }), None)
+
+    # Statements with side effects
+    assert is_impure(u"data = open('data.txt').read()", DEFAULT_IMPURE_NAMES)
+    assert is_impure(u"x = numpy.random.rand(10)", DEFAULT_IMPURE_NAMES)
+    assert is_impure(u"x = load_data() # impure", DEFAULT_IMPURE_NAMES)
+    assert not is_impure(u"x = a + b", DEFAULT_IMPURE_NAMES)
+
+    # Least recently used entries are dropped when the cache gets too big
+    cache = MemoCache(max_size=estimate_size([u"result"]) * 2 + estimate_size("x" * 100) * 2)
+    cache.store('1', [u"result"], { 'a': "x" * 100 }, ())
+    cache.store('2', [u"result"], { 'a': "y" * 100 }, ())
+    assert_equals(cache.lookup('1')[1]['a'], "x" * 100)
+    cache.store('3', [u"result"], { 'a': "z" * 100 }, ())
+    assert_equals(cache.lookup('2'), None)
+    assert cache.lookup('1') is not None
+    assert cache.lookup('3') is not None
+    assert_equals((cache.hits, cache.misses), (3, 1))
+
+    # Entries bigger than the cache aren't stored
+    cache.store('4', [], { 'a': "x" * 1000 }, ())
+    assert_equals(cache.lookup('4'), None)
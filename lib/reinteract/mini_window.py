@@ -42,6 +42,9 @@ class MiniWindow(BaseNotebookWindow):
          <separator/>
          <menuitem action="calculate"/>
          <menuitem action="break"/>
+         <menuitem action="profile"/>
+         <menuitem action="profile-calculation"/>
+         <menuitem action="clear-snapshots"/>
          <separator/>
          <menuitem action="calculate-all"/>
          <separator/>
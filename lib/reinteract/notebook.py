@@ -7,13 +7,14 @@
 #
 ########################################################################
 
-import copy
 import gobject
 import imp
 import os
 import pkgutil
 import sys
 
+from compile_cache import CompileCache, CACHE_DIRECTORY
+from copy_strategy import copy_for_mutation
 from notebook_info import NotebookInfo
 
 # Used to give each notebook a unique namespace
@@ -127,8 +128,10 @@ class Notebook(gobject.GObject):
 
         if folder:
             self.info = NotebookInfo(folder)
+            self.compile_cache = CompileCache(os.path.join(folder, CACHE_DIRECTORY))
         else:
             self.info = None
+            self.compile_cache = None
 
         self.refresh()
 
@@ -200,8 +203,46 @@ class Notebook(gobject.GObject):
 
         self.__modules = {}
 
+    def reset_module(self, name):
+        """Forget a module loaded from the notebook, so that it is loaded again when next imported
+
+        @returns: the module, or None if it wasn't loaded
+
+        """
+        module = self.__modules.pop(name, None)
+        if module is None:
+            return None
+
+        del sys.modules[self.__prefix + "." + name]
+
+        for worksheet in self.worksheets:
+            worksheet.module_changed(name)
+
+        return module
+
+    def __module_name_for_filename(self, filename):
+        if not self.folder:
+            return None
+
+        folder = os.path.normcase(os.path.abspath(self.folder))
+        filename = os.path.normcase(os.path.abspath(filename))
+        if not filename.startswith(folder + os.sep):
+            return None
+
+        base, ext = os.path.splitext(filename[len(folder) + 1:])
+        if ext != ".py":
+            return None
+
+        components = base.split(os.sep)
+        if components[-1] == "__init__":
+            components.pop()
+        if len(components) == 0:
+            return None
+
+        return ".".join(components)
+
     def reset_module_by_filename(self, filename):
-        filename = filename.lower()
+        lower_filename = filename.lower()
         for (name, module) in self.__modules.iteritems():
             # If the .py changed, we need to reload the module even if it was
             # loaded from a .pyc file.
@@ -209,14 +250,17 @@ class Notebook(gobject.GObject):
             if module_file.endswith(".pyc") or module_file.endswith(".pyo"):
                 module_file = module_file[:-3] + "py"
 
-            if module_file == filename:
-                del sys.modules[self.__prefix + "." + name]
-                del self.__modules[name]
+            if module_file == lower_filename:
+                return self.reset_module(name)
 
-                for worksheet in self.worksheets:
-                    worksheet.module_changed(name)
+        # The module might have been imported only in the worker process of
+        # a worksheet (see SubprocessExecutor)
+        name = self.__module_name_for_filename(filename)
+        if name is not None:
+            for worksheet in self.worksheets:
+                worksheet.module_changed(name)
 
-                return module
+        return None
 
     def __load_local_module(self, fullname, loader):
         prefixed = self.__prefix + "." + fullname
@@ -385,7 +429,7 @@ class Notebook(gobject.GObject):
 
     def setup_globals(self, globals):
         globals['__reinteract_notebook'] = self
-        globals['__reinteract_copy'] = copy.copy
+        globals['__reinteract_copy'] = copy_for_mutation
         globals['help'] = _Helper()
 
     def file_for_absolute_path(self, absolute_path):
@@ -52,6 +52,9 @@ class NotebookWindow(BaseNotebookWindow):
          <separator/>
          <menuitem action="calculate"/>
          <menuitem action="break"/>
+         <menuitem action="profile"/>
+         <menuitem action="profile-calculation"/>
+         <menuitem action="clear-snapshots"/>
          <separator/>
          <menuitem action="calculate-all"/>
          <separator/>
@@ -0,0 +1,559 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import gobject
+import logging
+import re
+import thread
+import threading
+
+from scope import LayeredScope
+from statement import Statement
+from thread_executor import add_update_source, check_timeout, interrupt_thread, publish_output, OUTPUT_INTERVAL
+
+_debug = logging.getLogger("ParallelExecutor").debug
+
+# Builtin functions that don't have side effects and don't call back into code of
+# the user's choosing (unlike, say, map() or sorted(), which take a function). A
+# statement that calls anything else might do I/O or modify objects through names
+# we don't see, so isn't executed in parallel unless marked with a comment
+_PURE_BUILTINS = frozenset(['abs', 'all', 'any', 'bin', 'bool', 'chr', 'cmp', 'complex',
+                            'dict', 'divmod', 'enumerate', 'float', 'frozenset', 'hex',
+                            'int', 'isinstance', 'issubclass', 'len', 'list', 'long', 'oct',
+                            'ord', 'pow', 'range', 'repr', 'reversed', 'round', 'set', 'slice',
+                            'str', 'sum', 'tuple', 'unichr', 'unicode', 'xrange', 'zip'])
+
+# A statement calling other functions can be marked as safe to execute in parallel
+# with a comment, for example 'x = fetch(url) # parallel'
+_PARALLEL_COMMENT_RE = re.compile(r'#\s*parallel\b')
+
+# Statements referencing these names look at the scope dynamically or use the
+# result of the previous statement, even if marked with a comment
+_SERIAL_NAMES = frozenset(['_', 'globals', 'locals', 'vars'])
+
+# States of the statements while executing
+_PENDING = 0
+_RUNNING = 1
+_COMPLETE = 2
+_FAILED = 3
+
+def _is_serial(statement):
+    # Check if a statement has to be executed after all previous statements and
+    # before all subsequent statements
+    if (statement.dependencies is None or statement.writes is None or statement.calls is None or
+        statement.imports is not None or statement.mutates or
+        not _SERIAL_NAMES.isdisjoint(statement.reads)):
+        return True
+
+    if _PARALLEL_COMMENT_RE.search(statement.get_text()):
+        return False
+
+    # A builtin name rebound in the worksheet is no longer the builtin
+    return not (statement.calls.issubset(_PURE_BUILTINS) and
+                statement.calls.isdisjoint(statement.dependencies) and
+                statement.calls.isdisjoint(statement.writes))
+
+class ParallelExecutor(gobject.GObject):
+    """Class to execute Python statements asynchronously, several at a time
+
+    The statements form a graph where each statement depends on the previous
+    statements that bind names it uses or binds. Statements that don't depend on
+    each other are executed concurrently in a pool of threads; since Python code
+    holds the global interpreter lock, this mostly helps when statements wait for
+    I/O or call native code that releases the lock. Statements that might have
+    effects that aren't visible in the names they use are executed only after all
+    previous statements and before all subsequent statements, as with
+    L{ThreadExecutor}. That includes any statement that calls a function other
+    than a few builtins, unless it is marked with a '# parallel' comment (see
+    _is_serial()). Statements that are executed without statement.dependencies
+    having been computed are all executed that way.
+
+    A statement that runs before the statements preceding it are complete is
+    executed on top of a scope built from the ones that are complete; once all
+    the preceding statements are complete, its result scope is layered on top of
+    the scope of its parent statement, so the final result scopes are the same
+    as if the statements were executed one at a time.
+
+    If a statement fails or execution is interrupted, no more statements are
+    started. Statements after the failed one that already completed are marked
+    for execution again, so the results of the worksheet are the same as if
+    execution had stopped at the failed statement.
+
+    Signals
+    =======
+     -  B{statement-executing}(executor, statement) emitted when the executor starts processing a statement. There is no guarantee that this signal will be emitted for each processed statement.
+     -  B{statement-output}(executor, statement) emitted every OUTPUT_INTERVAL milliseconds for each executing statement that has produced more results since the last time. statement.results holds the results produced so far.
+     -  B{statement-complete}(executor, statement) emitted when the executor is done with processing a statement. Statements may complete in a different order than they were added. A statement may be completed a second time if it is marked for execution again because a previous statement failed.
+     -  B{statements-complete}(executor, statements) emitted after ::statement-complete has been emitted for a batch of statements, with the list of those statements. Handling this signal rather than ::statement-complete allows updating for many statements at once.
+     -  B{complete}(executor): emitted when the executor is done with all processing
+
+    """
+
+    __gsignals__ = {
+        'statement-executing' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
+        'statement-output' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
+        'statement-complete' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
+        'statements-complete' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
+        'complete' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
+    }
+
+    def __init__(self, parent_statement=None, max_workers=2):
+        """Initialize the ParallelExecutor object
+
+        @param parent_statement: previous statement defining the execution environment for the first statement
+        @param max_workers: maximum number of statements to execute at once
+
+        """
+        gobject.GObject.__init__(self)
+
+        self.parent_statement = parent_statement
+        self.max_workers = max(1, max_workers)
+        self.statements = []
+        self.lock = thread.allocate_lock()
+
+        #: maximum number of times a second to signal progress, or None for no limit
+        self.max_update_rate = None
+        self.last_update_time = 0
+
+        self.idle_id = 0
+        self.output_id = 0
+        self.output_counts = {}
+        self.complete = False
+        self.interrupted = False
+        self.escalated = False
+
+        self.__condition = threading.Condition(self.lock)
+        self.__signals = []
+        self.__states = None
+        # For each statement, the indices of the previous statements that must complete first
+        self.__waits_for = None
+        # Index of the last statement such that it and all previous statements are complete
+        self.__finalized = -1
+        self.__failed = None
+        self.__running = 0
+        self.__workers = 0
+        # Maps index of an executing statement => thread executing it
+        self.__executing = {}
+
+    def __run_idle(self):
+        self.lock.acquire()
+        signals = self.__signals
+        self.__signals = []
+        complete = self.complete
+        self.idle_id = 0
+        self.lock.release()
+
+        completed = []
+        for signal, statement in signals:
+            self.emit(signal, statement)
+            if signal == 'statement-complete':
+                completed.append(statement)
+        if len(completed) > 0:
+            self.emit('statements-complete', completed)
+
+        if complete:
+            if self.output_id:
+                gobject.source_remove(self.output_id)
+                self.output_id = 0
+            self.emit('complete')
+
+        return False
+
+    def __run_output_timeout(self):
+        self.lock.acquire()
+        executing = [self.statements[i] for i in sorted(self.__executing)]
+        self.lock.release()
+
+        for statement in executing:
+            publish_output(self, statement)
+            check_timeout(self, statement)
+
+        return True
+
+    def __queue_signal(self, signal, statement):
+        # Must be called with the lock held
+        self.__signals.append((signal, statement))
+        if not self.idle_id:
+            self.idle_id = add_update_source(self, self.__run_idle)
+
+    def __compute_waits_for(self):
+        self.__waits_for = []
+        last_serial = None
+        last_writer = {}
+        for i, statement in enumerate(self.statements):
+            if _is_serial(statement):
+                # Waiting for everything since the last serial statement is enough,
+                # since that statement waited for everything before it
+                if last_serial is None:
+                    waits_for = range(0, i)
+                else:
+                    waits_for = range(last_serial, i)
+                last_serial = i
+                last_writer = {}
+            else:
+                waits_for = set()
+                if last_serial is not None:
+                    waits_for.add(last_serial)
+                # Waiting for the last writer of each name is enough, since it
+                # waited for the previous writers of the name
+                for name in statement.dependencies.union(statement.writes):
+                    if name in last_writer:
+                        waits_for.add(last_writer[name])
+                for name in statement.writes:
+                    last_writer[name] = i
+                waits_for = sorted(waits_for)
+
+            self.__waits_for.append(waits_for)
+
+    def __find_ready(self):
+        # Must be called with the lock held. Returns the index of the first statement
+        # that can be started, or None
+        if self.interrupted or self.__failed is not None:
+            return None
+
+        for i in xrange(self.__finalized + 1, len(self.statements)):
+            if self.__states[i] != _PENDING:
+                continue
+            for j in self.__waits_for[i]:
+                if self.__states[j] != _COMPLETE:
+                    break
+            else:
+                return i
+
+        return None
+
+    def __get_parent_scope(self, i):
+        # Must be called with the lock held. The scope of the last finalized
+        # statement, with the bindings of the statements after it that are
+        # complete on top. Since all the statements that statement i depends
+        # on are complete, this has the right values for its dependencies
+        if self.__finalized >= 0:
+            scope = self.statements[self.__finalized].result_scope
+        else:
+            scope = self.statements[0].get_parent_scope()
+            if scope is None:
+                return None
+
+        for j in xrange(self.__finalized + 1, i):
+            if self.__states[j] == _COMPLETE:
+                result_scope = self.statements[j].result_scope
+                scope = LayeredScope(scope, result_scope.bindings, result_scope.deleted)
+
+        return scope
+
+    def __finalize(self):
+        # Must be called with the lock held
+        while self.__finalized + 1 < len(self.statements) and self.__states[self.__finalized + 1] == _COMPLETE:
+            self.__finalized += 1
+            self.statements[self.__finalized].rebase_result_scope()
+
+    def __run_statement(self, i):
+        # Must be called with the lock held; returns with the lock held. See
+        # ThreadExecutor.__run_thread() for the locking pattern
+        statement = self.statements[i]
+        self.__states[i] = _RUNNING
+        self.__running += 1
+
+        parent_scope = self.__get_parent_scope(i)
+        if statement.can_reuse(parent_scope):
+            statement.reuse(parent_scope)
+        else:
+            statement.before_execute()
+            self.__executing[i] = thread.get_ident()
+            self.__queue_signal('statement-executing', statement)
+            try:
+                self.lock.release()
+                statement.execute(parent_scope)
+                self.lock.acquire()
+            except:
+                self.lock.acquire()
+            finally:
+                del self.__executing[i]
+                statement.after_execute()
+
+        self.__running -= 1
+        if statement.state == Statement.EXECUTE_SUCCESS:
+            self.__states[i] = _COMPLETE
+            self.__finalize()
+        else:
+            self.__states[i] = _FAILED
+            if self.__failed is None or i < self.__failed:
+                self.__failed = i
+
+        self.__queue_signal('statement-complete', statement)
+        self.__condition.notifyAll()
+
+    def __finish(self):
+        # Must be called with the lock held, once all workers are done
+        if self.__failed is not None or self.interrupted:
+            if self.__failed is None:
+                first_incomplete = self.__finalized + 1
+            else:
+                first_incomplete = self.__failed
+
+            for i in xrange(first_incomplete + 1, len(self.statements)):
+                if self.__states[i] == _COMPLETE:
+                    _debug("Reverting statement %d after failure of statement %d", i, first_incomplete)
+                    self.statements[i].mark_for_execute()
+                    self.__queue_signal('statement-complete', self.statements[i])
+
+        for i in xrange(0, len(self.statements)):
+            if self.__states[i] == _PENDING:
+                self.__queue_signal('statement-complete', self.statements[i])
+
+        self.complete = True
+        if not self.idle_id:
+            self.idle_id = add_update_source(self, self.__run_idle)
+
+    def __run_worker(self):
+        # If the result scope of the parent statement was evicted, rebuilding it
+        # executes code, so do that up front rather than with the lock held
+        parent_scope = self.statements[0].get_parent_scope()
+
+        self.lock.acquire()
+        try:
+            if parent_scope is None:
+                # Rebuilding failed, so there's nothing to execute the statements on
+                # top of; fall back to one at a time, so the first statement fails
+                self.__waits_for = [range(0, i) for i in xrange(0, len(self.statements))]
+
+            while True:
+                i = self.__find_ready()
+                if i is not None:
+                    self.__run_statement(i)
+                elif self.__running > 0:
+                    self.__condition.wait()
+                else:
+                    break
+        finally:
+            self.__workers -= 1
+            self.__condition.notifyAll()
+            if self.__workers == 0:
+                self.__finish()
+            self.lock.release()
+
+    def add_statement(self, statement):
+        """Add a statement to the list of statements that the executor will execute."""
+
+        self.statements.append(statement)
+
+    def compile(self):
+        """Compile all statements.
+
+        If compilation failed, then all processing for the executor is complete, so
+        ::statement-complete is emitted for each statement, then ::complete is emitted.
+        Otherwise no signals are emitted, until the executor is run using execute()
+
+        @returns: True if all statements compiled successfully
+
+        """
+
+        success = True
+        parent = self.parent_statement
+        for statement in self.statements:
+            statement.set_parent(parent)
+            if not statement.compile():
+                success = False
+            parent = statement
+
+        if not success:
+            for statement in self.statements:
+                self.emit('statement-complete', statement)
+            self.emit('statements-complete', list(self.statements))
+            self.emit('complete')
+
+        return success
+
+    def execute(self):
+        """Execute the statements of the executor asynchronously in a pool of threads."""
+
+        self.__states = [_PENDING] * len(self.statements)
+        self.__compute_waits_for()
+
+        # Any more threads than the widest set of statements that can run at
+        # once would be idle, but that's cheap enough not to bother computing
+        self.__workers = min(self.max_workers, len(self.statements))
+        self.output_id = gobject.timeout_add(OUTPUT_INTERVAL, self.__run_output_timeout)
+        for i in xrange(0, self.__workers):
+            thread.start_new_thread(self.__run_worker, ())
+
+    def interrupt(self):
+        """Interrupts the execution of the executor if possible.
+
+        Statements that are executing are interrupted as for L{ThreadExecutor.interrupt},
+        and no more statements are started. Once the executing statements are
+        interrupted, execution finishes as per normal by emitting the ::statement-complete
+        and ::complete signals, except that the state of the interrupted statements will
+        be Statement.INTERRUPTED, and statements that weren't complete before them
+        will have a state of Statement.COMPILE_SUCCESS.
+
+        Calling interrupt() more than once will have no effect.
+
+        """
+
+        # As for ThreadExecutor, we only send KeyboardInterrupt to a thread while it
+        # is executing a statement and at most once
+        self.lock.acquire()
+        if not self.complete and not self.interrupted:
+            self.interrupted = True
+            for tid in self.__executing.itervalues():
+                interrupt_thread(tid)
+            self.__condition.notifyAll()
+        self.lock.release()
+
+    def escalate_interrupt(self):
+        """Try harder to stop execution after interrupt() didn't stop it.
+
+        As for L{ThreadExecutor.escalate_interrupt}, there is nothing more that
+        can be done to stop threads, so this only logs.
+
+        """
+        _debug("Statements still executing after being interrupted; can't stop a thread")
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    gobject.threads_init()
+
+    import stdout_capture
+    stdout_capture.init()
+
+    import time
+
+    from notebook import Notebook
+    from test_utils import assert_equals
+    from worksheet import Worksheet
+
+    notebook = Notebook()
+    worksheet = Worksheet(notebook)
+
+    def test_execute(statements, interrupt_after=None):
+        executor = ParallelExecutor(max_workers=4)
+
+        for s, expected_state, expected_results in statements:
+            statement = Statement(s, worksheet)
+            statement._expected_state = expected_state
+            statement._expected_results = expected_results
+            executor.add_statement(statement)
+
+        order = []
+        loop = gobject.MainLoop()
+
+        def on_statement_complete(executor, statement):
+            order.append(executor.statements.index(statement))
+
+        def on_complete(executor):
+            loop.quit()
+
+        def interrupt():
+            executor.interrupt()
+
+        global timed_out
+        timed_out = False
+        def timeout():
+            global timed_out
+            timed_out = True
+            loop.quit()
+
+        executor.connect('statement-complete', on_statement_complete)
+        executor.connect('complete', on_complete)
+
+        if executor.compile():
+            # Normally done by the worksheet
+            bound = set()
+            for statement in executor.statements:
+                statement.dependencies = set(statement.reads).intersection(bound)
+                bound.update(statement.writes or ())
+
+            executor.execute()
+            if interrupt_after is not None:
+                interrupt_source = gobject.timeout_add(interrupt_after, interrupt)
+            timeout_source = gobject.timeout_add(5000, timeout)
+            loop.run()
+            if timed_out:
+                raise AssertionError("ParallelExecutor didn't complete")
+            gobject.source_remove(timeout_source)
+            if interrupt_after is not None:
+                gobject.source_remove(interrupt_source)
+
+        for s in executor.statements:
+            assert_equals(s.state, s._expected_state)
+            assert_equals(s.results, s._expected_results)
+
+        return executor, order
+
+    test_execute(
+        [
+            ("a = 1", Statement.COMPILE_SUCCESS, None),
+            ("a =", Statement.COMPILE_ERROR, None)
+        ])
+
+    # Independent statements run at the same time, and complete in the order they finish
+    start = time.time()
+    executor, order = test_execute(
+        [
+            ("import time", Statement.EXECUTE_SUCCESS, []),
+            ("def slow(t, x):\n    time.sleep(t)\n    return x", Statement.EXECUTE_SUCCESS, []),
+            ("a = slow(0.4, 1) # parallel", Statement.EXECUTE_SUCCESS, []),
+            ("b = slow(0.2, 2) # parallel", Statement.EXECUTE_SUCCESS, []),
+            ("c = b + 1", Statement.EXECUTE_SUCCESS, []),
+            ("a + c", Statement.EXECUTE_SUCCESS, ['4']),
+        ])
+    assert time.time() - start < 0.55
+    assert_equals(order, [0, 1, 3, 4, 2, 5])
+
+    # The final result scopes are layered as for serial execution
+    s = executor.statements
+    assert s[4].result_scope.parent is s[3].result_scope
+    assert_equals(s[5].result_scope.flatten()['c'], 3)
+    assert 'b' not in s[2].result_scope
+
+    # Statements that might have side effects aren't reordered
+    executor, order = test_execute(
+        [
+            ("l = []", Statement.EXECUTE_SUCCESS, []),
+            ("import time; time.sleep(0.1)", Statement.EXECUTE_SUCCESS, []),
+            ("l.append(1)", Statement.EXECUTE_SUCCESS, []),
+            ("x = 1", Statement.EXECUTE_SUCCESS, []),
+            ("len(l)", Statement.EXECUTE_SUCCESS, ['1']),
+        ])
+    assert_equals(order[0:3], [0, 1, 2])
+
+    # So are statements calling functions, unless marked as safe
+    executor, order = test_execute(
+        [
+            ("import time", Statement.EXECUTE_SUCCESS, []),
+            ("l = []", Statement.EXECUTE_SUCCESS, []),
+            ("def add(x):\n    time.sleep(0.1)\n    l.append(x)", Statement.EXECUTE_SUCCESS, []),
+            ("add(1)", Statement.EXECUTE_SUCCESS, []),
+            ("x = len(l) + 1", Statement.EXECUTE_SUCCESS, []),
+            ("len(l)", Statement.EXECUTE_SUCCESS, ['1']),
+        ])
+    assert_equals(order[0:4], [0, 1, 2, 3])
+
+    # When a statement fails, statements after it that completed are reverted
+    executor, order = test_execute(
+        [
+            ("import time", Statement.EXECUTE_SUCCESS, []),
+            ("def slow(t, x):\n    time.sleep(t)\n    return x", Statement.EXECUTE_SUCCESS, []),
+            ("a = slow(0.2, 1) + b # parallel", Statement.EXECUTE_ERROR, None),
+            ("c = 1", Statement.COMPILE_SUCCESS, []),
+            ("d = 2", Statement.COMPILE_SUCCESS, []),
+        ])
+    assert_equals(order[0:2], [0, 1])
+    assert_equals(sorted(order[2:5]), [2, 3, 4])
+    assert_equals(sorted(order[5:]), [3, 4])
+
+    # Interrupting interrupts all executing statements
+    test_execute(
+        [
+            ("x = 0", Statement.EXECUTE_SUCCESS, []),
+            ("for i in xrange(0,100000000): x = x + 1", Statement.INTERRUPTED, None),
+             ("for j in xrange(0,100000000): y = j", Statement.INTERRUPTED, None),
+            ("x", Statement.COMPILE_SUCCESS, None),
+        ], interrupt_after=200)
@@ -45,6 +45,31 @@ class PreferencesBuilder(WindowBuilder):
 
         self.autocomplete_check_button.connect('toggled', self.__on_autocomplete_check_button_toggled)
 
+        global_settings.connect('notify::execute-in-subprocess', self.__on_notify_execute_in_subprocess)
+        self.__on_notify_execute_in_subprocess()
+
+        self.execute_in_subprocess_check_button.connect('toggled', self.__on_execute_in_subprocess_check_button_toggled)
+
+        global_settings.connect('notify::show-execution-times', self.__on_notify_show_execution_times)
+        self.__on_notify_show_execution_times()
+
+        self.show_execution_times_check_button.connect('toggled', self.__on_show_execution_times_check_button_toggled)
+
+        global_settings.connect('notify::profile-by-sampling', self.__on_notify_profile_by_sampling)
+        self.__on_notify_profile_by_sampling()
+
+        self.profile_by_sampling_check_button.connect('toggled', self.__on_profile_by_sampling_check_button_toggled)
+
+        global_settings.connect('notify::calculate-all-jobs', self.__on_notify_calculate_all_jobs)
+        self.__on_notify_calculate_all_jobs()
+
+        self.calculate_all_jobs_spin_button.connect('value-changed', self.__on_calculate_all_jobs_spin_button_value_changed)
+
+        global_settings.connect('notify::statement-timeout', self.__on_notify_statement_timeout)
+        self.__on_notify_statement_timeout()
+
+        self.statement_timeout_spin_button.connect('value-changed', self.__on_statement_timeout_spin_button_value_changed)
+
     def __on_notify_editor_font_is_custom(self, *args):
         self.editor_font_custom_check_button.set_active(global_settings.editor_font_is_custom)
 
@@ -87,6 +112,46 @@ class PreferencesBuilder(WindowBuilder):
         if autocomplete != global_settings.autocomplete:
             global_settings.autocomplete = autocomplete
 
+    def __on_notify_execute_in_subprocess(self, *args):
+        self.execute_in_subprocess_check_button.set_active(global_settings.execute_in_subprocess)
+
+    def __on_execute_in_subprocess_check_button_toggled(self, *args):
+        execute_in_subprocess = self.execute_in_subprocess_check_button.get_active()
+        if execute_in_subprocess != global_settings.execute_in_subprocess:
+            global_settings.execute_in_subprocess = execute_in_subprocess
+
+    def __on_notify_show_execution_times(self, *args):
+        self.show_execution_times_check_button.set_active(global_settings.show_execution_times)
+
+    def __on_show_execution_times_check_button_toggled(self, *args):
+        show_execution_times = self.show_execution_times_check_button.get_active()
+        if show_execution_times != global_settings.show_execution_times:
+            global_settings.show_execution_times = show_execution_times
+
+    def __on_notify_profile_by_sampling(self, *args):
+        self.profile_by_sampling_check_button.set_active(global_settings.profile_by_sampling)
+
+    def __on_profile_by_sampling_check_button_toggled(self, *args):
+        profile_by_sampling = self.profile_by_sampling_check_button.get_active()
+        if profile_by_sampling != global_settings.profile_by_sampling:
+            global_settings.profile_by_sampling = profile_by_sampling
+
+    def __on_notify_calculate_all_jobs(self, *args):
+        self.calculate_all_jobs_spin_button.set_value(global_settings.calculate_all_jobs)
+
+    def __on_calculate_all_jobs_spin_button_value_changed(self, *args):
+        calculate_all_jobs = self.calculate_all_jobs_spin_button.get_value_as_int()
+        if calculate_all_jobs != global_settings.calculate_all_jobs:
+            global_settings.calculate_all_jobs = calculate_all_jobs
+
+    def __on_notify_statement_timeout(self, *args):
+        self.statement_timeout_spin_button.set_value(global_settings.statement_timeout)
+
+    def __on_statement_timeout_spin_button_value_changed(self, *args):
+        statement_timeout = self.statement_timeout_spin_button.get_value_as_int()
+        if statement_timeout != global_settings.statement_timeout:
+            global_settings.statement_timeout = statement_timeout
+
     def __on_response(self, dialog, response_id):
         self.dialog.hide()
 
@@ -0,0 +1,308 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import cProfile
+import marshal
+import os
+import sys
+import thread
+import time
+
+from custom_result import CustomResult, show_menu
+
+# How often SamplingProfiler looks at the stack of the profiled thread
+DEFAULT_SAMPLE_INTERVAL = 0.005 # seconds
+
+# Number of functions shown in a ProfileResult
+MAX_ROWS = 20
+
+class Profiler(object):
+    """Base class for profilers of statement execution. See L{Statement.profiler}
+
+    A profiler can be started and stopped several times, to accumulate statistics
+    for the execution of several statements.
+
+    """
+
+    def __init__(self):
+        #: statement to add the profile to the results of when it finishes executing.
+        #: If None, the profile is added to the results of each profiled statement
+        self.result_statement = None
+
+    def start(self):
+        """Start profiling the calling thread"""
+        raise NotImplementedError()
+
+    def stop(self):
+        """Stop profiling"""
+        raise NotImplementedError()
+
+    def get_stats(self):
+        """Get the collected statistics
+
+        @returns: a dictionary in the format of pstats.Stats.stats, mapping
+           (filename, line, function name) to (primitive calls, total calls,
+           internal time, cumulative time, callers)
+
+        """
+        raise NotImplementedError()
+
+    def create_result(self):
+        """Create a L{ProfileResult} showing the statistics collected so far"""
+
+        return ProfileResult(self.get_stats())
+
+class DeterministicProfiler(Profiler):
+    """Profiler that records every function call using cProfile
+
+    The statistics are exact, but the overhead of profiling each call can
+    be high and distorts the timings of code that makes many small calls.
+
+    """
+
+    def __init__(self):
+        Profiler.__init__(self)
+
+        self.__profile = cProfile.Profile()
+
+    def start(self):
+        self.__profile.enable()
+
+    def stop(self):
+        self.__profile.disable()
+
+    def get_stats(self):
+        self.__profile.create_stats()
+        return self.__profile.stats
+
+class SamplingProfiler(Profiler):
+    """Profiler that periodically looks at the stack of the profiled thread
+
+    The overhead is low and doesn't depend on the code being profiled, so it is
+    more suitable for long runs, but the statistics are approximate. The number
+    of calls of a function isn't known; the statistics give the number of
+    samples where the function was executing instead.
+
+    """
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        """Initialize the SamplingProfiler object
+
+        @param interval: the time between samples, in seconds
+
+        """
+        Profiler.__init__(self)
+
+        self.interval = interval
+
+        self.__lock = thread.allocate_lock()
+        # Maps (filename, line, function name) => [samples where it is the
+        # executing function, samples where it is on the stack]
+        self.__samples = {}
+        # Incremented each time we start or stop, so a sampling thread can tell
+        # when it should exit
+        self.__generation = 0
+
+    def start(self):
+        # We only record the part of the stack above our caller
+        base_frame = sys._getframe(1)
+
+        self.__lock.acquire()
+        self.__generation += 1
+        generation = self.__generation
+        self.__lock.release()
+
+        thread.start_new_thread(self.__run, (thread.get_ident(), base_frame, generation))
+
+    def stop(self):
+        self.__lock.acquire()
+        self.__generation += 1
+        self.__lock.release()
+
+    def __add_sample(self, frame, base_frame):
+        seen = set()
+        top = True
+        while frame is not None and frame is not base_frame:
+            code = frame.f_code
+            key = (code.co_filename, code.co_firstlineno, code.co_name)
+            counts = self.__samples.setdefault(key, [0, 0])
+            if top:
+                counts[0] += 1
+                top = False
+            # Recursive functions are counted once per sample
+            if not key in seen:
+                counts[1] += 1
+                seen.add(key)
+            frame = frame.f_back
+
+    def __run(self, tid, base_frame, generation):
+        while True:
+            time.sleep(self.interval)
+
+            self.__lock.acquire()
+            try:
+                if self.__generation != generation:
+                    return
+
+                frame = sys._current_frames().get(tid)
+                if frame is not None:
+                    self.__add_sample(frame, base_frame)
+                del frame
+            finally:
+                self.__lock.release()
+
+    def get_stats(self):
+        stats = {}
+        self.__lock.acquire()
+        for key, (own, total) in self.__samples.iteritems():
+            stats[key] = (own, own, own * self.interval, total * self.interval, {})
+        self.__lock.release()
+
+        return stats
+
+    def create_result(self):
+        return ProfileResult(self.get_stats(), sampled=True)
+
+def _format_function(key):
+    filename, line, name = key
+    if filename == '~' and line == 0:
+        # A builtin function
+        return name
+    else:
+        return "%s:%d(%s)" % (os.path.basename(filename), line, name)
+
+class ProfileResult(CustomResult):
+    """Result showing the functions that took the most time in a profile
+
+    The result is shown as a table of the MAX_ROWS functions with the highest
+    cumulative time. The full statistics can be saved from the right-click menu
+    in the format read by the standard pstats module.
+
+    """
+
+    def __init__(self, stats, sampled=False):
+        """Initialize the ProfileResult object
+
+        @param stats: statistics in the format returned by L{Profiler.get_stats}
+        @param sampled: if True, the statistics were collected by a L{SamplingProfiler}
+
+        """
+        self.stats = stats
+        self.sampled = sampled
+
+    def get_rows(self, count=MAX_ROWS):
+        """Get the functions with the highest cumulative times
+
+        @param count: the maximum number of functions to return
+        @returns: a list of (function description, calls, internal time, cumulative time)
+
+        """
+        rows = [(_format_function(key), nc, tt, ct) for key, (cc, nc, tt, ct, callers) in self.stats.iteritems()]
+        rows.sort(key=lambda row: row[3], reverse=True)
+
+        return rows[0:count]
+
+    def save(self, filename):
+        """Save the statistics to a file that can be loaded with pstats.Stats(filename)"""
+
+        f = open(filename, "wb")
+        try:
+            marshal.dump(self.stats, f)
+        finally:
+            f.close()
+
+    def __on_button_press_event(self, widget, event):
+        if event.button == 3:
+            show_menu(widget, event, save_callback=self.save)
+            return True
+
+        return False
+
+    def create_widget(self):
+        import gtk
+
+        store = gtk.ListStore(str, int, float, float)
+        for row in self.get_rows():
+            store.append(row)
+
+        view = gtk.TreeView(store)
+        if self.sampled:
+            calls_title = "Samples"
+        else:
+            calls_title = "Calls"
+
+        def format_time(column, cell, model, iter, index):
+            cell.props.text = "%.3f" % model.get_value(iter, index)
+
+        for index, title in enumerate(("Function", calls_title, "Time", "Cumulative")):
+            cell = gtk.CellRendererText()
+            column = gtk.TreeViewColumn(title, cell, text=index)
+            if index >= 2:
+                column.set_cell_data_func(cell, format_time, index)
+            column.set_sort_column_id(index)
+            view.append_column(column)
+
+        view.connect('button-press-event', self.__on_button_press_event)
+        view.show_all()
+
+        return view
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    import pstats
+    import shutil
+    import tempfile
+
+    from test_utils import assert_equals
+
+    def fib(n):
+        if n < 2:
+            return n
+        return fib(n - 1) + fib(n - 2)
+
+    def spin(seconds):
+        end = time.time() + seconds
+        while time.time() < end:
+            fib(10)
+
+    # Deterministic profiling, accumulated over two runs
+    profiler = DeterministicProfiler()
+    for i in xrange(0, 2):
+        profiler.start()
+        fib(10)
+        profiler.stop()
+
+    result = profiler.create_result()
+    rows = result.get_rows()
+    assert_equals([row for row in rows if row[0].endswith("(fib)")][0][1], 2 * 177)
+
+    # Saved statistics can be loaded by pstats
+    base = tempfile.mkdtemp("", "profiler")
+    try:
+        filename = os.path.join(base, "profile")
+        result.save(filename)
+        assert_equals(pstats.Stats(filename).total_calls, sum(row[1] for row in result.get_rows(count=None)))
+    finally:
+        shutil.rmtree(base)
+
+    # Sampling profiling records the time spent in each function
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.start()
+    spin(0.2)
+    profiler.stop()
+
+    rows = profiler.create_result().get_rows()
+    functions = [row[0] for row in rows]
+    # fib() may tie with spin(), if every sample happened to be inside it
+    spin_row = [row for row in rows if row[0].endswith("(spin)")][0]
+    assert_equals(spin_row[3], rows[0][3])
+    assert spin_row[3] > 0.05
+    assert "fib" in " ".join(functions)
+    # The frames below the caller of start() aren't included
+    assert not "<module>" in " ".join(functions)
@@ -0,0 +1,199 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import gobject
+import thread
+
+from custom_result import CustomResult
+import data_format
+import reunicode
+
+# The full text is passed to the main thread in pieces of about this many characters
+_BATCH_LENGTH = 65536
+
+# Size of the scrolled area showing the full text
+_FULL_TEXT_WIDTH = 600
+_FULL_TEXT_HEIGHT = 300
+
+class _FullTextGenerator(object):
+    # Generates repr() of a value in a thread, passing the text to the main
+    # loop in batches as it is generated
+
+    def __init__(self, value, callback):
+        self.__callback = callback
+        self.__lock = thread.allocate_lock()
+        self.__pending = []
+        self.__done = False
+        self.__stopped = False
+        self.__idle_id = 0
+
+        thread.start_new_thread(self.__run, (value,))
+
+    def __run(self, value):
+        batch = []
+        length = 0
+        try:
+            for s in data_format.iter_repr(value):
+                if self.__stopped:
+                    return
+                batch.append(s)
+                length += len(s)
+                if length >= _BATCH_LENGTH:
+                    self.__queue("".join(batch), False)
+                    batch = []
+                    length = 0
+        except Exception, e:
+            batch.append("\n<Error: %s>" % e)
+
+        self.__queue("".join(batch), True)
+
+    def __queue(self, text, done):
+        self.__lock.acquire()
+        self.__pending.append(text)
+        self.__done = done
+        if self.__idle_id == 0:
+            self.__idle_id = gobject.idle_add(self.__run_idle)
+        self.__lock.release()
+
+    def __run_idle(self):
+        self.__lock.acquire()
+        pending = self.__pending
+        self.__pending = []
+        done = self.__done
+        self.__idle_id = 0
+        self.__lock.release()
+
+        if not self.__stopped:
+            self.__callback("".join(pending), done)
+
+        return False
+
+    def stop(self):
+        self.__stopped = True
+
+class ReprResult(CustomResult):
+    """Result showing a summary of a value that is too large to show in full
+
+    The summary is computed when the statement is executed, see
+    L{data_format.format_result}. The full text of repr() of the value is
+    only generated when the user asks for it, in a separate thread, and shown
+    as it is generated.
+
+    """
+
+    def __init__(self, summary, value):
+        """Initialize the ReprResult object
+
+        @param summary: the summary to show, as a unicode string
+        @param value: the value being shown
+
+        """
+        self.summary = summary
+        self.value = value
+
+    def __getstate__(self):
+        # The value may not be picklable, and is probably large; a result sent
+        # from a worker process (see subprocess_executor.py) only has the summary
+        return { 'summary': self.summary, 'value': None }
+
+    def can_show_full_text(self):
+        """Return True if the full text can be generated"""
+
+        return self.value is not None
+
+    def generate_full_text(self, callback):
+        """Generate the full text of repr() of the value, in a separate thread
+
+        @param callback: function called from the main loop as callback(text, done)
+           with each piece of the text as it is generated; done is True for the last piece
+        @returns: a function to call to stop generating the text
+
+        """
+        generator = _FullTextGenerator(self.value, callback)
+        return generator.stop
+
+    def create_widget(self):
+        import gtk
+
+        box = gtk.VBox()
+
+        label = gtk.Label(self.summary)
+        label.set_alignment(0., 0.)
+        label.set_selectable(True)
+        box.pack_start(label, expand=False, fill=False)
+
+        if self.can_show_full_text():
+            # Replaces the label when the full text is shown
+            view = gtk.TextView()
+            view.set_editable(False)
+            view.set_wrap_mode(gtk.WRAP_CHAR)
+            buf = view.get_buffer()
+
+            scrolled = gtk.ScrolledWindow()
+            scrolled.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+            scrolled.set_shadow_type(gtk.SHADOW_IN)
+            scrolled.set_size_request(_FULL_TEXT_WIDTH, _FULL_TEXT_HEIGHT)
+            scrolled.add(view)
+            scrolled.set_no_show_all(True)
+            box.pack_start(scrolled, expand=False, fill=False)
+
+            button_box = gtk.HBox()
+            button = gtk.Button("Show All")
+            button_box.pack_start(button, expand=False, fill=False)
+            box.pack_start(button_box, expand=False, fill=False)
+
+            def on_text(text, done):
+                if isinstance(text, str):
+                    text = reunicode.decode(text, escape=True)
+                buf.insert(buf.get_end_iter(), text)
+                if done:
+                    button_box.hide()
+
+            def on_clicked(button):
+                button.set_sensitive(False)
+                label.hide()
+                view.show()
+                scrolled.show()
+
+                stop = self.generate_full_text(on_text)
+                box.connect('destroy', lambda widget: stop())
+
+            button.connect('clicked', on_clicked)
+
+        box.show_all()
+
+        return box
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    import cPickle
+
+    from test_utils import assert_equals
+
+    gobject.threads_init()
+
+    value = dict((i, range(i)) for i in xrange(0, 200))
+
+    # The full text is the same as repr()
+    result = ReprResult(data_format.format(value), value)
+    pieces = []
+    loop = gobject.MainLoop()
+    def on_text(text, done):
+        pieces.append(text)
+        if done:
+            loop.quit()
+    _BATCH_LENGTH = 1000
+    result.generate_full_text(on_text)
+    loop.run()
+    assert_equals("".join(pieces), repr(value))
+
+    # Only the summary is pickled
+    copy = cPickle.loads(cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL))
+    assert_equals(copy.summary, result.summary)
+    assert not copy.can_show_full_text()
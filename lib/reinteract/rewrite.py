@@ -596,6 +596,175 @@ def _get_imports(t):
     else:
         return None
 
+######################################################################
+# Finding the names that a statement reads and binds
+
+# Some symbols only exist in some versions of the Python grammar
+_with_item = getattr(symbol, 'with_item', None)  # Python >= 2.7
+_with_var = getattr(symbol, 'with_var', None)    # Python < 2.7
+_comp_for_symbols = set(filter(lambda x: x is not None,
+                               (getattr(symbol, name, None) for name in ('list_for', 'comp_for', 'gen_for'))))
+_sequence_symbols = set(filter(lambda x: x is not None,
+                               (getattr(symbol, name, None) for name in ('exprlist', 'testlist', 'testlist_comp',
+                                                                         'testlist_gexp', 'listmaker'))))
+
+class _NameScanState(object):
+    def __init__(self):
+        self.reads = set()
+        self.writes = set()
+        self.unknown_writes = False
+
+def _strip_node(t):
+    # Strip off chains of nodes with a single child, so that, for example,
+    # a 'test' that is just a name is reduced to the NAME token
+    while t[0] >= token.NT_OFFSET and len(t) == 2:
+        t = t[1]
+    return t
+
+def _scan_target(t, state):
+    # Scan an assignment target. A bare name is bound, a tuple or list is
+    # unpacked into its elements, and anything else (a[0], a.b) mutates the
+    # object at the root of the path
+    t = _strip_node(t)
+    if t[0] == token.NAME:
+        state.writes.add(t[1])
+    elif t[0] == symbol.atom and t[1][0] in (token.LPAR, token.LSQB):
+        if len(t) > 3:
+            _scan_target(t[2], state)
+    elif t[0] in _sequence_symbols:
+        for i in xrange(1, len(t)):
+            if t[i][0] != token.COMMA:
+                _scan_target(t[i], state)
+    else:
+        if t[0] == symbol.power:
+            root = _strip_node(t[1])
+            if root[0] == token.NAME:
+                state.writes.add(root[1])
+        _scan_names(t, state)
+
+def _scan_children(t, state, skip=()):
+    for i in xrange(1, len(t)):
+        if i not in skip and t[i][0] >= token.NT_OFFSET:
+            _scan_names(t[i], state)
+
+def _scan_names(t, state):
+    # Scan an AST for the names it reads and binds. Reads are found by looking
+    # for atoms that are names; this is an over-estimate, since, for example,
+    # it includes the local variables of function bodies, but that's harmless.
+    # The names that are bound must not be underestimated.
+    node_type = t[0]
+
+    if node_type == symbol.atom:
+        if t[1][0] == token.NAME:
+            state.reads.add(t[1][1])
+        else:
+            _scan_children(t, state)
+    elif node_type == symbol.power:
+        # A method call on a name, a.b(), may mutate a, just as in _rewrite_expr_stmt
+        root = _strip_node(t[1])
+        if root[0] == token.NAME:
+            for i in xrange(2, len(t) - 1):
+                if (t[i][0] == symbol.trailer and t[i][1][0] == token.DOT and
+                    t[i + 1][0] == symbol.trailer and t[i + 1][1][0] == token.LPAR and
+                    _GETTER_RE.match(t[i][2][1]) is None):
+                    state.writes.add(root[1])
+                    break
+        _scan_children(t, state)
+    elif node_type == symbol.expr_stmt:
+        if len(t) == 2:
+            _scan_children(t, state)
+        elif t[2][0] == symbol.augassign:
+            _scan_target(t[1], state)
+            _scan_children(t, state)
+        else:
+            for i in xrange(1, len(t) - 1, 2):
+                _scan_target(t[i], state)
+            _scan_names(t[-1], state)
+    elif node_type == symbol.for_stmt or node_type in _comp_for_symbols:
+        # 'for' exprlist 'in' ...
+        _scan_target(t[2], state)
+        _scan_children(t, state, skip=(2,))
+    elif node_type == symbol.funcdef or node_type == symbol.classdef:
+        state.writes.add(t[2][1])
+        _scan_children(t, state)
+    elif node_type == symbol.decorator:
+        # '@' dotted_name [ '(' [arglist] ')' ] NEWLINE
+        state.reads.add(t[2][1][1])
+        _scan_children(t, state, skip=(2,))
+    elif node_type == symbol.import_name:
+        # Unlike _process_import_name(), we want the name that is bound
+        # in the scope, so 'import a.b' binds 'a'
+        for dotted_as_name in t[2][1:]:
+            if dotted_as_name[0] == token.COMMA:
+                continue
+            if len(dotted_as_name) == 4:
+                state.writes.add(dotted_as_name[3][1])
+            else:
+                state.writes.add(dotted_as_name[1][1][1])
+    elif node_type == symbol.import_from:
+        _, import_map = _process_import_from(t)[0]
+        if import_map == '*':
+            state.unknown_writes = True
+        else:
+            for _, as_name in import_map:
+                state.writes.add(as_name)
+    elif node_type == _with_item and len(t) == 4:
+        # test 'as' expr
+        _scan_target(t[3], state)
+        _scan_children(t, state, skip=(3,))
+    elif node_type == _with_var:
+        # 'as' expr
+        _scan_target(t[2], state)
+    elif node_type == symbol.except_clause and len(t) == 5:
+        # 'except' test ('as' | ',') test
+        _scan_target(t[4], state)
+        _scan_children(t, state, skip=(4,))
+    elif node_type == symbol.del_stmt:
+        _scan_target(t[2], state)
+    elif node_type == symbol.exec_stmt:
+        state.unknown_writes = True
+        _scan_children(t, state)
+    else:
+        _scan_children(t, state)
+
+def _get_names(t):
+    state = _NameScanState()
+    _scan_names(t, state)
+
+    if state.unknown_writes:
+        return state.reads, None
+    else:
+        return state.reads, state.writes
+
+def _scan_calls(t, calls):
+    # Scan an AST for the functions it calls. A call of a bare name, f(x), adds
+    # the name to calls; any other call, such as a.f(x) or f(x)(y), adds None.
+    # Decorators, class definitions and with statements call code we can't
+    # see, so they add None as well.
+    node_type = t[0]
+
+    if node_type == symbol.power:
+        # power: atom trailer* ['**' factor]
+        for i in xrange(2, len(t)):
+            if t[i][0] == symbol.trailer and t[i][1][0] == token.LPAR:
+                root = _strip_node(t[1])
+                if i == 2 and root[0] == token.NAME:
+                    calls.add(root[1])
+                else:
+                    calls.add(None)
+    elif node_type in (symbol.decorator, symbol.classdef, symbol.with_stmt):
+        calls.add(None)
+
+    for i in xrange(1, len(t)):
+        if t[i][0] >= token.NT_OFFSET:
+            _scan_calls(t[i], calls)
+
+def _get_calls(t):
+    calls = set()
+    _scan_calls(t, calls)
+
+    return calls
+
 ######################################################################
 # Turn list of paths that are mutated into code to copy them
 
@@ -773,6 +942,37 @@ class Rewriter:
 
         return _get_imports(self.original)
 
+    def get_names(self):
+        """
+        Return information about the names that the statement reads and binds
+
+        The names read include all names referenced within the statement, including
+        within the bodies of functions and classes that it defines. The names bound
+        include the names of objects that the statement may mutate (see
+        rewrite_and_compile())
+
+        @returns: A tuple of (reads, writes), each a set of names. writes is None
+          if the names bound by the statement can't be determined (for
+          'from module import *' and the exec statement.)
+
+        """
+
+        return _get_names(self.original)
+
+    def get_calls(self):
+        """
+        Return the names of the functions that the statement calls
+
+        Calls within the bodies of functions that the statement defines are
+        included, even though they don't happen when the statement is executed.
+
+        @returns: a set of names. If the statement calls something that isn't
+          a bare name (for example, a method), the set also contains None.
+
+        """
+
+        return _get_calls(self.original)
+
     def rewrite_and_compile(self, output_func_name=None, print_func_name=None, copy_func_name="__copy"):
         """
         Compiles the parse tree into code, while rewriting the parse tree according to the
@@ -1070,6 +1270,64 @@ a.a = A()
 
     test_imports('from __future__ import division', [('__future__', [('division', 'division')])])
 
+    #
+    # Test finding the names that are read and bound
+    #
+
+    def test_names(code, expected_reads, expected_writes):
+        rewriter = Rewriter(code)
+        reads, writes = rewriter.get_names()
+        if reads != set(expected_reads):
+            raise AssertionError("Got reads '%s', expected '%s'" % (sorted(reads), sorted(expected_reads)))
+        if expected_writes is None:
+            if writes is not None:
+                raise AssertionError("Got writes '%s', expected None" % sorted(writes))
+        elif writes != set(expected_writes):
+            raise AssertionError("Got writes '%s', expected '%s'" % (writes and sorted(writes), sorted(expected_writes)))
+
+    test_names('a', ('a',), ())
+    test_names('a = b + c', ('b', 'c'), ('a',))
+    test_names('a = b = c', ('c',), ('a', 'b'))
+    test_names('a, (b, [c]) = d', ('d',), ('a', 'b', 'c'))
+    test_names('a += 1', ('a',), ('a',))
+    test_names('a[i] = b.c', ('a', 'i', 'b'), ('a',))
+    test_names('a.b = 1', ('a',), ('a',))
+    test_names('a.append(b)', ('a', 'b'), ('a',))
+    test_names('x = a.get_b()', ('a',), ('x',))
+    test_names('for i, j in a: b', ('a', 'b'), ('i', 'j'))
+    test_names('x = [i for i in a]', ('i', 'a'), ('i', 'x'))
+    test_names('def f(x, y=d):\n    return x + z', ('d', 'x', 'z'), ('f',))
+    test_names('@deco\ndef f(): pass', ('deco',), ('f',))
+    test_names('class A(B):\n    c = d', ('B', 'd'), ('A', 'c'))
+    test_names('import os.path, re as r', (), ('os', 'r'))
+    test_names('from re import match as m, sub', (), ('m', 'sub'))
+    test_names('from re import *', (), None)
+    test_names('exec "a = 1"', (), None)
+    test_names('del a, b[0]', ('b',), ('a', 'b'))
+    test_names('try:\n    a\nexcept E, e:\n    pass', ('a', 'E'), ('e',))
+    test_names('with a as b: pass', ('a',), ('b',))
+    test_names('f(x=1)', ('f', 'x'), ())
+
+    #
+    # Test finding the functions that are called
+    #
+
+    def test_calls(code, expected):
+        calls = Rewriter(code).get_calls()
+        if calls != set(expected):
+            raise AssertionError("Got calls '%s', expected '%s'" % (sorted(calls), sorted(expected)))
+
+    test_calls('a = b + 1', ())
+    test_calls('a = len(b) + f(g(1))', ('len', 'f', 'g'))
+    test_calls('a.append(1)', (None,))
+    test_calls('f(1)(2)', ('f', None))
+    test_calls('a = b[0](1)', (None,))
+    test_calls('x = y ** f(z)', ('f',))
+    test_calls('def f(x):\n    return g(x)', ('g',))
+    test_calls('@deco\ndef f(): pass', (None,))
+    test_calls('class A(B):\n    c = d', (None,))
+    test_calls('with a as b: pass', (None,))
+
     #
     # Test passing in future_features to use in compilation
     #
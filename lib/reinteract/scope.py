@@ -0,0 +1,321 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import sys
+from UserDict import DictMixin
+
+# When a chain of scopes gets longer than this, we flatten the parent
+# into a dictionary, so lookups don't get arbitrarily slow
+MAX_DEPTH = 16
+
+# Limit on the number of objects estimate_size() looks at
+_MAX_SIZE_OBJECTS = 10000
+
+def estimate_size(value):
+    """Estimate the amount of memory used by a value, in bytes
+
+    The estimate includes the contents of standard containers and the data of
+    objects with an 'nbytes' attribute (like numpy arrays), but isn't
+    otherwise recursive. For very large containers, the size of the part
+    that was examined is extrapolated.
+
+    """
+    total = 0
+    count = 0
+    seen = set()
+    pending = [value]
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+
+        count += 1
+        if count > _MAX_SIZE_OBJECTS:
+            return total + total * len(pending) // count
+
+        try:
+            total += sys.getsizeof(obj)
+        except TypeError:
+            pass
+
+        if isinstance(obj, dict):
+            pending.extend(obj.iterkeys())
+            pending.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            pending.extend(obj)
+        else:
+            nbytes = getattr(obj, 'nbytes', None)
+            if isinstance(nbytes, (int, long)):
+                total += nbytes
+
+    return total
+
+class LayeredScope(DictMixin):
+    """
+    A LayeredScope is a scope that consists of the names bound by a single
+    statement layered on top of the scope of the previous statement. It is
+    used to store the result scopes of statements, so that each result
+    scope costs memory in proportion to the number of names the statement
+    bound rather than the total number of names.
+
+    A LayeredScope can be used as a read-only mapping for things like
+    completion; code can't be executed in it directly, since Python requires
+    the global scope of code to be a real dictionary. Use flatten() to get
+    a dictionary that can be executed in.
+
+    """
+
+    def __init__(self, parent, bindings, deleted=()):
+        """Initialize the LayeredScope object
+
+        @param parent: the scope of the previous statement; either a dictionary or a LayeredScope
+        @param bindings: dictionary of the names bound on top of the parent scope
+        @param deleted: names that are deleted from the parent scope
+
+        """
+        if isinstance(parent, LayeredScope):
+            if parent.depth >= MAX_DEPTH:
+                parent = parent.flatten()
+                self.depth = 1
+            else:
+                self.depth = parent.depth + 1
+        else:
+            self.depth = 1
+
+        self.parent = parent
+        self.bindings = bindings
+        self.deleted = frozenset(deleted)
+
+    @staticmethod
+    def from_dict(parent, scope, names=None):
+        """Create a LayeredScope from the result of executing code in a flattened copy of parent
+
+        @param parent: the scope the code was executed on top of
+        @param scope: the dictionary the code was executed in
+        @param names: the names the code may have bound or deleted. If None, all names in
+           the scope are compared with the parent scope to find the differences.
+
+        """
+        bindings = {}
+        deleted = []
+        if names is None:
+            for name, value in scope.iteritems():
+                if not (name in parent and parent[name] is value):
+                    bindings[name] = value
+            for name in parent.keys():
+                if not name in scope:
+                    deleted.append(name)
+        else:
+            for name in names:
+                if name in scope:
+                    bindings[name] = scope[name]
+                elif name in parent:
+                    deleted.append(name)
+
+        return LayeredScope(parent, bindings, deleted)
+
+    def __getitem__(self, name):
+        scope = self
+        while isinstance(scope, LayeredScope):
+            try:
+                return scope.bindings[name]
+            except KeyError:
+                if name in scope.deleted:
+                    raise KeyError(name)
+            scope = scope.parent
+
+        return scope[name]
+
+    def __contains__(self, name):
+        scope = self
+        while isinstance(scope, LayeredScope):
+            if name in scope.bindings:
+                return True
+            if name in scope.deleted:
+                return False
+            scope = scope.parent
+
+        return name in scope
+
+    has_key = __contains__
+
+    def __setitem__(self, name, value):
+        self.bindings[name] = value
+        if name in self.deleted:
+            self.deleted = self.deleted - set([name])
+
+    def __delitem__(self, name):
+        if not name in self:
+            raise KeyError(name)
+        self.bindings.pop(name, None)
+        self.deleted = self.deleted | set([name])
+
+    def rebase(self, parent):
+        """Replace the parent scope. The new parent must have the same values as the old
+        parent for all names that aren't bound or deleted by this scope."""
+
+        if isinstance(parent, LayeredScope):
+            self.depth = parent.depth + 1
+        else:
+            self.depth = 1
+        self.parent = parent
+
+    def prune(self, base, exclude):
+        """Merge layers into a single layer, dropping names that are shadowed
+
+        Creates a new single layer on top of base that has the same values as this
+        scope for all names not in exclude. If base isn't found in the chain of
+        parents of this scope, the layer is created on top of the first scope in the
+        chain that isn't a LayeredScope. The values bound by the merged layers are
+        no longer referenced by the result, unless they are still visible.
+
+        @param base: the scope to stop merging at
+        @param exclude: names that can be omitted from the result
+
+        """
+        layers = []
+        scope = self
+        while isinstance(scope, LayeredScope) and scope is not base:
+            layers.append(scope)
+            scope = scope.parent
+
+        bindings = {}
+        deleted = set()
+        for layer in reversed(layers):
+            for name in layer.deleted:
+                bindings.pop(name, None)
+                deleted.add(name)
+            bindings.update(layer.bindings)
+            deleted.difference_update(layer.bindings)
+
+        for name in exclude:
+            bindings.pop(name, None)
+            deleted.discard(name)
+
+        return LayeredScope(scope, bindings, deleted)
+
+    def estimate_size(self):
+        """Estimate the memory used by the values bound in this layer; see estimate_size()"""
+
+        return sum(estimate_size(value) for value in self.bindings.itervalues())
+
+    def keys(self):
+        return self.flatten().keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.flatten())
+
+    def iteritems(self):
+        return self.flatten().iteritems()
+
+    def items(self):
+        return self.flatten().items()
+
+    def flatten(self):
+        """Return a new dictionary with all the names in the scope"""
+
+        layers = []
+        scope = self
+        while isinstance(scope, LayeredScope):
+            layers.append(scope)
+            scope = scope.parent
+
+        result = dict(scope)
+        for layer in reversed(layers):
+            for name in layer.deleted:
+                result.pop(name, None)
+            result.update(layer.bindings)
+
+        return result
+
+    def __repr__(self):
+        return "LayeredScope(depth=%d, bindings=%r, deleted=%r)" % (self.depth, sorted(self.bindings.keys()), sorted(self.deleted))
+
+def flatten_scope(scope):
+    """Return a new dictionary with the names in scope, which is either a dictionary or a LayeredScope"""
+
+    if isinstance(scope, LayeredScope):
+        return scope.flatten()
+    else:
+        return dict(scope)
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    from test_utils import assert_equals
+
+    base = { 'a': 1, 'b': 2 }
+
+    s1 = LayeredScope(base, { 'c': 3 })
+    assert_equals(s1['a'], 1)
+    assert_equals(s1['c'], 3)
+    assert 'c' in s1
+    assert not 'c' in base
+    assert_equals(s1.get('d'), None)
+    assert_equals(sorted(s1.keys()), ['a', 'b', 'c'])
+    assert_equals(sorted(s1.items()), [('a', 1), ('b', 2), ('c', 3)])
+
+    # Deleting a name from a parent
+    s2 = LayeredScope(s1, { 'a': 4 }, ['b'])
+    assert_equals(s2['a'], 4)
+    assert not 'b' in s2
+    try:
+        s2['b']
+        raise AssertionError("Expected KeyError")
+    except KeyError:
+        pass
+    assert_equals(s2.flatten(), { 'a': 4, 'c': 3 })
+    s2['b'] = 5
+    assert_equals(s2['b'], 5)
+    del s2['c']
+    assert_equals(s2.flatten(), { 'a': 4, 'b': 5 })
+    assert_equals(s1.flatten(), { 'a': 1, 'b': 2, 'c': 3 })
+
+    # Creating from the result of execution
+    s1['__builtins__'] = __builtins__
+    scope = s1.flatten()
+    exec "d = a + c; del b" in scope
+    s3 = LayeredScope.from_dict(s1, scope)
+    assert_equals(s3.bindings, { 'd': 4 })
+    assert_equals(s3.deleted, frozenset(['b']))
+    s3 = LayeredScope.from_dict(s1, scope, ['d', 'b'])
+    assert_equals(s3.bindings, { 'd': 4 })
+    assert_equals(s3.deleted, frozenset(['b']))
+
+    # Pruning a chain of layers
+    s4 = LayeredScope(s3, { 'a': range(1000, 1100) })
+    s5 = LayeredScope(s4, { 'a': 6 })
+    pruned = s4.prune(s1, s5.bindings)
+    assert pruned.parent is s1
+    assert_equals(pruned.bindings, { 'd': 4 })
+    assert_equals(pruned.deleted, frozenset(['b']))
+    expected = s5.flatten()
+    s5.rebase(pruned)
+    assert_equals(s5.flatten(), expected)
+    assert_equals(s5['a'], 6)
+    assert s4.estimate_size() > 100 * sys.getsizeof(0) / 2
+
+    # Size estimates
+    assert estimate_size([]) < estimate_size(range(1000))
+    assert estimate_size(xrange(1000000)) < 1000
+    shared = range(1000)
+    assert estimate_size([shared, shared]) < 2 * estimate_size(shared)
+    big = [[i] for i in xrange(10 * _MAX_SIZE_OBJECTS)]
+    assert estimate_size(big) > 5 * _MAX_SIZE_OBJECTS * sys.getsizeof([0])
+
+    # Long chains are flattened
+    s = LayeredScope(base, {})
+    for i in xrange(0, 100):
+        s = LayeredScope(s, { 'a': i })
+        assert s.depth <= MAX_DEPTH
+    assert_equals(s['a'], 99)
+    assert_equals(s['b'], 2)
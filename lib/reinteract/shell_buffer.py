@@ -8,10 +8,12 @@
 
 from __future__ import with_statement
 
+from collections import deque
 import gobject
 import gtk
 import logging
 import pango
+import time
 
 from custom_result import CustomResult
 from chunks import StatementChunk,CommentChunk
@@ -49,6 +51,10 @@ ADJUST_BEFORE = 0
 ADJUST_AFTER = 1
 ADJUST_NONE = 2
 
+# Chunks that aren't visible are fontified in the background, in batches that
+# take about this long
+_FONTIFY_BATCH_TIME = 0.02 # seconds
+
 #######################################################
 # GtkTextView fixups
 #######################################################
@@ -92,11 +98,13 @@ class ShellBuffer(gtk.TextBuffer):
         self.worksheet.connect('text-deleted', self.on_text_deleted)
         self.worksheet.connect('lines-inserted', self.on_lines_inserted)
         self.worksheet.connect('lines-deleted', self.on_lines_deleted)
+        self.worksheet.connect('reset', self.on_reset)
         self.worksheet.connect('chunk-inserted', self.on_chunk_inserted)
         self.worksheet.connect('chunk-changed', self.on_chunk_changed)
         self.worksheet.connect('chunk-deleted', self.on_chunk_deleted)
         self.worksheet.connect('chunk-status-changed', self.on_chunk_status_changed)
         self.worksheet.connect('chunk-results-changed', self.on_chunk_results_changed)
+        self.worksheet.connect('chunk-results-appended', self.on_chunk_results_appended)
         self.worksheet.connect('place-cursor', self.on_place_cursor)
 
         self.__result_tag = self.create_tag(family="monospace",
@@ -148,6 +156,15 @@ class ShellBuffer(gtk.TextBuffer):
         self.__have_pair = False
         self.__pair_mark = self.create_mark(None, self.get_start_iter(), True)
 
+        # New chunks are fontified from idle handlers, the visible chunks first,
+        # so that inserting or loading a lot of text doesn't block the user.
+        # Chunks that change are fontified immediately.
+        self.__fontify_pending = set()
+        self.__fontify_queue = deque()
+        self.__fontify_idle = 0
+        self.__fontify_visible_idle = 0
+        self.__visible_lines = (0, 0)
+
     #######################################################
     # Utility
     #######################################################
@@ -187,7 +204,8 @@ class ShellBuffer(gtk.TextBuffer):
         chunk.results_start_mark.source = chunk
 
         if chunk.error_message:
-            results = [ chunk.error_message ]
+            # A failed statement only has results if a profile was added to them
+            results = [ chunk.error_message ] + (chunk.results or [])
         else:
             results = chunk.results
 
@@ -197,25 +215,7 @@ class ShellBuffer(gtk.TextBuffer):
                 self.insert(location, "\n")
             first = False
 
-            if isinstance(result, basestring):
-                self.insert(location, result)
-            elif isinstance(result, WarningResult):
-                start_mark = self.create_mark(None, location, True)
-                self.insert(location, result.message)
-                start = self.get_iter_at_mark(start_mark)
-                self.delete_mark(start_mark)
-                self.apply_tag(self.__warning_tag, start, location)
-            elif isinstance(result, HelpResult):
-                start_mark = self.create_mark(None, location, True)
-                doc_format.insert_docs(self, location, result.arg, self.__bold_tag)
-                start = self.get_iter_at_mark(start_mark)
-                self.delete_mark(start_mark)
-                self.apply_tag(self.__help_tag, start, location)
-            elif isinstance(result, CustomResult):
-                anchor = self.create_child_anchor(location)
-                self.emit("add-custom-result", result, anchor)
-                location = self.get_iter_at_child_anchor(anchor)
-                location.forward_char() # Skip over child
+            location = self.__insert_result(location, result)
 
         start = self.get_iter_at_mark(chunk.results_start_mark)
         self.apply_tag(self.__result_tag, start, location)
@@ -228,6 +228,60 @@ class ShellBuffer(gtk.TextBuffer):
 
         self.__end_modification()
 
+    def __insert_result(self, location, result):
+        # Inserts a single result at location, returns an iter pointing after it
+        if isinstance(result, basestring):
+            self.insert(location, result)
+        elif isinstance(result, WarningResult):
+            start_mark = self.create_mark(None, location, True)
+            self.insert(location, result.message)
+            start = self.get_iter_at_mark(start_mark)
+            self.delete_mark(start_mark)
+            self.apply_tag(self.__warning_tag, start, location)
+        elif isinstance(result, HelpResult):
+            start_mark = self.create_mark(None, location, True)
+            doc_format.insert_docs(self, location, result.arg, self.__bold_tag)
+            start = self.get_iter_at_mark(start_mark)
+            self.delete_mark(start_mark)
+            self.apply_tag(self.__help_tag, start, location)
+        elif isinstance(result, CustomResult):
+            anchor = self.create_child_anchor(location)
+            self.emit("add-custom-result", result, anchor)
+            location = self.get_iter_at_child_anchor(anchor)
+            location.forward_char() # Skip over child
+
+        return location
+
+    def __append_results(self, chunk, results):
+        # Adds results to the end of the existing results of the chunk, leaving
+        # what is already there alone
+        self.__begin_modification()
+
+        location = self.get_iter_at_mark(chunk.results_end_mark)
+
+        # As in __insert_results, don't move the insert cursor if it is right
+        # at the end of the results
+        if location.compare(self.get_iter_at_mark(self.get_insert())) == 0:
+            saved_insert = self.create_mark(None, location, True)
+        else:
+            saved_insert = None
+
+        start_mark = self.create_mark(None, location, True)
+        for result in results:
+            self.insert(location, "\n")
+            location = self.__insert_result(location, result)
+
+        start = self.get_iter_at_mark(start_mark)
+        self.delete_mark(start_mark)
+        self.apply_tag(self.__result_tag, start, location)
+        self.move_mark(chunk.results_end_mark, location)
+
+        if saved_insert is not None:
+            self.place_cursor(self.get_iter_at_mark(saved_insert))
+            self.delete_mark(saved_insert)
+
+        self.__end_modification()
+
     def __delete_results_marks(self, chunk):
         if not (isinstance(chunk, StatementChunk) and chunk.results_start_mark):
             return
@@ -331,6 +385,63 @@ class ShellBuffer(gtk.TextBuffer):
                     end.set_line_offset(end_index)
                     self.apply_tag(tag, iter, end)
 
+    def __fontify_chunk(self, chunk, changed_lines):
+        if isinstance(chunk, StatementChunk):
+            self.__fontify_statement_chunk(chunk, changed_lines)
+        elif isinstance(chunk, CommentChunk):
+            start = self.pos_to_iter(chunk.start)
+            end = self.pos_to_iter(chunk.end - 1, len(self.worksheet.get_line(chunk.end - 1)))
+            self.remove_all_tags(start, end)
+            self.apply_tag(self.__comment_tag, start, end)
+
+    def __queue_fontify(self, chunk):
+        if chunk in self.__fontify_pending:
+            return
+
+        self.__fontify_pending.add(chunk)
+        self.__fontify_queue.append(chunk)
+
+        if self.__fontify_idle == 0:
+            self.__fontify_idle = gobject.idle_add(self.__fontify_in_background,
+                                                   priority=gobject.PRIORITY_LOW)
+        self.__queue_fontify_visible()
+
+    def __queue_fontify_visible(self):
+        # A higher priority than GTK+ uses for redrawing, so the visible chunks are
+        # fontified before they are drawn
+        if self.__fontify_visible_idle == 0:
+            self.__fontify_visible_idle = gobject.idle_add(self.__fontify_visible,
+                                                           priority=gobject.PRIORITY_HIGH_IDLE)
+
+    def __fontify_pending_chunk(self, chunk):
+        self.__fontify_pending.remove(chunk)
+        self.__fontify_chunk(chunk, xrange(0, chunk.end - chunk.start))
+
+    def __fontify_visible(self):
+        self.__fontify_visible_idle = 0
+
+        start_line, end_line = self.__visible_lines
+        for chunk in list(self.worksheet.iterate_chunks(start_line, end_line)):
+            if chunk in self.__fontify_pending:
+                self.__fontify_pending_chunk(chunk)
+
+        return False
+
+    def __fontify_in_background(self):
+        end_time = time.time() + _FONTIFY_BATCH_TIME
+
+        queue = self.__fontify_queue
+        while len(queue) > 0:
+            chunk = queue.popleft()
+            # Chunks that were deleted or fontified since they were queued aren't pending
+            if chunk in self.__fontify_pending:
+                self.__fontify_pending_chunk(chunk)
+                if time.time() > end_time:
+                    return True
+
+        self.__fontify_idle = 0
+        return False
+
     #######################################################
     # Overrides for GtkTextView behavior
     #######################################################
@@ -524,14 +635,51 @@ class ShellBuffer(gtk.TextBuffer):
         for i in xrange(start, len(self.__line_marks)):
             self.__line_marks[i].line -= (end - start)
 
+    def on_reset(self, worksheet):
+        _debug("...reset")
+        self.__begin_modification()
+
+        self.delete(self.get_start_iter(), self.get_end_iter())
+
+        # All the marks are now at the start of the buffer. The chunks that the
+        # results belonged to are gone, so we find the results marks from there
+        for mark in self.get_start_iter().get_marks():
+            if hasattr(mark, 'source'):
+                self.__delete_results_marks(mark.source)
+        for mark in self.__line_marks:
+            self.delete_mark(mark)
+
+        self.insert(self.get_start_iter(), worksheet.get_text())
+
+        line_count = worksheet.get_line_count()
+        self.__line_marks = [None] * line_count
+        iter = self.get_start_iter()
+        for i in xrange(0, line_count):
+            mark = self.__line_marks[i] = self.create_mark(None, iter, True)
+            mark.line = i
+            iter.forward_line()
+
+        self.__fontify_pending.clear()
+        self.__fontify_queue.clear()
+        for chunk in worksheet.iterate_chunks():
+            chunk.results_start_mark = None
+            chunk.results_end_mark = None
+            self.__queue_fontify(chunk)
+
+        self.place_cursor(self.get_start_iter())
+
+        self.__end_modification()
+
     def on_chunk_inserted(self, worksheet, chunk):
         _debug("...chunk %s inserted", chunk);
         chunk.results_start_mark = None
         chunk.results_end_mark = None
-        self.on_chunk_changed(worksheet, chunk, range(0, chunk.end - chunk.start))
+        self.__insert_results(chunk)
+        self.__queue_fontify(chunk)
 
     def on_chunk_deleted(self, worksheet, chunk):
         _debug("...chunk %s deleted", chunk);
+        self.__fontify_pending.discard(chunk)
         self.__delete_results(chunk)
 
     def on_chunk_changed(self, worksheet, chunk, changed_lines):
@@ -547,13 +695,10 @@ class ShellBuffer(gtk.TextBuffer):
         else:
             self.__insert_results(chunk)
 
-        if isinstance(chunk, StatementChunk):
-            self.__fontify_statement_chunk(chunk, changed_lines)
-        elif isinstance(chunk, CommentChunk):
-            start = self.pos_to_iter(chunk.start)
-            end = self.pos_to_iter(chunk.end - 1, len(self.worksheet.get_line(chunk.end - 1)))
-            self.remove_all_tags(start, end)
-            self.apply_tag(self.__comment_tag, start, end)
+        if chunk in self.__fontify_pending:
+            self.__fontify_pending_chunk(chunk)
+        else:
+            self.__fontify_chunk(chunk, changed_lines)
 
     def on_chunk_status_changed(self, worksheet, chunk):
         _debug("...chunk %s status changed", chunk);
@@ -564,6 +709,14 @@ class ShellBuffer(gtk.TextBuffer):
         self.__delete_results(chunk)
         self.__insert_results(chunk)
 
+    def on_chunk_results_appended(self, worksheet, chunk, results):
+        _debug("...chunk %s results appended", chunk);
+        if chunk.results_start_mark and chunk.error_message is None:
+            self.__append_results(chunk, results)
+        else:
+            self.__delete_results(chunk)
+            self.__insert_results(chunk)
+
     def on_place_cursor(self, worksheet, line, offset):
         self.place_cursor(self.pos_to_iter(line, offset))
 
@@ -647,6 +800,18 @@ class ShellBuffer(gtk.TextBuffer):
 
         return self.worksheet.get_text(start_line, start_offset, end_line, end_offset)
 
+    def set_visible_lines(self, start_line, end_line):
+        """Set the range of lines that are currently visible. New chunks in this
+        range are fontified before other chunks.
+
+        @param start_line: the first visible line
+        @param end_line: the line after the last visible line
+
+        """
+        self.__visible_lines = (start_line, end_line)
+        if len(self.__fontify_pending) > 0:
+            self.__queue_fontify_visible()
+
     def get_pair_location(self):
         """Return an iter pointing to the character paired with the character before the cursor, or None"""
 
@@ -952,3 +1117,40 @@ a.foo()""")
 >>> a.foo()
 'a' apparently modified, but can't copy it
 A()""")
+
+    # Loading a worksheet replaces the text, removing the old results
+    import os
+    import tempfile
+
+    from test_utils import assert_equals
+
+    handle, fname = tempfile.mkstemp(".rws", "reinteract_shell_buffer")
+    os.close(handle)
+    try:
+        f = open(fname, "w")
+        f.write("# A comment\n1 + \\\n  1\n\n3")
+        f.close()
+
+        buf.worksheet.load(fname)
+        expect("""# A comment
+>>> 1 + \\
+...   1
+
+>>> 3""")
+
+        # The chunks are fontified in the background
+        assert_equals(buf.get_start_iter().get_tags(), [])
+        while gtk.events_pending():
+            gtk.main_iteration()
+        assert buf.get_start_iter().get_tags() != []
+
+        calculate()
+        expect("""# A comment
+>>> 1 + \\
+...   1
+2
+
+>>> 3
+3""")
+    finally:
+        os.remove(fname)
@@ -8,6 +8,7 @@
 
 import gobject
 import gtk
+import math
 import re
 from shell_buffer import ShellBuffer, ADJUST_NONE, ADJUST_BEFORE, ADJUST_AFTER
 from chunks import StatementChunk, CommentChunk, BlankChunk
@@ -19,6 +20,24 @@ import sanitize_textview_ipc
 
 LEFT_MARGIN_WIDTH = 10
 
+# Statements taking less time than this are all shown in the coldest color
+# when showing execution times
+MIN_HEAT_COST = 0.001 # seconds
+
+def _get_heat_colors(cost, max_cost):
+    # Fill and outline colors for a statement when showing execution times; from
+    # the normal blue for the fastest statements to orange for the slowest. Execution
+    # times vary by orders of magnitude, so we use a log scale
+    if max_cost <= MIN_HEAT_COST:
+        heat = 0.
+    else:
+        heat = math.log(max(cost, MIN_HEAT_COST) / MIN_HEAT_COST) / math.log(max_cost / MIN_HEAT_COST)
+
+    fill = (heat, 0.5 * heat, 1 - heat)
+    outline = (0.5 * heat, 0.25 * heat, 0.5 * (1 - heat))
+
+    return fill, outline
+
 ALL_WHITESPACE_RE = re.compile("^\s*$")
 
 class ShellView(gtk.TextView):
@@ -44,6 +63,7 @@ class ShellView(gtk.TextView):
             buf.worksheet.connect('chunk-inserted', self.on_chunk_inserted)
             buf.worksheet.connect('chunk-changed', self.on_chunk_changed)
             buf.worksheet.connect('chunk-status-changed', self.on_chunk_status_changed)
+            buf.worksheet.connect('reset', self.on_reset)
             buf.worksheet.connect('notify::state', self.on_notify_state)
 
             # Track changes to update completion
@@ -79,6 +99,14 @@ class ShellView(gtk.TextView):
         self.__arg_highlight_end = None
         buf.connect('mark-set', self.on_mark_set)
 
+        self.__show_execution_times = False
+
+        # The visible lines are reported to the buffer when the view is scrolled or
+        # resized, so that the buffer can fontify them before they are drawn
+        self.__vadjustment = None
+        self.__vadjustment_changed_id = 0
+        self.connect_after('set-scroll-adjustments', self.on_set_scroll_adjustments)
+
     def __get_worksheet_line_yrange(self, line):
         buffer_line = self.get_buffer().pos_to_iter(line)
         return self.get_line_yrange(buffer_line)
@@ -105,6 +133,18 @@ class ShellView(gtk.TextView):
         cr.set_line_width(1)
         cr.stroke()
 
+    def set_show_execution_times(self, show_execution_times):
+        """Set whether the left margin shows the time taken by the last execution of
+        each statement as a heat scale, rather than just the status of the statement.
+        Statements with errors or that need to be executed are still shown as usual.
+
+        """
+        if show_execution_times == self.__show_execution_times:
+            return
+
+        self.__show_execution_times = show_execution_times
+        self.queue_draw()
+
     def do_realize(self):
         gtk.TextView.do_realize(self)
 
@@ -145,6 +185,28 @@ class ShellView(gtk.TextView):
         if (self.flags() & gtk.REALIZED) != 0:
             self.__watch_window.resize(allocation.width, allocation.height)
 
+        self.__update_visible_lines()
+
+    def on_set_scroll_adjustments(self, view, hadjustment, vadjustment):
+        if self.__vadjustment_changed_id != 0:
+            self.__vadjustment.disconnect(self.__vadjustment_changed_id)
+            self.__vadjustment_changed_id = 0
+
+        self.__vadjustment = vadjustment
+        if vadjustment is not None:
+            # Connected after GtkTextView has connected to the adjustment, so the
+            # view has already scrolled when we are called
+            self.__vadjustment_changed_id = vadjustment.connect('value-changed', self.on_vadjustment_value_changed)
+
+    def on_vadjustment_value_changed(self, adjustment):
+        self.__update_visible_lines()
+
+    def __update_visible_lines(self):
+        rect = self.get_visible_rect()
+        start_line = self.__get_worksheet_line_at_y(rect.y, adjust=ADJUST_AFTER)
+        end_line = self.__get_worksheet_line_at_y(rect.y + rect.height - 1, adjust=ADJUST_BEFORE)
+        self.get_buffer().set_visible_lines(start_line, end_line + 1)
+
     def __expose_window_left(self, event):
         (_, start_y) = self.window_to_buffer_coords(gtk.TEXT_WINDOW_LEFT, 0, event.area.y)
         start_line = self.__get_worksheet_line_at_y(start_y, adjust=ADJUST_AFTER)
@@ -156,6 +218,16 @@ class ShellView(gtk.TextView):
 
         cr = event.window.cairo_create()
 
+        # The scale is relative to the slowest statement in the entire worksheet, so it
+        # doesn't change when scrolling
+        max_cost = 0
+        if self.__show_execution_times:
+            for chunk in buf.worksheet.iterate_chunks():
+                if isinstance(chunk, StatementChunk):
+                    cost = chunk.get_cost()
+                    if cost is not None:
+                        max_cost = max(cost, max_cost)
+
         for chunk in buf.worksheet.iterate_chunks(start_line, end_line + 1):
             if isinstance(chunk, StatementChunk):
                 if chunk.executing:
@@ -166,6 +238,9 @@ class ShellView(gtk.TextView):
                     self.paint_chunk(cr, event.area, chunk, (1, 1, 0), (0.5, 0.5, 0))
                 elif chunk.needs_execute:
                     self.paint_chunk(cr, event.area, chunk, (1, 0, 1), (0.5, 0.5, 0))
+                elif self.__show_execution_times and chunk.get_cost() is not None:
+                    fill, outline = _get_heat_colors(chunk.get_cost(), max_cost)
+                    self.paint_chunk(cr, event.area, chunk, fill, outline)
                 else:
                     self.paint_chunk(cr, event.area, chunk, (0, 0, 1), (0, 0, 0.5))
 
@@ -619,6 +694,9 @@ class ShellView(gtk.TextView):
     def on_chunk_status_changed(self, worksheet, chunk):
         self.__invalidate_status(chunk)
 
+    def on_reset(self, worksheet):
+        self.queue_draw()
+
     def on_notify_state(self, worksheet, param_spec):
         if (self.flags() & gtk.REALIZED) != 0:
             if worksheet.state == NotebookFile.EXECUTING:
@@ -627,6 +705,10 @@ class ShellView(gtk.TextView):
             else:
                 self.__watch_window.hide()
 
+        # The scale of the execution times may have changed
+        if self.__show_execution_times and worksheet.state != NotebookFile.EXECUTING:
+            self.queue_draw()
+
     def on_after_insert_text(self, buf, location, text, len):
         if buf.worksheet.in_user_action() and not buf.in_modification():
             self.__inserted_in_user_action = True
@@ -679,6 +761,24 @@ class ShellView(gtk.TextView):
         buf = self.get_buffer()
 
         buf.worksheet.calculate()
+        self.__after_calculate()
+
+    def profile(self, whole_calculation=False):
+        """Calculate the worksheet, profiling the statement at the cursor, or if
+        whole_calculation is True, the whole calculation. See Worksheet.profile()"""
+
+        buf = self.get_buffer()
+
+        if whole_calculation:
+            line = None
+        else:
+            line, _ = buf.iter_to_pos(buf.get_iter_at_mark(buf.get_insert()), adjust=ADJUST_BEFORE)
+
+        buf.worksheet.profile(line=line, sampling=global_settings.profile_by_sampling)
+        self.__after_calculate()
+
+    def __after_calculate(self):
+        buf = self.get_buffer()
 
         # This is a hack to work around the fact that scroll_mark_onscreen()
         # doesn't wait for a size-allocate cycle, so doesn't properly handle
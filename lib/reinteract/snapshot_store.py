@@ -0,0 +1,294 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import cPickle
+import logging
+import os
+import sys
+import types
+
+try:
+    from hashlib import sha1
+except ImportError: # Python 2.4
+    from sha import new as sha1
+
+from file_writer import replace_file
+from statement import WarningResult
+
+_debug = logging.getLogger("SnapshotStore").debug
+
+# Bump if the format of snapshots changes
+_FORMAT_VERSION = 1
+
+def get_snapshot_key(parent_key, text):
+    """Compute the key identifying the snapshot of a statement
+
+    The key covers the text of the statement and, through parent_key, the texts
+    of all the statements before it.
+
+    @param parent_key: the key of the previous statement, or None for the first statement
+    @param text: the text of the statement
+
+    """
+    if isinstance(text, unicode):
+        text = text.encode("utf8")
+
+    h = sha1()
+    h.update("%d\0%s\0%s\0" % (_FORMAT_VERSION, sys.version, parent_key or ""))
+    h.update(text)
+
+    return h.hexdigest()
+
+def get_snapshot_directory(filename):
+    """Get the directory holding the snapshots for a worksheet file. It is next to the
+    worksheet file, and starts with '.', so it is ignored by Notebook"""
+
+    folder, basename = os.path.split(filename)
+    return os.path.join(folder, "." + basename + ".snapshots")
+
+def _encode_results(results):
+    # Results are normally unicode strings; anything else that can't be pickled
+    # is replaced with a warning
+    encoded = []
+    for result in results:
+        if not isinstance(result, basestring):
+            try:
+                cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+            except Exception:
+                result = WarningResult("Can't restore %s result from a snapshot" % type(result).__name__)
+        encoded.append(result)
+
+    return encoded
+
+def _import_module(name):
+    __import__(name)
+    return sys.modules[name]
+
+class SnapshotStore(object):
+    """Class to store the results of executing statements on disk
+
+    When a worksheet is reopened, executing a statement that takes a long time
+    (loading a big data file, say) can be skipped by restoring the results and
+    the names bound by the statement from a snapshot saved the last time.
+
+    A snapshot is stored under a key computed with get_snapshot_key(), so it
+    is only used when the text of the statement and all the statements before
+    it are unchanged. Changes to files or modules that the statements read
+    aren't noticed; clear() removes all the snapshots.
+
+    Modules bound by a statement are stored by name and imported again. Other
+    values are pickled; if any value can't be pickled, no snapshot is stored.
+    Errors reading or writing snapshots are otherwise ignored, so it is fine
+    for the directory to be unwritable.
+
+    """
+
+    def __init__(self, directory):
+        """Initialize the SnapshotStore object
+
+        @param directory: the directory to store snapshots in. Created when needed
+
+        """
+        self.directory = directory
+
+        self.hits = 0
+        self.misses = 0
+
+    def __remove(self, filename):
+        try:
+            os.remove(os.path.join(self.directory, filename))
+        except OSError:
+            pass
+
+    def lookup(self, key, text):
+        """Load the snapshot of a statement
+
+        @param key: the key of the statement, see get_snapshot_key()
+        @param text: the text of the statement; a snapshot stored for a different
+           text isn't used
+        @returns: None if there is no valid snapshot, otherwise a tuple of
+           (results, bindings, deleted), as passed to store()
+
+        """
+        path = os.path.join(self.directory, key)
+        try:
+            f = open(path, "rb")
+        except IOError:
+            self.misses += 1
+            return None
+
+        try:
+            try:
+                unpickler = cPickle.Unpickler(f)
+                version, stored_key, stored_text = unpickler.load()
+                if version != _FORMAT_VERSION or stored_key != key or stored_text != text:
+                    _debug("Snapshot %s is for a different statement", key)
+                    self.misses += 1
+                    return None
+
+                results, deleted, modules = unpickler.load()
+                bindings = unpickler.load()
+            finally:
+                f.close()
+
+            for name, module_name in modules.iteritems():
+                bindings[name] = _import_module(module_name)
+        except Exception:
+            # A corrupt snapshot, or values of a class that can no longer be imported
+            _debug("Can't load snapshot %s", key, exc_info=True)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return results, bindings, deleted
+
+    def store(self, key, text, results, bindings, deleted):
+        """Store the snapshot of a statement
+
+        @param key: the key of the statement, see get_snapshot_key()
+        @param text: the text of the statement
+        @param results: the results of executing the statement. Results other than
+           strings that can't be pickled are replaced with a warning
+        @param bindings: dictionary of the names bound by the statement
+        @param deleted: names deleted by the statement
+        @returns: a list of (name, error message) for the values in bindings that
+           couldn't be pickled. If not empty, the snapshot wasn't stored.
+
+        """
+        modules = {}
+        values = {}
+        for name, value in bindings.iteritems():
+            if isinstance(value, types.ModuleType):
+                modules[name] = value.__name__
+            else:
+                values[name] = value
+
+        path = os.path.join(self.directory, key)
+        tmpname = path + ".tmp"
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            f = open(tmpname, "wb")
+        except (IOError, OSError), e:
+            _debug("Can't write snapshot %s: %s", key, e)
+            return []
+
+        failures = []
+        success = False
+        try:
+            try:
+                # Pickling all the values together keeps objects shared between them shared
+                pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+                pickler.dump((_FORMAT_VERSION, key, text))
+                pickler.dump((_encode_results(results), tuple(deleted), modules))
+                pickler.dump(values)
+                f.close()
+                replace_file(tmpname, path)
+                success = True
+            except (IOError, OSError), e:
+                _debug("Can't write snapshot %s: %s", key, e)
+            except Exception:
+                # Find out which values are the problem
+                for name in sorted(values):
+                    try:
+                        cPickle.dumps(values[name], cPickle.HIGHEST_PROTOCOL)
+                    except Exception, e:
+                        failures.append((name, str(e)))
+        finally:
+            if not success:
+                f.close()
+                self.__remove(tmpname)
+
+        return failures
+
+    def prune(self, keys):
+        """Remove all snapshots except those with the given keys
+
+        @param keys: the keys of the snapshots to keep
+
+        """
+        keys = set(keys)
+        try:
+            filenames = os.listdir(self.directory)
+        except OSError:
+            return
+
+        remaining = len(filenames)
+        for filename in filenames:
+            if not filename in keys:
+                _debug("Removing snapshot %s", filename)
+                self.__remove(filename)
+                remaining -= 1
+
+        if remaining == 0:
+            try:
+                os.rmdir(self.directory)
+            except OSError:
+                pass
+
+    def clear(self):
+        """Remove all snapshots"""
+
+        self.prune(())
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    import shutil
+    import tempfile
+
+    from test_utils import assert_equals
+
+    base = tempfile.mkdtemp("", "snapshot_store")
+    try:
+        store = SnapshotStore(get_snapshot_directory(os.path.join(base, "test.rws")))
+
+        key1 = get_snapshot_key(None, u"import os; a = [1, 2]; b = a")
+        key2 = get_snapshot_key(key1, u"c = 1")
+        assert key1 != get_snapshot_key(None, u"c = 1")
+        assert key2 != get_snapshot_key(get_snapshot_key(None, u"import os"), u"c = 1")
+
+        assert_equals(store.lookup(key1, u"import os; a = [1, 2]; b = a"), None)
+
+        a = [1, 2]
+        failures = store.store(key1, u"import os; a = [1, 2]; b = a",
+                               [u"hello", WarningResult("warning"), lambda: None],
+                               { 'os': os, 'a': a, 'b': a }, ['d'])
+        assert_equals(failures, [])
+        results, bindings, deleted = store.lookup(key1, u"import os; a = [1, 2]; b = a")
+        assert_equals(results[0], u"hello")
+        assert_equals(results[1].message, "warning")
+        assert_equals(results[2].message, "Can't restore function result from a snapshot")
+        assert bindings['os'] is os
+        assert_equals(bindings['a'], [1, 2])
+        assert bindings['a'] is bindings['b']
+        assert_equals(deleted, ('d',))
+        assert_equals((store.hits, store.misses), (1, 1))
+
+        # The text is checked as well as the key
+        assert_equals(store.lookup(key1, u"a = 1"), None)
+
+        # Values that can't be pickled are reported, and nothing is stored
+        failures = store.store(key2, u"c = 1", [], { 'c': 1, 'g': (x for x in ()) }, ())
+        assert_equals([name for name, _ in failures], ['g'])
+        assert_equals(store.lookup(key2, u"c = 1"), None)
+
+        # Corrupt snapshots are treated as missing
+        f = open(os.path.join(store.directory, key1), "wb")
+        f.write("garbage")
+        f.close()
+        assert_equals(store.lookup(key1, u"import os; a = [1, 2]; b = a"), None)
+
+        # Pruning removes the other snapshots, and the directory when it is empty
+        store.store(key2, u"c = 1", [], { 'c': 1 }, ())
+        store.prune([key2])
+        assert_equals(os.listdir(store.directory), [key2])
+        store.clear()
+        assert not os.path.exists(store.directory)
+    finally:
+        shutil.rmtree(base)
@@ -6,18 +6,48 @@
 #
 ########################################################################
 
-import copy
+import logging
+import os
 import pkgutil
+import threading
+import time
 import traceback
+import types
 import sys
 
 from custom_result import CustomResult
+import data_format
 import notebook
+from memo_cache import get_memo_key, is_impure
 from notebook import HelpResult
 from rewrite import Rewriter, UnsupportedSyntaxError
+from repr_result import ReprResult
 import reunicode
+from scope import LayeredScope, estimate_size, flatten_scope
 from stdout_capture import StdoutCapture
 
+_debug = logging.getLogger("Statement").debug
+
+# Marker for a name that wasn't found in a scope
+_MISSING = object()
+
+# If a statement references these, it can bind names that we don't know about
+_DYNAMIC_SCOPE_NAMES = frozenset(['globals', 'locals', 'vars'])
+
+# Copying an object before a statement modifies it is reported to the user
+# when it takes longer than this. See copy_strategy.py
+COPY_WARNING_TIME = 0.5 # seconds
+
+# Held while rebuilding an evicted result scope, since that can happen either
+# from the executor thread or from the main thread
+_rebuild_lock = threading.RLock()
+
+def _get_cpu_time():
+    # Python doesn't give us the CPU time of a single thread, so this is
+    # the CPU time of the whole process, in seconds
+    times = os.times()
+    return times[0] + times[1]
+
 class WarningResult(object):
     def __init__(self, message):
         self.message = message
@@ -49,8 +79,66 @@ class Statement:
         self.imports = None
         #: names imported from __future__. Used when compiling subsequent statements
         self.future_features = None
-
-        #: scope at the end of successful execution
+        #: names referenced by the statement. Set after compilation. See L{Rewriter.get_names}
+        self.reads = None
+        #: names bound by the statement, or None if unknown. Set after compilation. See L{Rewriter.get_names}
+        self.writes = None
+        #: names of the functions called by the statement. Set after compilation.
+        #: See L{Rewriter.get_calls}
+        self.calls = None
+        #: True if the statement modifies objects in place (for example, 'a.append(1)').
+        #: Set after compilation
+        self.mutates = False
+        #: names whose values at the start of execution determine the results
+        #: of the statement. Set by the worksheet; None if unknown
+        self.dependencies = None
+
+        #: wall-clock time taken by the last compilation, in seconds. None if not compiled
+        self.compile_time = None
+        #: CPU time taken by the last compilation, in seconds. This is the CPU time of the
+        #: whole process, so includes other threads that were running at the same time
+        self.compile_cpu_time = None
+        #: wall-clock time taken by the last execution, in seconds. None if not executed
+        self.execute_time = None
+        #: CPU time taken by the last execution, in seconds; see compile_cpu_time
+        self.execute_cpu_time = None
+        #: True if the results of the last execution were reused rather than executing
+        #: again; the execution times are then those of the last execution
+        self.reused = False
+        #: True if the results of the last execution were restored from a snapshot
+        #: rather than executing; the execution times are those of loading the snapshot
+        self.restored = False
+        #: True if the results of the last execution were found in the memo cache
+        #: of the worksheet rather than executing. See L{MemoCache}
+        self.memoized = False
+
+        #: L{SnapshotStore} to save the results of executing the statement in and to
+        #: restore them from, or None. Set by the worksheet, along with snapshot_key
+        self.snapshot_store = None
+        #: key of the statement in snapshot_store; see L{snapshot_store.get_snapshot_key}
+        self.snapshot_key = None
+
+        #: maximum time that execution of the statement may take, in seconds, or None for
+        #: no limit. Enforced by the executor; see L{thread_executor.check_timeout}
+        self.timeout = None
+        #: True if the last execution was interrupted because it took longer than timeout
+        self.timed_out = False
+        #: time.time() when the current execution started; None if not executing
+        self.execute_start_time = None
+
+        #: False if the worksheet may evict the result scope of the statement to stay
+        #: within its memory budget. If so, an object bound by the statement that isn't
+        #: referenced from anywhere else is modified in place by the next statement
+        #: rather than copied, and the result scope is evicted. Set by the worksheet
+        self.keep_result_scope = True
+
+        #: if not None, a L{Profiler} to profile execution of the statement with.
+        #: The profile is added to the results of the statement, or of
+        #: profiler.result_statement when that statement finishes executing
+        self.profiler = None
+
+        #: scope at the end of successful execution. None if the scope has been evicted
+        #: to save memory; use get_result_scope() to rebuild it as necessary
         self.result_scope = None
         #: list of results from the statement. Set after successful execution
         self.results = None
@@ -65,6 +153,21 @@ class Statement:
         self.__compiled = None
         self.__parent_future_features = None
 
+        # Values of self.dependencies at the start of the last successful execution,
+        # and whether that execution set '_'; used to check if the execution can be reused
+        self.__dependency_values = None
+        self.__set_underscore = False
+
+        # Objects identifying the modifications that the last execution made to
+        # objects it couldn't copy first, by name, and the objects identifying the
+        # modifications made by previous statements to the dependencies at the
+        # start of the last successful execution; see can_reuse()
+        self.__mutation_tokens = {}
+        self.__dependency_tokens = None
+
+        self.__scope_evicted = False
+        self.__result_scope_size = None
+
         self.set_parent(parent)
 
         self.__stdout_buffer = None
@@ -81,6 +184,16 @@ class Statement:
         """
         self.__parent = parent
 
+    def get_parent(self):
+        """Get the parent statement set with set_parent()"""
+
+        return self.__parent
+
+    def get_text(self):
+        """Get the text of the statement"""
+
+        return self.__text
+
     def compile(self):
         """Compile the statement.
 
@@ -98,15 +211,44 @@ class Statement:
         elif self.state != Statement.NEW:
             return self.state != Statement.COMPILE_ERROR
 
+        start_time = time.time()
+        start_cpu_time = _get_cpu_time()
+        try:
+            return self.__do_compile()
+        finally:
+            self.compile_time = time.time() - start_time
+            self.compile_cpu_time = _get_cpu_time() - start_cpu_time
+
+    def __do_compile(self):
         self.error_message = None
         self.error_line = None
         self.error_offset = None
+        self.__dependency_values = None
+
+        # The encoding is part of the key of the compile cache, so the same one must
+        # be used for looking up and storing
+        encoding = "utf8"
+
+        cache = self.__worksheet.notebook.compile_cache
+        if cache is not None:
+            cached = cache.lookup(self.__text, encoding, self.__parent_future_features)
+        else:
+            cached = None
 
         try:
-            rewriter = Rewriter(self.__text, future_features=self.__parent_future_features)
-            self.imports = rewriter.get_imports()
-            self.__compiled, self.__mutated = rewriter.rewrite_and_compile(output_func_name='reinteract_output',
-                                                                           copy_func_name="__reinteract_copy")
+            if cached is not None:
+                self.__compiled, self.__mutated, self.imports, self.reads, self.writes, self.calls = cached
+            else:
+                rewriter = Rewriter(self.__text, encoding, future_features=self.__parent_future_features)
+                self.imports = rewriter.get_imports()
+                self.reads, self.writes = rewriter.get_names()
+                self.calls = rewriter.get_calls()
+                self.__compiled, self.__mutated = rewriter.rewrite_and_compile(output_func_name='reinteract_output',
+                                                                               copy_func_name="__reinteract_copy")
+                if cache is not None:
+                    cache.store(self.__text, encoding, self.__parent_future_features,
+                                self.__compiled, self.__mutated, self.imports, self.reads, self.writes,
+                                self.calls)
         except SyntaxError, e:
             self.error_message = e.msg
             self.error_line = e.lineno
@@ -122,6 +264,7 @@ class Statement:
             self.state = Statement.COMPILE_ERROR
             return False
 
+        self.mutates = len(self.__mutated) > 0
         self.future_features = self.__parent_future_features
         if self.imports is not None:
             for module, symbols in self.imports:
@@ -147,6 +290,15 @@ class Statement:
 
         return s
 
+    def __append_repr(self, value):
+        # Large values are summarized, with the full text generated later if
+        # the user asks for it
+        text, complete = data_format.format_result(value)
+        if complete:
+            self.results.append(self.__coerce_to_unicode(text))
+        else:
+            self.results.append(ReprResult(self.__coerce_to_unicode(text), value))
+
     def do_output(self, *args):
         """Called by execution of statements with non-None output (see L{Rewriter})"""
 
@@ -158,11 +310,13 @@ class Statement:
             elif isinstance(args[0], CustomResult) or isinstance(args[0], HelpResult):
                 self.results.append(args[0])
             else:
-                self.results.append(self.__coerce_to_unicode(repr(args[0])))
+                self.__append_repr(args[0])
                 self.result_scope['_'] = args[0]
+                self.__set_underscore = True
         else:
-            self.results.append(self.__coerce_to_unicode(repr(args)))
+            self.__append_repr(args)
             self.result_scope['_'] = args
+            self.__set_underscore = True
 
     def __stdout_write(self, s):
         s = self.__coerce_to_unicode(s)
@@ -197,8 +351,12 @@ class Statement:
         """
         assert self.state != Statement.NEW and self.state != Statement.COMPILE_ERROR
         self.state = Statement.EXECUTING
+        self.timed_out = False
+        self.execute_start_time = time.time()
+        # While executing, results holds the output produced so far
+        self.results = []
 
-        self.__worksheet.global_scope['__reinteract_statement'] = self
+        self.__worksheet.global_scope['__reinteract_current'].statement = self
         self.__capture = StdoutCapture(self.__stdout_write)
         self.__capture.push()
 
@@ -213,8 +371,11 @@ class Statement:
             self.state = Statement.INTERRUPTED
             self.results = None
             self.result_scope = None
+            self.__scope_evicted = False
+            self.__result_scope_size = None
 
-        self.__worksheet.global_scope['__reinteract_statement'] = None
+        self.__worksheet.global_scope['__reinteract_current'].statement = None
+        self.execute_start_time = None
         self.__stdout_buffer = None
         self.__capture.pop()
         self.__capture = None
@@ -239,31 +400,262 @@ class Statement:
 
         return (formatted + last_line).rstrip()
 
-    def __do_execute(self):
-        root_scope = self.__worksheet.global_scope
+    def get_parent_scope(self):
+        """Get the scope the statement executes in: the result scope of the parent
+        statement, or the global scope of the worksheet if there is no parent statement.
+
+        @returns: the scope, or None if the parent statement has no result scope
+
+        """
         if self.__parent:
-            scope = copy.copy(self.__parent.result_scope)
+            return self.__parent.get_result_scope()
         else:
-            scope = copy.copy(root_scope)
+            return self.__worksheet.global_scope
 
-        self.results = []
-        self.result_scope = scope
-        self.__stdout_buffer = None
+    def __get_bound_names(self):
+        # Names that execution may have bound or deleted; None if we need to
+        # compare the entire scope against the parent scope to find out
+        if self.writes is None or not _DYNAMIC_SCOPE_NAMES.isdisjoint(self.reads):
+            return None
 
+        if self.__set_underscore:
+            return self.writes.union(('_',))
+        else:
+            return self.writes
+
+    def __get_unshared_mutated(self, parent_scope):
+        # Find the names that the statement modifies that are bound by the parent
+        # statement to objects only referenced from the parent's result scope. If
+        # the parent's result scope isn't kept anyway, we can evict it and modify
+        # the objects without copying them; when the scope is needed again, it is
+        # rebuilt with new objects. The memo cache would refer to the objects.
+        parent = self.__parent
+        if (parent is None or parent.keep_result_scope or parent.state != Statement.EXECUTE_SUCCESS or
+            parent_scope is None or parent_scope is not parent.result_scope or
+            self.__worksheet.memo_cache is not None):
+            return ()
+
+        unshared = set()
+        bindings = parent_scope.bindings
+        for root, description, _ in self.__mutated:
+            if description != root:
+                continue
+            value = bindings.get(root, _MISSING)
+            # The references are from bindings, value, and the argument to getrefcount()
+            if value is not _MISSING and type(value) != type(sys) and sys.getrefcount(value) == 3:
+                unshared.add(root)
+            del value
+
+        if len(unshared) > 0:
+            parent.evict_result_scope()
+            self.__worksheet.scope_evictions += 1
+
+        return unshared
+
+    def __copy_mutated(self, scope, unshared=(), uncopied=None):
+        # Copy objects that the statement modifies, so that the modifications don't
+        # affect the scopes of previous statements, except for the paths that are
+        # just a name in unshared. The names of the objects that are modified
+        # without being copied are added to uncopied. Returns a list of warnings
+        warnings = []
         for root, description, copy_code in self.__mutated:
             try:
                 # If the path to the mutated object starts with a module, ignore it;
                 # our copy magic only applies to worksheet-loca variables
-                if root in scope and type(scope[root]) != type(sys):
+                if description == root and root in unshared:
+                    pass
+                elif root in scope and type(scope[root]) == type(sys):
+                    if uncopied is not None:
+                        uncopied.add(root)
+                elif root in scope:
+                    start_time = time.time()
                     exec copy_code in scope, scope
+                    elapsed = time.time() - start_time
+                    if elapsed >= COPY_WARNING_TIME:
+                        size = estimate_size(scope[root])
+                        warnings.append(WarningResult("Copying '%s' before modifying it took %.1f seconds "
+                                                      "('%s' uses about %.1fMB)" %
+                                                      (description, elapsed, root, size / (1024. * 1024.))))
             except:
-                self.results.append(WarningResult("'%s' apparently modified, but can't copy it" % description))
+                if uncopied is not None:
+                    uncopied.add(root)
+                warnings.append(WarningResult("'%s' apparently modified, but can't copy it" % description))
+
+        return warnings
+
+    def __get_dependency_values(self, parent_scope):
+        if self.dependencies is not None:
+            return dict((name, parent_scope.get(name, _MISSING)) for name in self.dependencies)
+        else:
+            return None
+
+    def __get_dependency_tokens(self):
+        # Find the objects identifying the last modifications that previous
+        # statements made to the dependencies without copying them. A module or an
+        # object that can't be copied keeps its identity when it is modified, so
+        # comparing the values of the dependencies doesn't catch the modification
+        if self.dependencies is None:
+            return None
+
+        tokens = {}
+        remaining = set(self.dependencies)
+        statement = self.__parent
+        while statement is not None and len(remaining) > 0:
+            if len(statement.__mutation_tokens) > 0:
+                for name in remaining.intersection(statement.__mutation_tokens):
+                    tokens[name] = statement.__mutation_tokens[name]
+                    remaining.remove(name)
+            # Modifications before a name was bound were to a different object
+            if statement.writes is not None:
+                remaining.difference_update(statement.writes)
+            statement = statement.__parent
+
+        return tokens
+
+    def __set_stored_result(self, parent_scope, results, bindings, deleted):
+        # Use the results and bindings stored by an earlier execution instead of executing
+        self.results = list(results)
+        self.result_scope = LayeredScope(parent_scope, bindings, deleted)
+        self.__set_underscore = '_' in bindings
+        self.__scope_evicted = False
+        self.__result_scope_size = None
+        self.__dependency_values = self.__get_dependency_values(parent_scope)
+        self.__mutation_tokens = {}
+        self.__dependency_tokens = self.__get_dependency_tokens()
+        self.state = Statement.EXECUTE_SUCCESS
+
+    def __restore_snapshot(self, parent_scope):
+        # When profiling, the point is to execute the statement
+        if self.snapshot_store is None or parent_scope is None or self.profiler is not None:
+            return False
+
+        snapshot = self.snapshot_store.lookup(self.snapshot_key, self.__text)
+        if snapshot is None:
+            return False
+
+        self.__set_stored_result(parent_scope, *snapshot)
+        self.restored = True
+
+        return True
+
+    def __get_memo_key(self, parent_scope):
+        # Only statements that we can assume depend on nothing but the values
+        # of the names they read are memoized
+        memo_cache = self.__worksheet.memo_cache
+        if memo_cache is None or parent_scope is None or self.profiler is not None:
+            return None
+        if self.reads is None or self.writes is None or self.imports is not None:
+            return None
+        if not _DYNAMIC_SCOPE_NAMES.isdisjoint(self.reads):
+            return None
+        if is_impure(self.__text, self.__worksheet.impure_names):
+            return None
+
+        return get_memo_key(self.__text, self.future_features, self.reads, parent_scope,
+                            self.__worksheet.impure_names)
+
+    def __store_memo(self, memo_key):
+        bindings = self.result_scope.bindings
+        # Functions and classes hold on to the scope they were defined in
+        for value in bindings.itervalues():
+            if isinstance(value, (types.FunctionType, types.ClassType, type)):
+                return
 
+        self.__worksheet.memo_cache.store(memo_key, list(self.results), bindings, self.result_scope.deleted)
+
+    def __save_snapshot(self):
+        # Values that can't be saved are reported with the other results
+        failures = self.snapshot_store.store(self.snapshot_key, self.__text, self.results,
+                                             self.result_scope.bindings, self.result_scope.deleted)
+        for name, message in failures:
+            self.results.append(WarningResult("Can't save '%s' in a snapshot: %s" % (name, message)))
+
+    def __do_execute(self, parent_scope):
+        self.reused = False
+        self.restored = False
+        self.memoized = False
+        start_time = time.time()
+        start_cpu_time = _get_cpu_time()
         try:
-            exec self.__compiled in scope, scope
+            if parent_scope is None:
+                parent_scope = self.get_parent_scope()
+
+            memo_key = self.__get_memo_key(parent_scope)
+            if memo_key is not None:
+                memoized = self.__worksheet.memo_cache.lookup(memo_key)
+                if memoized is not None:
+                    self.__set_stored_result(parent_scope, *memoized)
+                    self.memoized = True
+                    return True
+
+            if self.__restore_snapshot(parent_scope):
+                return True
+
+            success = self.__do_execute_in_scope(parent_scope)
+        finally:
+            self.execute_time = time.time() - start_time
+            self.execute_cpu_time = _get_cpu_time() - start_cpu_time
+
+        if success and memo_key is not None:
+            self.__store_memo(memo_key)
+        if (success and self.snapshot_store is not None and
+            self.execute_time >= self.__worksheet.snapshot_min_time):
+            self.__save_snapshot()
+
+        return success
+
+    def __do_execute_in_scope(self, parent_scope):
+        # We execute in a flattened copy of the parent scope, but then only
+        # keep the names that the statement bound as our result scope
+        if parent_scope is None:
+            parent_scope = self.get_parent_scope()
+        if parent_scope is None:
+            # Can happen if the previous statement's result scope was evicted and
+            # executing it again failed
+            self.results = None
+            self.result_scope = None
+            self.error_message = "Can't recreate the result of the previous statement"
+            self.error_line = None
+            self.error_offset = None
+            self.state = Statement.EXECUTE_ERROR
+            return False
+
+        unshared = self.__get_unshared_mutated(parent_scope)
+        scope = flatten_scope(parent_scope)
+
+        self.results = []
+        self.result_scope = scope
+        self.__stdout_buffer = None
+        self.__set_underscore = False
+        self.__scope_evicted = False
+        self.__result_scope_size = None
+
+        dependency_values = self.__get_dependency_values(parent_scope)
+        dependency_tokens = self.__get_dependency_tokens()
+        self.__dependency_values = None
+        self.__dependency_tokens = None
+
+        uncopied = set()
+        self.results.extend(self.__copy_mutated(scope, unshared, uncopied))
+        self.__mutation_tokens = dict((name, object()) for name in uncopied)
+
+        try:
+            if self.profiler is not None:
+                self.profiler.start()
+                try:
+                    exec self.__compiled in scope, scope
+                finally:
+                    self.profiler.stop()
+            else:
+                exec self.__compiled in scope, scope
             if self.__stdout_buffer is not None and self.__stdout_buffer != '':
                 self.results.append(self.__stdout_buffer)
+            if self.profiler is not None and self.profiler.result_statement in (None, self):
+                self.results.append(self.profiler.create_result())
             self.state = Statement.EXECUTE_SUCCESS
+            self.result_scope = LayeredScope.from_dict(parent_scope, scope, self.__get_bound_names())
+            self.__dependency_values = dependency_values
+            self.__dependency_tokens = dependency_tokens
         except KeyboardInterrupt, e:
             raise e
         except:
@@ -279,21 +671,241 @@ class Statement:
 
         return self.state == Statement.EXECUTE_SUCCESS
 
-    def execute(self):
-        """Execute the statement"""
+    def execute(self, parent_scope=None):
+        """Execute the statement
+
+        @param parent_scope: the scope to execute the statement in. Defaults to the result
+           of get_parent_scope(). When a different scope is passed in, it must have the same
+           values as that scope for all the names the statement depends on, and
+           rebase_result_scope() must be called before the result scope is used by
+           subsequent statements.
+
+        """
         was_in_execute = self.state == Statement.EXECUTING
         if not was_in_execute:
             self.before_execute()
         try:
-            return self.__do_execute()
+            return self.__do_execute(parent_scope)
         finally:
             if not was_in_execute:
                 self.after_execute()
 
-    def mark_for_execute(self):
-        """Mark a statement that executed succesfully as needing execution again"""
+    def can_reuse(self, parent_scope=None):
+        """Check if the results of the last execution are still valid.
+
+        The results of a statement that has been marked for execution can be
+        reused if the statement executed successfully and all its dependencies
+        have the same values in the scope of the parent statement as they did
+        at the start of that execution. (Values are compared by identity.) Since
+        modules and objects that can't be copied are modified in place, the
+        results also can't be reused if a previous statement that modifies one
+        of the dependencies that way has been executed since.
+
+        @param parent_scope: the scope to check the dependencies in; see execute()
+
+        """
+        if self.state != Statement.COMPILE_SUCCESS or self.__scope_evicted:
+            return False
+        if self.__dependency_values is None or self.dependencies is None or self.writes is None:
+            return False
+
+        if parent_scope is None:
+            parent_scope = self.get_parent_scope()
+        if parent_scope is None:
+            return False
+
+        for name in self.dependencies:
+            try:
+                old_value = self.__dependency_values[name]
+            except KeyError:
+                return False
+            if parent_scope.get(name, _MISSING) is not old_value:
+                return False
+
+        if self.__get_dependency_tokens() != self.__dependency_tokens:
+            return False
+
+        return True
+
+    def reuse(self, parent_scope=None):
+        """Reuse the results of the last execution instead of executing again.
+
+        The result scope is rebuilt by layering the bindings made by the last
+        execution on top of the current scope of the parent statement. Must only
+        be called if can_reuse() returns True.
+
+        @param parent_scope: the scope to layer the bindings on; see execute()
+
+        """
+        assert self.can_reuse(parent_scope)
+
+        if parent_scope is None:
+            parent_scope = self.get_parent_scope()
+
+        old_scope = self.result_scope
+        self.result_scope = LayeredScope(parent_scope, old_scope.bindings, old_scope.deleted)
+        self.state = Statement.EXECUTE_SUCCESS
+        self.reused = True
+
+    def rebase_result_scope(self):
+        """Layer the result scope on the current result scope of the parent statement
+
+        Used after the statement was executed with a parent_scope other than
+        the scope of the parent statement; see execute().
+
+        """
+        assert self.state == Statement.EXECUTE_SUCCESS
+
+        self.result_scope.rebase(self.get_parent_scope())
+
+    def set_remote_result(self, state, results=None, error_message=None, error_line=None, error_offset=None,
+                          execute_time=None, execute_cpu_time=None):
+        """Set the results of executing the statement in a different process
+
+        Used by L{SubprocessExecutor}. The result scope isn't available in this process.
+
+        """
+        if state == Statement.EXECUTING:
+            self.timed_out = False
+            self.execute_start_time = time.time()
+        else:
+            self.execute_start_time = None
+
+        self.state = state
+        self.execute_time = execute_time
+        self.execute_cpu_time = execute_cpu_time
+        self.reused = False
+        self.restored = False
+        self.memoized = False
+        self.results = results
+        self.result_scope = None
+        self.error_message = error_message
+        self.error_line = error_line
+        self.error_offset = error_offset
+        self.__dependency_values = None
+        self.__dependency_tokens = None
+        self.__mutation_tokens = {}
+        self.__scope_evicted = False
+        self.__result_scope_size = None
+
+    def add_remote_output(self, results):
+        """Add output produced so far by a statement executing in a different process
+
+        Used by L{SubprocessExecutor}.
+
+        """
+        assert self.state == Statement.EXECUTING
+
+        if self.results is None:
+            self.results = []
+        self.results.extend(results)
+
+    def evict_result_scope(self):
+        """Drop the result scope of a statement that executed successfully to save memory
+
+        The result scope will be rebuilt by get_result_scope() when it is next needed,
+        by executing the statement again (and its parents, if their result scopes have
+        also been evicted.)
+
+        """
+        assert self.state == Statement.EXECUTE_SUCCESS
+
+        self.result_scope = None
+        self.__scope_evicted = True
+        self.__result_scope_size = None
+
+    def __rebuild_result_scope(self):
+        # Execute the statement again to recreate an evicted result scope. The
+        # output is discarded, and the results and state of the statement are
+        # left alone
+        parent_scope = self.get_parent_scope()
+        if parent_scope is None:
+            self.__scope_evicted = False
+            return
+
+        if self.snapshot_store is not None:
+            snapshot = self.snapshot_store.lookup(self.snapshot_key, self.__text)
+            if snapshot is not None:
+                _, bindings, deleted = snapshot
+                self.result_scope = LayeredScope(parent_scope, bindings, deleted)
+                self.__scope_evicted = False
+                self.__worksheet.scope_rebuilds += 1
+                return
+
+        scope = flatten_scope(parent_scope)
+        self.__copy_mutated(scope)
+
+        def rebuild_output(*args):
+            if len(args) == 1:
+                if not (args[0] is None or isinstance(args[0], CustomResult) or isinstance(args[0], HelpResult)):
+                    scope['_'] = args[0]
+            else:
+                scope['_'] = args
+
+        output_func = scope.get('reinteract_output')
+        scope['reinteract_output'] = rebuild_output
+
+        capture = StdoutCapture(lambda s: None)
+        capture.push()
+        try:
+            try:
+                exec self.__compiled in scope, scope
+            finally:
+                capture.pop()
+        except KeyboardInterrupt, e:
+            raise e
+        except:
+            _debug("Rebuilding result scope failed", exc_info=True)
+            self.__scope_evicted = False
+            return
+
+        scope['reinteract_output'] = output_func
+
+        self.result_scope = LayeredScope.from_dict(parent_scope, scope, self.__get_bound_names())
+        self.__scope_evicted = False
+        self.__worksheet.scope_rebuilds += 1
+
+    def get_result_scope(self):
+        """Get the result scope of the statement, rebuilding it if it was evicted.
+
+        @returns: the result scope, or None if there is no result scope (or it couldn't be rebuilt)
+
+        """
+        if self.__scope_evicted:
+            _rebuild_lock.acquire()
+            try:
+                if self.__scope_evicted:
+                    self.__rebuild_result_scope()
+            finally:
+                _rebuild_lock.release()
+
+        return self.result_scope
+
+    def get_result_scope_size(self):
+        """Estimate the memory used by the values bound by the statement. See L{scope.estimate_size}
+
+        @returns: the estimated size in bytes; 0 if there is no result scope
+
+        """
+        if self.__result_scope_size is None:
+            if isinstance(self.result_scope, LayeredScope):
+                self.__result_scope_size = self.result_scope.estimate_size()
+            else:
+                self.__result_scope_size = 0
+
+        return self.__result_scope_size
+
+    def mark_for_execute(self, allow_reuse=True):
+        """Mark a statement that executed succesfully as needing execution again
+
+        @param allow_reuse: if False, the results of the last execution won't be reused
+           even if the dependencies of the statement are unchanged. (See can_reuse())
+
+        """
         if self.state != Statement.NEW and self.state != Statement.COMPILE_ERROR:
             self.state = Statement.COMPILE_SUCCESS
+        if not allow_reuse:
+            self.__dependency_values = None
 
 if __name__=='__main__':
     import stdout_capture
@@ -326,6 +938,14 @@ if __name__=='__main__':
     expect_result("print 'a', 'b'", ['a b'])
     expect_result("print 'a\\nb'", ['a','b'])
 
+    # Large values are summarized
+    s = Statement("range(0, 100000)", worksheet)
+    s.compile()
+    s.execute()
+    assert isinstance(s.results[0], ReprResult)
+    assert s.results[0].summary.startswith(u"[0, 1, 2")
+    assert s.results[0].summary.endswith(u"...]")
+
     # Test that we copy a variable before mutating it (when we can detect
     # the mutation)
     s1 = Statement("b = [0]", worksheet)
@@ -344,6 +964,42 @@ if __name__=='__main__':
     s2a.execute()
     assert_equals(s2a.results[0], "0")
 
+    # Copies that take a long time are reported
+    import copy_strategy
+    class Slow(object):
+        pass
+    def copy_slow(obj):
+        time.sleep(COPY_WARNING_TIME)
+        return Slow()
+    copy_strategy.register_copy_strategy(Slow, copy_slow)
+    s4 = Statement("slow.x = 1", worksheet)
+    s4.compile()
+    parent_scope = dict(worksheet.global_scope)
+    parent_scope['slow'] = Slow()
+    s4.execute(parent_scope)
+    assert isinstance(s4.results[0], WarningResult)
+    assert s4.results[0].message.startswith("Copying 'slow' before modifying it took")
+    copy_strategy.register_copy_strategy(Slow, None)
+
+    # Result scopes only store the names that the statement bound
+    assert isinstance(s2.result_scope, LayeredScope)
+    assert_equals(s2.result_scope.bindings.keys(), ['b'])
+    assert_equals(s3.result_scope.bindings.keys(), ['_'])
+    assert_equals(s3.result_scope['b'], [1])
+    assert_equals(s1.result_scope['b'], [0])
+
+    s1 = Statement("c = 1; globals()['d'] = 2; del b", worksheet, parent=s3)
+    s1.compile()
+    s1.execute()
+    assert_equals(sorted(s1.result_scope.bindings.keys()), ['c', 'd'])
+    assert_equals(s1.result_scope.deleted, frozenset(['b']))
+
+    # Completion against a result scope
+    from tokenized_statement import TokenizedStatement
+    ts = TokenizedStatement()
+    ts.set_lines(['c'])
+    assert 'c' in [n for n, _, _ in ts.find_completions(0, 1, s1.result_scope)]
+
     # Tests of catching errors
     s1 = Statement("b = ", worksheet)
     assert_equals(s1.compile(), False)
@@ -364,3 +1020,85 @@ if __name__=='__main__':
 
     s1 = Statement("import  __future__", worksheet) # just a normal import
     assert_equals(s1.future_features, None)
+
+    # Tests of reusing the results of a previous execution. Memoization would
+    # give the same objects when executing a statement again
+    worksheet.memo_cache = None
+    s1 = Statement("a = [1]", worksheet)
+    s1.compile()
+    s1.execute()
+    s2 = Statement("b = 2", worksheet, parent=s1)
+    s2.compile()
+    s2.dependencies = set(s2.reads)
+    s2.execute()
+    s3 = Statement("c = a[0]; c", worksheet, parent=s2)
+    s3.compile()
+    s3.dependencies = set(s3.reads)
+    s3.execute()
+    assert_equals(s3.results, ['1'])
+
+    # Dependencies unchanged: the old results can be reused
+    s2.mark_for_execute()
+    s3.mark_for_execute()
+    assert_equals(s2.can_reuse(), True)
+    s2.reuse()
+    assert_equals(s3.can_reuse(), True)
+    old_results = s3.results
+    s3.reuse()
+    assert s3.results is old_results
+    assert_equals(s3.result_scope['b'], 2)
+    assert_equals(s3.result_scope['c'], 1)
+    assert_equals(s3.result_scope['_'], 1)
+
+    # A dependency changed: must execute again
+    s1.execute()
+    s2.mark_for_execute()
+    s3.mark_for_execute()
+    assert_equals(s2.can_reuse(), True)
+    s2.reuse()
+    assert_equals(s3.can_reuse(), False)
+
+    # Unknown dependencies or explicitly disallowed reuse: must execute again
+    s3.execute()
+    s3.mark_for_execute(allow_reuse=False)
+    assert_equals(s3.can_reuse(), False)
+    s3.execute()
+    s3.dependencies = None
+    s3.mark_for_execute()
+    assert_equals(s3.can_reuse(), False)
+
+    # Tests of memoization: executing again with equal values for the names read
+    from memo_cache import MemoCache
+    worksheet.memo_cache = MemoCache()
+    s1 = Statement("a = [1, 2]", worksheet)
+    s1.compile()
+    s1.execute()
+    s2 = Statement("b = a * 2; print len(b)", worksheet, parent=s1)
+    s2.compile()
+    s2.execute()
+    assert_equals(s2.memoized, False)
+    old_b = s2.result_scope['b']
+
+    s1 = Statement("a = [1] + [2]", worksheet)
+    s1.compile()
+    s1.execute()
+    s2.set_parent(s1)
+    s2.execute()
+    assert_equals(s2.memoized, True)
+    assert s2.result_scope['b'] is old_b
+    assert_equals(s2.results, ['4'])
+
+    s1 = Statement("a = [3]", worksheet)
+    s1.compile()
+    s1.execute()
+    s2.set_parent(s1)
+    s2.execute()
+    assert_equals(s2.memoized, False)
+    assert_equals(s2.results, ['2'])
+
+    # Impure statements are always executed
+    s3 = Statement("c = sorted(a) # impure", worksheet, parent=s1)
+    s3.compile()
+    s3.execute()
+    s3.execute()
+    assert_equals(s3.memoized, False)
@@ -0,0 +1,891 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import cPickle
+import errno
+import gobject
+import logging
+import os
+import signal
+import struct
+import subprocess
+import sys
+import thread
+import time
+import weakref
+
+from notebook import HelpResult
+from statement import Statement, WarningResult
+from thread_executor import add_update_source, check_timeout, publish_output, OUTPUT_INTERVAL
+
+_debug = logging.getLogger("SubprocessExecutor").debug
+
+# How long to wait after asking the worker process to interrupt execution
+# before we kill it
+KILL_TIMEOUT = 2000 # milliseconds
+
+# Command to run the worker process. We need to import this module the same way
+# as the parent process did, so that pickled objects refer to the same classes
+if __name__.rfind('.') >= 0:
+    _WORKER_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    _WORKER_MODULE = __name__[0:__name__.rfind('.')] + '.subprocess_executor'
+else:
+    _WORKER_PATH = os.path.dirname(os.path.abspath(__file__))
+    _WORKER_MODULE = 'subprocess_executor'
+
+_WORKER_COMMAND = "import sys; sys.path.insert(0, %r); from %s import run_worker; run_worker()" % (_WORKER_PATH, _WORKER_MODULE)
+
+######################################################################
+#
+# Messages between the processes are pickled tuples, preceded by their length.
+# We use raw file descriptors, since reads and writes on Python file objects
+# lose data if they are interrupted by a signal.
+#
+
+def _read_bytes(fd, count):
+    chunks = []
+    while count > 0:
+        try:
+            chunk = os.read(fd, count)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if chunk == '':
+            return None
+        chunks.append(chunk)
+        count -= len(chunk)
+
+    return ''.join(chunks)
+
+def _write_bytes(fd, data):
+    while data:
+        try:
+            written = os.write(fd, data)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        data = data[written:]
+
+def _read_message(fd):
+    header = _read_bytes(fd, 4)
+    if header is None:
+        return None
+    data = _read_bytes(fd, struct.unpack("!I", header)[0])
+    if data is None:
+        return None
+
+    return cPickle.loads(data)
+
+def _write_message(fd, message):
+    data = cPickle.dumps(message, cPickle.HIGHEST_PROTOCOL)
+    _write_bytes(fd, struct.pack("!I", len(data)) + data)
+
+def _encode_results(results):
+    # Results are normally unicode strings; anything else we try to pickle, and
+    # if that doesn't work, replace it with a warning
+    if results is None:
+        return None
+
+    encoded = []
+    for result in results:
+        if isinstance(result, basestring):
+            encoded.append(result)
+        elif isinstance(result, WarningResult):
+            encoded.append(('warning', result.message))
+        else:
+            type_name = type(result).__name__
+            if isinstance(result, HelpResult):
+                type_name = 'help'
+            try:
+                encoded.append(('pickle', cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL), type_name))
+            except Exception:
+                encoded.append(('warning', "Can't display %s result from the worker process" % type_name))
+
+    return encoded
+
+def _decode_results(encoded):
+    if encoded is None:
+        return None
+
+    results = []
+    for result in encoded:
+        if isinstance(result, basestring):
+            results.append(result)
+        elif result[0] == 'warning':
+            results.append(WarningResult(result[1]))
+        else:
+            try:
+                results.append(cPickle.loads(result[1]))
+            except Exception:
+                results.append(WarningResult("Can't display %s result from the worker process" % result[2]))
+
+    return results
+
+######################################################################
+
+class SubprocessWorker(object):
+    """Handle to a child process that executes the statements of a worksheet
+
+    The child process is started when first needed, and started again as needed
+    if it exits or is killed. The result scopes of the statements only exist in
+    the child process; when the child process is started again, it recreates them
+    by executing the previous statements again.
+
+    """
+
+    def __init__(self, notebook):
+        """Initialize the SubprocessWorker object
+
+        @param notebook: the notebook that statements are executed in the context of
+
+        """
+        self.notebook = notebook
+
+        #: number of times that the child process was started again after exiting
+        self.restarts = 0
+
+        self.__process = None
+        self.__ids = weakref.WeakKeyDictionary()
+        self.__next_id = 1
+
+        self.__lock = thread.allocate_lock()
+        self.__pending = []
+
+    def get_id(self, statement):
+        """Get an identifier for a statement that is used to refer to it in the child process"""
+
+        try:
+            return self.__ids[statement]
+        except KeyError:
+            id = self.__ids[statement] = self.__next_id
+            self.__next_id += 1
+            return id
+
+    def __ensure_started(self):
+        if self.__process is not None:
+            if self.__process.poll() is None:
+                return
+            self.restarts += 1
+
+        _debug("Starting worker process")
+        self.__process = subprocess.Popen([sys.executable, "-c", _WORKER_COMMAND],
+                                          stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                          close_fds=(sys.platform != 'win32'))
+        _write_message(self.__process.stdin.fileno(), ('init', sys.path, self.notebook.folder))
+
+        # A new process doesn't have any modules loaded
+        self.__lock.acquire()
+        self.__pending = []
+        self.__lock.release()
+
+    def send(self, message):
+        """Send a message to the child process, starting it if necessary"""
+
+        self.__ensure_started()
+
+        self.__lock.acquire()
+        pending = self.__pending
+        self.__pending = []
+        self.__lock.release()
+
+        fd = self.__process.stdin.fileno()
+        for m in pending:
+            _write_message(fd, m)
+        _write_message(fd, message)
+
+    def read(self):
+        """Read a message from the child process
+
+        @returns: the message, or None if the child process exited
+
+        """
+        try:
+            return _read_message(self.__process.stdout.fileno())
+        except (EOFError, cPickle.UnpicklingError, EnvironmentError):
+            # We can't trust anything more from the child process
+            self.kill()
+            return None
+
+    def wait(self):
+        """Wait for the child process to exit after read() returned None
+
+        @returns: the exit status of the child process
+
+        """
+        if self.__process is None:
+            return -1
+
+        return self.__process.wait()
+
+    def module_changed(self, module_name):
+        """Tell the child process to reload a module from the notebook before executing anything else"""
+
+        self.__lock.acquire()
+        if self.__process is not None:
+            self.__pending.append(('module-changed', module_name))
+        self.__lock.release()
+
+    def interrupt(self):
+        """Try to interrupt the child process by sending it SIGINT"""
+
+        if self.__process is None:
+            return
+
+        if sys.platform == 'win32':
+            self.kill()
+        else:
+            try:
+                os.kill(self.__process.pid, signal.SIGINT)
+            except OSError:
+                pass
+
+    def kill(self):
+        """Kill the child process. It will be started again when next needed."""
+
+        if self.__process is None:
+            return
+
+        try:
+            if sys.platform == 'win32':
+                self.__process.terminate()
+            else:
+                os.kill(self.__process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def close(self):
+        """Make the child process exit"""
+
+        if self.__process is None:
+            return
+
+        self.kill()
+        self.__process.wait()
+        self.__process.stdin.close()
+        self.__process.stdout.close()
+        self.__process = None
+
+class SubprocessExecutor(gobject.GObject):
+    """Class to execute Python statements asynchronously in a child process
+
+    SubprocessExecutor has the same interface and signals as L{ThreadExecutor}, but
+    the statements are executed in the child process of a L{SubprocessWorker}. This
+    keeps the user interface responsive during long computations, and means that
+    execution can always be interrupted, and that a crash during execution doesn't
+    affect the rest of the application. The result scopes of the executed
+    statements are not available in this process.
+
+    Signals
+    =======
+     -  B{statement-executing}(executor, statement) emitted when the executor starts processing a statement. There is no guarantee that this signal will be emitted for each processed statement.
+     -  B{statement-output}(executor, statement) emitted every OUTPUT_INTERVAL milliseconds while a statement is executing, if the worker process has sent more results since the last time. statement.results holds the results produced so far.
+     -  B{statement-complete}(executor, statement) emitted when the executor is done with all processing it will do on a statement
+     -  B{statements-complete}(executor, statements) emitted after ::statement-complete has been emitted for a batch of statements, with the list of those statements. Handling this signal rather than ::statement-complete allows updating for many statements at once.
+     -  B{complete}(executor): emitted when the executor is done with all processing
+
+    """
+
+    __gsignals__ = {
+        'statement-executing' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
+        'statement-output' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
+        'statement-complete' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
+        'statements-complete' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
+        'complete' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
+    }
+
+    def __init__(self, worker, parent_statement=None):
+        """Initialize the SubprocessExecutor object
+
+        @param worker: the L{SubprocessWorker} to execute the statements in
+        @param parent_statement: previous statement defining the execution environment for the first statement.
+           Must have been executed by the same worker.
+
+        """
+        gobject.GObject.__init__(self)
+
+        self.worker = worker
+        self.parent_statement = parent_statement
+        self.statements = []
+        self.lock = thread.allocate_lock()
+
+        #: maximum number of times a second to signal progress, or None for no limit
+        self.max_update_rate = None
+        self.last_update_time = 0
+
+        self.idle_id = 0
+        self.kill_id = 0
+        self.output_id = 0
+        self.output_counts = {}
+        self.executing = -1
+        self.last_complete = -1
+        self.last_signalled = -1
+        self.complete = False
+        self.interrupted = False
+        self.escalated = False
+
+    def __run_idle(self):
+        self.lock.acquire()
+        complete = self.complete
+        last_complete = self.last_complete
+        self.idle_id = 0
+        self.lock.release()
+
+        for i in xrange(self.last_signalled + 1, last_complete + 1):
+            self.emit('statement-complete', self.statements[i])
+        if last_complete > self.last_signalled:
+            self.emit('statements-complete', self.statements[self.last_signalled + 1:last_complete + 1])
+
+        self.last_signalled = last_complete
+
+        if complete:
+            if self.kill_id:
+                gobject.source_remove(self.kill_id)
+                self.kill_id = 0
+            if self.output_id:
+                gobject.source_remove(self.output_id)
+                self.output_id = 0
+            self.emit('complete')
+        elif last_complete < len(self.statements) - 1:
+            self.emit('statement-executing', self.statements[last_complete + 1])
+
+        return False
+
+    def __queue_idle(self):
+        # Must be called with the lock held
+        if not self.idle_id:
+            self.idle_id = add_update_source(self, self.__run_idle)
+
+    def __run_output_timeout(self):
+        self.lock.acquire()
+        if self.executing >= 0:
+            statement = self.statements[self.executing]
+        else:
+            statement = None
+        self.lock.release()
+
+        if statement is not None:
+            publish_output(self, statement)
+            check_timeout(self, statement)
+
+        return True
+
+    def __run_thread(self, message):
+        # Sends the statements to the worker process, then waits for the results
+        done = False
+        try:
+            self.worker.send(message)
+            while not done:
+                message = self.worker.read()
+                if message is None:
+                    break
+
+                self.lock.acquire()
+                if message[0] == 'executing':
+                    self.executing = message[1]
+                    self.statements[self.executing].set_remote_result(Statement.EXECUTING)
+                elif message[0] == 'output':
+                    self.statements[message[1]].add_remote_output(_decode_results(message[2]))
+                elif message[0] == 'complete':
+                    i, state, results, error_message, error_line, error_offset, execute_time, execute_cpu_time = message[1:]
+                    self.statements[i].set_remote_result(state, _decode_results(results),
+                                                         error_message, error_line, error_offset,
+                                                         execute_time, execute_cpu_time)
+                    self.last_complete = i
+                    self.executing = -1
+                elif message[0] == 'done':
+                    done = True
+                self.__queue_idle()
+                self.lock.release()
+        except EnvironmentError, e:
+            _debug("Error communicating with worker process: %s", e)
+            self.worker.kill()
+        finally:
+            if not done:
+                status = self.worker.wait()
+
+            self.lock.acquire()
+            if not done and self.executing >= 0:
+                statement = self.statements[self.executing]
+                # The worker process was killed, so we only know the elapsed time
+                execute_time = time.time() - statement.execute_start_time
+                if self.interrupted:
+                    statement.set_remote_result(Statement.INTERRUPTED, execute_time=execute_time)
+                else:
+                    statement.set_remote_result(Statement.EXECUTE_ERROR, None,
+                                                "Worker process exited unexpectedly (status %d)" % status,
+                                                execute_time=execute_time)
+            self.executing = -1
+            self.complete = True
+            self.last_complete = len(self.statements) - 1
+            self.__queue_idle()
+            self.lock.release()
+
+    def add_statement(self, statement):
+        """Add a statement to the list of statements that the executor will execute."""
+
+        self.statements.append(statement)
+
+    def compile(self):
+        """Compile all statements.
+
+        If compilation failed, then all processing for the executor is complete, so
+        ::statement-complete is emitted for each statement, then ::complete is emitted.
+        Otherwise no signals are emitted, until the executor is run using execute()
+
+        @returns: True if all statements compiled successfully
+
+        """
+
+        success = True
+        parent = self.parent_statement
+        for statement in self.statements:
+            statement.set_parent(parent)
+            if not statement.compile():
+                success = False
+            parent = statement
+
+        if not success:
+            for statement in self.statements:
+                self.emit('statement-complete', statement)
+            self.emit('statements-complete', list(self.statements))
+            self.emit('complete')
+
+        return success
+
+    def execute(self):
+        """Execute the statements of the executor asynchronously in the worker process."""
+
+        # The worker process needs the texts of all the previous statements, in case
+        # it has to recreate their result scopes
+        context = []
+        parent = self.parent_statement
+        while parent is not None:
+            context.append((self.worker.get_id(parent), parent.get_text()))
+            parent = parent.get_parent()
+        context.reverse()
+
+        requests = []
+        for statement in self.statements:
+            dependencies = statement.dependencies
+            if dependencies is not None:
+                dependencies = list(dependencies)
+            requests.append((self.worker.get_id(statement), statement.get_text(), dependencies))
+
+        self.output_id = gobject.timeout_add(OUTPUT_INTERVAL, self.__run_output_timeout)
+        thread.start_new_thread(self.__run_thread, (('execute', context, requests),))
+
+    def __on_kill_timeout(self):
+        self.kill_id = 0
+        self.worker.kill()
+
+        return False
+
+    def interrupt(self):
+        """Interrupts the execution of the executor.
+
+        Sends SIGINT to the worker process. If that doesn't interrupt execution
+        within KILL_TIMEOUT milliseconds, for example because the worker process
+        is stuck in native code, the worker process is killed. It will be started
+        again for the next execution.
+
+        Once the execution is interrupted, execution finishes as per normal
+        by emitting the ::statement-complete and ::complete signals, except that
+        the state of the interrupted statement will be Statement.INTERRUPTED,
+        and subsequence statements will have a state of Statement.COMPILE_SUCCESS.
+
+        Calling interrupt() more than once will have no effect.
+
+        """
+
+        self.lock.acquire()
+        if not self.complete and not self.interrupted:
+            self.interrupted = True
+            self.worker.interrupt()
+            self.kill_id = gobject.timeout_add(KILL_TIMEOUT, self.__on_kill_timeout)
+        self.lock.release()
+
+    def escalate_interrupt(self):
+        """Try harder to stop execution after interrupt() didn't stop it.
+
+        Kills the worker process right away, rather than waiting for the rest
+        of KILL_TIMEOUT.
+
+        """
+        self.lock.acquire()
+        if not self.complete and self.interrupted:
+            _debug("Killing worker process after timeout")
+            if self.kill_id:
+                gobject.source_remove(self.kill_id)
+                self.kill_id = 0
+            self.worker.kill()
+        self.lock.release()
+
+######################################################################
+#
+# The child process
+#
+
+class _Worker(object):
+    def __init__(self, out_fd, folder):
+        # Imported here to avoid a circular import
+        from notebook import Notebook
+        from worksheet import Worksheet
+
+        self.out_fd = out_fd
+        self.notebook = Notebook(folder)
+        self.worksheet = Worksheet(self.notebook)
+
+        # Maps id => (text, statement) for the statements we have result scopes for
+        self.statements = {}
+
+        self.executing = False
+        self.interrupted = False
+
+        # The output thread sends the output of the statement being executed
+        # while it executes; the lock protects the fields below, and is held
+        # while sending output, so that output for a statement can't be sent
+        # after the statement is complete
+        self.__output_lock = thread.allocate_lock()
+        # (index in the request, statement) being executed, or None
+        self.__output_statement = None
+        # Number of results of that statement sent so far
+        self.__output_sent = 0
+        thread.start_new_thread(self.__run_output_thread, ())
+
+    def __set_output_statement(self, output_statement):
+        self.__output_lock.acquire()
+        self.__output_statement = output_statement
+        self.__output_sent = 0
+        self.__output_lock.release()
+
+    def __run_output_thread(self):
+        while True:
+            time.sleep(OUTPUT_INTERVAL / 1000.)
+
+            self.__output_lock.acquire()
+            try:
+                if self.__output_statement is not None:
+                    i, statement = self.__output_statement
+                    results = statement.results
+                    if results is not None and len(results) > self.__output_sent:
+                        new_results = results[self.__output_sent:]
+                        self.__output_sent += len(new_results)
+                        self.__send(('output', i, _encode_results(new_results)))
+            finally:
+                self.__output_lock.release()
+
+    def on_sigint(self, signum, frame):
+        self.interrupted = True
+        if self.executing:
+            raise KeyboardInterrupt()
+
+    def __send(self, message):
+        _write_message(self.out_fd, message)
+
+    def __send_complete(self, i, statement):
+        self.__send(('complete', i, statement.state, _encode_results(statement.results),
+                     statement.error_message, statement.error_line, statement.error_offset,
+                     statement.execute_time, statement.execute_cpu_time))
+
+    def __run(self, statement, index=None):
+        # See the comments in ThreadExecutor.__run_thread(); here SIGINT plays the part
+        # of the asynchronous exception, and it only raises KeyboardInterrupt when
+        # self.executing is set. If index is not None, output is sent while executing
+        statement.before_execute()
+        if index is not None:
+            self.__set_output_statement((index, statement))
+        try:
+            try:
+                self.executing = True
+                if not self.interrupted:
+                    statement.execute()
+                self.executing = False
+            except KeyboardInterrupt:
+                self.executing = False
+        finally:
+            statement.after_execute()
+            if index is not None:
+                self.__set_output_statement(None)
+
+        return statement.state == Statement.EXECUTE_SUCCESS
+
+    def execute(self, context, requests):
+        self.interrupted = False
+        statements = {}
+
+        # Make sure that we have the result scopes of the previous statements, executing
+        # them again if the process was restarted or they changed
+        parent = None
+        valid = True
+        for id, text in context:
+            if valid and id in self.statements:
+                old_text, statement = self.statements[id]
+                valid = (old_text == text and statement.get_parent() is parent and
+                         statement.state == Statement.EXECUTE_SUCCESS)
+            else:
+                valid = False
+
+            if not valid:
+                statement = Statement(text, self.worksheet, parent)
+                if not (statement.compile() and self.__run(statement)):
+                    if statement.state == Statement.INTERRUPTED:
+                        state = Statement.INTERRUPTED
+                    else:
+                        state = Statement.EXECUTE_ERROR
+                    self.__send(('complete', 0, state, None, "Can't recreate the result of a previous statement", None, None, None, None))
+                    self.statements = statements
+                    return
+
+            statements[id] = (text, statement)
+            parent = statement
+
+        for i, (id, text, dependencies) in enumerate(requests):
+            if id in self.statements and self.statements[id][0] == text:
+                statement = self.statements[id][1]
+                statement.set_parent(parent)
+                statement.mark_for_execute()
+            else:
+                statement = Statement(text, self.worksheet, parent)
+            statements[id] = (text, statement)
+
+            if not statement.compile():
+                self.__send_complete(i, statement)
+                break
+
+            if dependencies is not None:
+                statement.dependencies = set(dependencies)
+            else:
+                statement.dependencies = None
+
+            if statement.can_reuse():
+                statement.reuse()
+            else:
+                self.__send(('executing', i))
+                self.__run(statement, i)
+
+            self.__send_complete(i, statement)
+            if statement.state != Statement.EXECUTE_SUCCESS:
+                break
+
+            parent = statement
+
+        self.statements = statements
+
+    def module_changed(self, module_name):
+        self.notebook.reset_module(module_name)
+
+        # Our statements don't know what to reexecute, so don't reuse any results
+        for _, statement in self.statements.itervalues():
+            statement.mark_for_execute(allow_reuse=False)
+
+    def handle(self, message):
+        if message[0] == 'execute':
+            self.execute(message[1], message[2])
+            self.__send(('done',))
+        elif message[0] == 'module-changed':
+            self.module_changed(message[1])
+
+def run_worker():
+    """Run the worker process. See SubprocessWorker"""
+
+    # Keep the pipes to the parent process for ourselves, and redirect the file descriptors
+    # for standard input and output so that other code can't interfere with them
+    in_fd = os.dup(0)
+    out_fd = os.dup(1)
+    null_fd = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null_fd, 0)
+    os.close(null_fd)
+    os.dup2(2, 1)
+
+    import stdout_capture
+    stdout_capture.init()
+
+    message = _read_message(in_fd)
+    if message is None:
+        return
+
+    _, path, folder = message
+    sys.path[:] = path
+
+    worker = _Worker(out_fd, folder)
+    signal.signal(signal.SIGINT, worker.on_sigint)
+
+    while True:
+        try:
+            message = _read_message(in_fd)
+            if message is None:
+                break
+            worker.handle(message)
+        except KeyboardInterrupt:
+            # An interrupt that arrived just as execution finished
+            pass
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    gobject.threads_init()
+
+    import stdout_capture
+    stdout_capture.init()
+
+    from notebook import Notebook
+    from test_utils import assert_equals
+    from worksheet import Worksheet
+
+    notebook = Notebook()
+    worksheet = Worksheet(notebook)
+    worker = SubprocessWorker(notebook)
+
+    def test_execute(statements, parent=None, interrupt_after=None, timeout=None):
+        executor = SubprocessExecutor(worker, parent)
+
+        for s, expected_state, expected_results in statements:
+            statement = Statement(s, worksheet)
+            statement.timeout = timeout
+            statement._expected_state = expected_state
+            statement._expected_results = expected_results
+            statement._got_output = []
+            executor.add_statement(statement)
+
+        loop = gobject.MainLoop()
+
+        def on_statement_output(executor, statement):
+            statement._got_output.append(list(statement.results))
+
+        def on_statement_complete(executor, statement):
+            statement._got_state = statement.state
+            statement._got_results = statement.results
+            if statement.results is not None:
+                statement._got_results = [isinstance(r, WarningResult) and r.message or r for r in statement.results]
+
+        def on_complete(executor):
+            loop.quit()
+
+        def interrupt():
+            executor.interrupt()
+
+        global timed_out
+        timed_out = False
+        def timeout():
+            global timed_out
+            timed_out = True
+            loop.quit()
+
+        executor.connect('statement-output', on_statement_output)
+        executor.connect('statement-complete', on_statement_complete)
+        executor.connect('complete', on_complete)
+
+        if executor.compile():
+            executor.execute()
+            if interrupt_after is not None:
+                interrupt_source = gobject.timeout_add(interrupt_after, interrupt)
+            timeout_source = gobject.timeout_add(KILL_TIMEOUT + 5000, timeout)
+            loop.run()
+            if timed_out:
+                raise AssertionError("SubprocessExecutor timed out")
+            if interrupt_after is not None:
+                gobject.source_remove(interrupt_source)
+            gobject.source_remove(timeout_source)
+
+        for s in executor.statements:
+            assert_equals(s._got_state, s._expected_state)
+            assert_equals(s._got_results, s._expected_results)
+
+        return executor.statements
+
+    test_execute(
+        [
+            ("a = 1", Statement.COMPILE_SUCCESS, None),
+            ("a =", Statement.COMPILE_ERROR, None)
+        ])
+
+    s1, s2 = test_execute(
+        [
+            ("a = 1", Statement.EXECUTE_SUCCESS, []),
+            ("print a; a", Statement.EXECUTE_SUCCESS, ['1', '1'])
+        ])
+    assert_equals(s2.result_scope, None)
+
+    test_execute(
+        [
+            ("a = 1", Statement.EXECUTE_SUCCESS, []),
+            ("b", Statement.EXECUTE_ERROR, None),
+            ("c = 2", Statement.COMPILE_SUCCESS, None)
+        ])
+
+    # Continuing from a previous statement; results that can't be pickled
+    test_execute(
+        [
+            ("a += 1; a", Statement.EXECUTE_SUCCESS, ['2']),
+            ("help(lambda x: x)", Statement.EXECUTE_SUCCESS, ["Can't display help result from the worker process"])
+        ], parent=s2)
+
+    # Interrupting straight python code
+    test_execute(
+        [
+            ("y = 1", Statement.EXECUTE_SUCCESS, []),
+            ("for x in xrange(0,100000000): y = y* 2", Statement.INTERRUPTED, None),
+            ("z = 1", Statement.COMPILE_SUCCESS, None)
+        ], interrupt_after=500)
+    assert_equals(worker.restarts, 0)
+
+    # If SIGINT doesn't work, the worker process is killed and started again
+    test_execute(
+        [
+            ("import signal; _ = signal.signal(signal.SIGINT, signal.SIG_IGN)", Statement.EXECUTE_SUCCESS, []),
+            ("while True: pass", Statement.INTERRUPTED, None),
+        ], interrupt_after=500)
+    test_execute(
+        [
+            ("a", Statement.EXECUTE_SUCCESS, ['1'])
+        ], parent=s1)
+    assert_equals(worker.restarts, 1)
+
+    # A crash of the worker process
+    test_execute(
+        [
+            ("import os; os._exit(3)", Statement.EXECUTE_ERROR, None),
+        ])
+    test_execute(
+        [
+            ("a = 1", Statement.EXECUTE_SUCCESS, []),
+        ])
+    assert_equals(worker.restarts, 2)
+
+    # A statement that times out and ignores SIGINT is killed after TIMEOUT_GRACE
+    import thread_executor
+    thread_executor.TIMEOUT_GRACE = 200
+    start = time.time()
+    s1, s2 = test_execute(
+        [
+            ("import signal; _ = signal.signal(signal.SIGINT, signal.SIG_IGN)", Statement.EXECUTE_SUCCESS, []),
+            ("while True: pass", Statement.INTERRUPTED, None),
+        ], timeout=0.2)
+    assert time.time() - start < KILL_TIMEOUT / 1000.
+    assert s2.timed_out
+    assert s2.execute_time >= 0.2
+
+    # Output is sent while the statement is executing
+    s1, s2 = test_execute(
+        [
+            ("import time", Statement.EXECUTE_SUCCESS, []),
+            ("for i in xrange(0, 3):\n    print i\n    time.sleep(0.3)", Statement.EXECUTE_SUCCESS, ['0', '1', '2']),
+        ])
+    assert_equals(s2._got_output[0], ['0'])
+    assert_equals(s2._got_output[-1], ['0', '1', '2'])
+
+    worker.close()
+
+    # Executing a worksheet in a worker process
+    worksheet.execute_in_subprocess = True
+    worksheet.insert(0, 0, "a = 1\nprint a + 1")
+    worksheet.calculate(wait=True)
+    assert_equals([chunk.results for chunk in worksheet.iterate_chunks()], [[], ['2']])
+    worksheet.close()
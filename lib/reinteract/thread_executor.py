@@ -9,12 +9,23 @@
 
 import ctypes
 import gobject
+import logging
 import signal
 import sys
 import thread
+import time
 
 from statement import Statement
 
+_debug = logging.getLogger("ThreadExecutor").debug
+
+# How often output produced so far by an executing statement is published
+OUTPUT_INTERVAL = 100 # milliseconds
+
+# How long a statement that timed out may go on executing after it was interrupted
+# before we try harder to stop it; see check_timeout()
+TIMEOUT_GRACE = 2000 # milliseconds
+
 #
 # The primary means we use to interrupt a running thread is a Python facility
 # to set an exception asynchronously on another thread. To keep it out of
@@ -22,6 +33,7 @@ from statement import Statement
 # through pthreads.
 #
 _PyThreadState_SetAsyncExc = ctypes.pythonapi.PyThreadState_SetAsyncExc
+_PyThreadState_SetAsyncExc.argtypes = [ctypes.c_long, ctypes.py_object]
 
 #
 # _PyThreadState_SetAsyncExc won't immediately wake up a thread that is blocking
@@ -51,6 +63,8 @@ else:
         _pthreads_dll = ctypes.CDLL("libpthread.so.0")
     
     _pthread_kill = _pthreads_dll.pthread_kill
+    # pthread_t is pointer-sized; without this, ctypes truncates thread IDs to an int
+    _pthread_kill.argtypes = [ctypes.c_ulong, ctypes.c_int]
 
 if _pthread_kill is not None:
     def _ignore_handler(signum, frame):
@@ -58,20 +72,106 @@ if _pthread_kill is not None:
 
     signal.signal(signal.SIGUSR1, _ignore_handler)
 
+def interrupt_thread(tid):
+    """Raise KeyboardInterrupt asynchronously in another thread
+
+    An attempt is made to wake the thread up if it is blocking in a system call.
+    See ThreadExecutor.interrupt() for the limitations.
+
+    @param tid: the thread to interrupt, as returned by thread.start_new_thread() or thread.get_ident()
+
+    """
+    _PyThreadState_SetAsyncExc(tid, KeyboardInterrupt)
+    if _pthread_kill is not None:
+        _pthread_kill(tid, signal.SIGUSR1)
+
+def publish_output(executor, statement):
+    """Emit ::statement-output on an executor if an executing statement has produced
+    results since the last time. The number of results published for each statement is
+    tracked in executor.output_counts.
+
+    Shared by the executor classes. Must be called from the main thread, without
+    the lock of the executor held.
+
+    """
+    # The executing thread appends to statement.results, or replaces it with None
+    # if execution fails, so we only look at it once
+    results = statement.results
+    if statement.state != Statement.EXECUTING or results is None:
+        return
+
+    count = len(results)
+    if count > executor.output_counts.get(statement, 0):
+        executor.output_counts[statement] = count
+        executor.emit('statement-output', statement)
+
+def check_timeout(executor, statement):
+    """Interrupt an executor if an executing statement has run for longer than
+    statement.timeout. The statement is marked as timed out. If it is still executing
+    TIMEOUT_GRACE milliseconds later, executor.escalate_interrupt() is called, once.
+
+    Shared by the executor classes. Must be called from the main thread, without
+    the lock of the executor held.
+
+    """
+    timeout = statement.timeout
+    start_time = statement.execute_start_time
+    if timeout is None or start_time is None or statement.state != Statement.EXECUTING:
+        return
+
+    elapsed = time.time() - start_time
+    if elapsed < timeout:
+        return
+
+    if not statement.timed_out:
+        # If the user already interrupted execution, the statement didn't time out
+        if not executor.interrupted:
+            _debug("Statement timed out after %g seconds", timeout)
+            statement.timed_out = True
+            executor.interrupt()
+    elif elapsed >= timeout + TIMEOUT_GRACE / 1000. and not executor.escalated:
+        executor.escalated = True
+        executor.escalate_interrupt()
+
+def add_update_source(executor, callback):
+    """Arrange for callback to be called from the main loop to signal the progress
+    of an executor, no sooner than executor.max_update_rate allows. When statements
+    complete faster than that, the signals for them are batched together.
+
+    Shared by the executor classes. May be called from any thread.
+
+    @returns: the ID of the main loop source
+
+    """
+    def run():
+        executor.last_update_time = time.time()
+        return callback()
+
+    if executor.max_update_rate:
+        delay = executor.last_update_time + 1. / executor.max_update_rate - time.time()
+        if delay > 0:
+            return gobject.timeout_add(int(delay * 1000), run)
+
+    return gobject.idle_add(run)
+
 class ThreadExecutor(gobject.GObject):
     """Class to execute Python statements asynchronously in a thread
 
     Signals
     =======
      -  B{statement-executing}(executor, statement) emitted when the executor starts processing a statement. There is no guarantee that this signal will be emitted for each processed statement.
+     -  B{statement-output}(executor, statement) emitted every OUTPUT_INTERVAL milliseconds while a statement is executing, if it has produced more results since the last time. statement.results holds the results produced so far.
      -  B{statement-complete}(executor, statement) emitted when the executor is done with all processing it will do on a statement
+     -  B{statements-complete}(executor, statements) emitted after ::statement-complete has been emitted for a batch of statements, with the list of those statements. Handling this signal rather than ::statement-complete allows updating for many statements at once.
      -  B{complete}(executor): emitted when the executor is done with all processing
 
     """
 
     __gsignals__ = {
         'statement-executing' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
+        'statement-output' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
         'statement-complete' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
+        'statements-complete' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
         'complete' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
     }
 
@@ -87,11 +187,18 @@ class ThreadExecutor(gobject.GObject):
         self.statements = []
         self.lock = thread.allocate_lock()
 
+        #: maximum number of times a second to signal progress, or None for no limit
+        self.max_update_rate = None
+        self.last_update_time = 0
+
         self.idle_id = 0
+        self.output_id = 0
+        self.output_counts = {}
         self.last_complete = -1
         self.last_signalled = -1
         self.complete = False
         self.interrupted = False
+        self.escalated = False
 
     def __run_idle(self):
         self.lock.acquire()
@@ -102,10 +209,15 @@ class ThreadExecutor(gobject.GObject):
 
         for i in xrange(self.last_signalled + 1, last_complete + 1):
             self.emit('statement-complete', self.statements[i])
+        if last_complete > self.last_signalled:
+            self.emit('statements-complete', self.statements[self.last_signalled + 1:last_complete + 1])
 
         self.last_signalled = last_complete
 
         if self.complete:
+            if self.output_id:
+                gobject.source_remove(self.output_id)
+                self.output_id = 0
             self.emit('complete')
         elif last_complete < len(self.statements) - 1:
             self.emit('statement-executing', self.statements[last_complete + 1])
@@ -115,7 +227,21 @@ class ThreadExecutor(gobject.GObject):
     def __queue_idle(self):
         # Must be called with the lock held
         if not self.idle_id:
-            self.idle_id = gobject.idle_add(self.__run_idle)
+            self.idle_id = add_update_source(self, self.__run_idle)
+
+    def __run_output_timeout(self):
+        self.lock.acquire()
+        if self.last_complete < len(self.statements) - 1:
+            statement = self.statements[self.last_complete + 1]
+        else:
+            statement = None
+        self.lock.release()
+
+        if statement is not None:
+            publish_output(self, statement)
+            check_timeout(self, statement)
+
+        return True
 
     def __run_thread(self):
         # The patten used twice here of:
@@ -135,8 +261,22 @@ class ThreadExecutor(gobject.GObject):
         #
         statement = None
         try:
+            # If the result scope of the parent statement was evicted, rebuilding it
+            # executes code, so do that up front rather than with the lock held
+            if self.parent_statement is not None:
+                self.parent_statement.get_result_scope()
+
             for i, statement in enumerate(self.statements):
                 self.lock.acquire()
+                # If nothing the statement depends on has changed, we can skip
+                # executing it and just rebase the old results
+                if statement.can_reuse():
+                    statement.reuse()
+                    self.last_complete = i
+                    self.__queue_idle()
+                    self.lock.release()
+                    continue
+
                 statement.before_execute()
                 self.__queue_idle()
                 try:
@@ -194,12 +334,14 @@ class ThreadExecutor(gobject.GObject):
         if not success:
             for statement in self.statements:
                 self.emit('statement-complete', statement)
+            self.emit('statements-complete', list(self.statements))
             self.emit('complete')
 
         return success
 
     def execute(self):
         """Execute the statements of the executor asynchronously in a thread."""
+        self.output_id = gobject.timeout_add(OUTPUT_INTERVAL, self.__run_output_timeout)
         self.tid = thread.start_new_thread(self.__run_thread, ())
 
     def interrupt(self):
@@ -224,11 +366,20 @@ class ThreadExecutor(gobject.GObject):
         self.lock.acquire()
         if not self.complete and not self.interrupted:
             self.interrupted = True
-            _PyThreadState_SetAsyncExc(self.tid, ctypes.py_object(KeyboardInterrupt))
-            if _pthread_kill is not None:
-                _pthread_kill(self.tid, signal.SIGUSR1)
+            interrupt_thread(self.tid)
         self.lock.release()
 
+    def escalate_interrupt(self):
+        """Try harder to stop execution after interrupt() didn't stop it.
+
+        Called when a statement that timed out goes on executing. There is no safe
+        way to stop a thread, and sending KeyboardInterrupt again would break the
+        locking in the executing thread, so this does nothing beyond logging;
+        the statement will be interrupted if it ever returns to Python code.
+
+        """
+        _debug("Statement still executing after being interrupted; can't stop a thread")
+
 ######################################################################
 
 if __name__ == '__main__': #pragma: no cover
@@ -325,6 +476,37 @@ if __name__ == '__main__': #pragma: no cover
             ("c = 2", Statement.COMPILE_SUCCESS, None)
         ])
 
+    # With a maximum update rate, statements that complete quickly are signalled in batches
+    executor = ThreadExecutor()
+    executor.max_update_rate = 10
+    for i in xrange(0, 100):
+        executor.add_statement(Statement("a%d = %d" % (i, i), worksheet))
+    batches = []
+    loop = gobject.MainLoop()
+    executor.connect('statements-complete', lambda executor, statements: batches.append(statements))
+    executor.connect('complete', lambda executor: loop.quit())
+    executor.compile()
+    executor.execute()
+    loop.run()
+    assert_equals(sum(batches, []), executor.statements)
+    assert len(batches) < 10
+
+    # A statement that takes longer than its timeout is interrupted
+    executor = ThreadExecutor()
+    statement = Statement("while True: pass", worksheet)
+    statement.timeout = 0.2
+    executor.add_statement(statement)
+    loop = gobject.MainLoop()
+    executor.connect('complete', lambda executor: loop.quit())
+    timeout_source = gobject.timeout_add(5000, loop.quit)
+    executor.compile()
+    executor.execute()
+    loop.run()
+    gobject.source_remove(timeout_source)
+    assert_equals(statement.state, Statement.INTERRUPTED)
+    assert statement.timed_out
+    assert statement.execute_time >= 0.2
+
     # Test interrupting straight python code
     test_execute(
         [
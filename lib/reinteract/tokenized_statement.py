@@ -92,8 +92,43 @@ class _TokenIter(object):
 class TokenizedStatement(object):
     def __init__(self):
         self.lines = []
-        self.tokens = []
-        self.stacks = []
+        self.__tokens = []
+        self.__stacks = []
+        # If True, self.lines haven't been tokenized yet
+        self.__pending = False
+
+    def __tokenize_pending(self):
+        if not self.__pending:
+            return
+
+        self.__pending = False
+        tokens = self.__tokens = [None] * len(self.lines)
+        stacks = self.__stacks = [None] * len(self.lines)
+        stack = []
+        for i, line in enumerate(self.lines):
+            tokens[i], stack = tokenize_line(line, stack)
+            stacks[i] = stack
+
+    def __get_tokens(self):
+        self.__tokenize_pending()
+        return self.__tokens
+
+    #: list with the tokens of each line
+    tokens = property(__get_tokens)
+
+    def __get_stacks(self):
+        self.__tokenize_pending()
+        return self.__stacks
+
+    #: list with the stack of open brackets and strings at the end of each line
+    stacks = property(__get_stacks)
+
+    def is_tokenized(self):
+        """Return True if the lines have been tokenized. Lines that are set
+        when there were no lines before are only tokenized when the tokens
+        are first needed."""
+
+        return not self.__pending
 
     def set_lines(self, lines):
         """Set the lines in the Tokenized statement
@@ -104,7 +139,15 @@ class TokenizedStatement(object):
         added or changed.
 
         """
-        
+
+        if len(self.lines) == 0:
+            # Everything is new; tokenizing is put off until the tokens are needed
+            if len(lines) == 0:
+                return None
+            self.lines = lines
+            self.__pending = True
+            return (0, len(lines))
+
         # We want to avoid retokenizing everything on pure insertions
         # to make editing not egregiously O(n^2); we don't care much
         # if we have to retokenize on other cases.
@@ -114,8 +157,8 @@ class TokenizedStatement(object):
         old_stacks = self.stacks
 
         self.lines = lines
-        tokens = self.tokens = [None] * len(lines)
-        stacks = self.stacks = [None] * len(lines)
+        tokens = self.__tokens = [None] * len(lines)
+        stacks = self.__stacks = [None] * len(lines)
 
         # Iterate forward, find an unchanged segment of lines at the front
 
@@ -651,6 +694,19 @@ if __name__ == '__main__':
 
     assert ts.set_lines(['((1 + 2', '+ 3 + 4)']) == (-1, -1) # truncation
 
+    # Tokenizing a new statement is put off until the tokens are needed
+    ts = TokenizedStatement()
+    assert ts.set_lines(['(1 + 2','+ 3 + 4)']) == (0, 2)
+    assert not ts.is_tokenized()
+    expect(ts, [['(', '1', '+', '2', ['(']], ['+', '3', '+', '4', ')']])
+    assert ts.is_tokenized()
+
+    # Changing the lines before then tokenizes the old lines, to find what changed
+    ts = TokenizedStatement()
+    ts.set_lines(['(1 + 2','+ 3 + 4)'])
+    assert ts.set_lines(['(1 + 2','+ 5 + 6)']) == (1, 2)
+    assert ts.is_tokenized()
+
     ### Tests of iterator functionality
     
     ts = TokenizedStatement()
@@ -6,7 +6,12 @@
 #
 ########################################################################
 
+import logging
 import re
+import tempfile
+import zlib
+
+_debug = logging.getLogger("UndoStack").debug
 
 # Two consecutive inserts are merged together if the sum of the
 # two matches this. The (?!\n) is to defeat the normal regular
@@ -14,12 +19,90 @@ import re
 # before the last newline in the string
 COALESCE_RE = re.compile(r'^\S+ *(?!\n)$')
 
+# Same as worksheet.NEW_LINE_RE
+_NEW_LINE_RE = re.compile(r'\n|\r|\r\n')
+
+# Default for UndoStack.max_memory
+DEFAULT_MAX_MEMORY = 4 * 1024 * 1024
+
+def _end_position(start, text):
+    # Position at the end of text inserted at start
+    line, offset = start
+    last = 0
+    for m in _NEW_LINE_RE.finditer(text):
+        line += 1
+        offset = 0
+        last = m.end()
+
+    return (line, offset + len(text) - last)
+
+class _Journal(object):
+    # Temporary file holding the text of operations spilled out of memory. Each
+    # text is compressed separately, so it can be read back on its own. The file
+    # only grows, until the undo stack is cleared.
+
+    def __init__(self):
+        self.__file = tempfile.TemporaryFile(prefix="reinteract-undo")
+        self.__length = 0
+
+    def write(self, text):
+        if isinstance(text, unicode):
+            data = zlib.compress(text.encode("utf8"), 1)
+        else:
+            data = zlib.compress(text, 1)
+
+        self.__file.seek(self.__length)
+        self.__file.write(data)
+        self.__file.flush()
+
+        offset = self.__length
+        self.__length += len(data)
+
+        return offset, len(data)
+
+    def read(self, offset, length, is_unicode):
+        self.__file.seek(offset)
+        text = zlib.decompress(self.__file.read(length))
+        if is_unicode:
+            text = text.decode("utf8")
+
+        return text
+
+    def close(self):
+        self.__file.close()
+
 class _InsertDeleteOp(object):
     def __init__(self, start, end, text):
         self.start = start
         self.end = end
         self.text = text
 
+    def __get_text(self):
+        if self.__text is None:
+            journal, offset, length, is_unicode = self.__spilled
+            return journal.read(offset, length, is_unicode)
+        else:
+            return self.__text
+
+    def __set_text(self, text):
+        self.__text = text
+        self.__spilled = None
+
+    text = property(__get_text, __set_text)
+
+    def _get_size(self):
+        # The amount of text held in memory
+        if self.__text is None:
+            return 0
+        else:
+            return len(self.__text)
+
+    def _spill(self, journal):
+        # Move the text into the journal; raises IOError if writing fails
+        offset, length = journal.write(self.__text)
+        self.__spilled = (journal, offset, length, isinstance(self.__text, unicode))
+        self.__text = None
+
     def _insert(self, worksheet):
         worksheet.begin_user_action()
         worksheet.insert(self.start[0], self.start[1], self.text)
@@ -60,9 +143,54 @@ class EndActionOp(object):
     def __repr__(self):
         return "EndActionOp()"
     
+def _compact_ops(ops):
+    # Merge consecutive operations of a user action where they continue each
+    # other, so that typing or deleting a run of text is a single operation.
+    # Undoing and redoing the result does exactly the same as the original ops.
+    result = []
+    for op in ops:
+        if result:
+            prev = result[-1]
+            if isinstance(op, InsertOp) and isinstance(prev, InsertOp) and op.start == prev.end:
+                result[-1] = InsertOp(prev.start, op.end, prev.text + op.text)
+                continue
+            elif isinstance(op, DeleteOp) and isinstance(prev, DeleteOp):
+                if op.end == prev.start: # Deleting backwards
+                    result[-1] = DeleteOp(op.start, prev.end, op.text + prev.text)
+                    continue
+                elif op.start == prev.start: # Deleting forwards
+                    text = prev.text + op.text
+                    result[-1] = DeleteOp(prev.start, _end_position(prev.start, text), text)
+                    continue
+
+        result.append(op)
+
+    return result
+
 class UndoStack(object):
-    def __init__(self, worksheet):
+    """
+    The UndoStack class records the changes made to a worksheet, so they can be undone
+    and redone.
+
+    To bound the memory used by a long editing session, the operations of a user
+    action are merged together where possible when the action ends, and when the
+    total length of the text held by the operations goes over max_memory, the text of
+    the oldest operations is moved to a temporary file, and read back when they are
+    undone or redone.
+
+    """
+
+    def __init__(self, worksheet, max_memory=DEFAULT_MAX_MEMORY):
+        """Initialize the UndoStack object
+
+        @param worksheet: the worksheet to undo and redo changes in
+        @param max_memory: the number of characters of text to keep in memory before
+           moving the oldest operations to disk, or None to keep everything in memory.
+           Can be changed later by setting the max_memory attribute.
+
+        """
         self.__worksheet = worksheet
+        self.max_memory = max_memory
         self.__position = 0
         # The position at which we last pruned the stack; everything after
         # this has been inserted consecutively without any intervening
@@ -72,6 +200,12 @@ class UndoStack(object):
         self.__applying_undo = False
         self.__user_action_count = 0
         self.__action_ops = 0
+        # Amount of text held in memory by the ops in the stack
+        self.__memory = 0
+        # Ops before this position have been spilled to the journal
+        self.__spill_position = 0
+        self.__journal = None
+        self.__journal_failed = False
 
     def undo(self):
         if self.__position == 0:
@@ -117,29 +251,64 @@ class UndoStack(object):
         cur = self.__stack[-1]
         prev = self.__stack[-2]
         if isinstance(cur, InsertOp) and isinstance(prev, InsertOp) and \
+                prev._get_size() > 0 and \
                 cur.start == prev.end and COALESCE_RE.match(prev.text + cur.text):
             prev.end = cur.end
             prev.text += cur.text
             self.__stack.pop()
             self.__position -= 1
-            
+
+    def __compact_action(self):
+        start = len(self.__stack) - self.__action_ops
+        ops = _compact_ops(self.__stack[start:])
+        self.__stack[start:] = ops
+        self.__position = len(self.__stack)
+        self.__action_ops = len(ops)
+
+    def __limit_memory(self):
+        if self.max_memory is None or self.__journal_failed:
+            return
+
+        # The last op is kept in memory, since it may still be coalesced
+        while self.__memory > self.max_memory and self.__spill_position < len(self.__stack) - 1:
+            op = self.__stack[self.__spill_position]
+            size = isinstance(op, _InsertDeleteOp) and op._get_size()
+            if size:
+                try:
+                    if self.__journal is None:
+                        self.__journal = _Journal()
+                    op._spill(self.__journal)
+                except (IOError, OSError), e:
+                    _debug("Can't write undo journal, keeping everything in memory: %s", e)
+                    self.__journal_failed = True
+                    return
+                self.__memory -= size
+
+            self.__spill_position += 1
+
     def append_op(self, op):
         if self.__applying_undo:
             return
 
         if self.__position < len(self.__stack):
             assert self.__action_ops == 0
+            for old in self.__stack[self.__position:]:
+                if isinstance(old, _InsertDeleteOp):
+                    self.__memory -= old._get_size()
             self.__stack[self.__position:] = []
             self.__prune_position = self.__position
+            self.__spill_position = min(self.__spill_position, self.__position)
 
         self.__stack.append(op)
         self.__position += 1
-        
+        self.__memory += op._get_size()
+
         if self.__user_action_count > 0:
             self.__action_ops += 1
         else:
             self.__check_coalesce()
-        
+            self.__limit_memory()
+
     def begin_user_action(self):
         self.__user_action_count += 1
         
@@ -147,18 +316,126 @@ class UndoStack(object):
         self.__user_action_count -= 1
         if self.__user_action_count == 0:
             if self.__action_ops > 1:
-                self.__stack.insert(len(self.__stack) - self.__action_ops, BeginActionOp())
-                self.__stack.append(EndActionOp())
-                self.__position += 2
+                # Compacting may leave a single op; it isn't coalesced with the
+                # previous op, since it was a separate user action
+                self.__compact_action()
+                if self.__action_ops > 1:
+                    self.__stack.insert(len(self.__stack) - self.__action_ops, BeginActionOp())
+                    self.__stack.append(EndActionOp())
+                    self.__position += 2
             elif self.__action_ops == 1:
                 self.__check_coalesce()
             self.__action_ops = 0
-                
+            self.__limit_memory()
 
     def clear(self):
         self.__stack = []
         self.__position = 0
+        self.__memory = 0
+        self.__spill_position = 0
+        if self.__journal is not None:
+            self.__journal.close()
+            self.__journal = None
+        self.__journal_failed = False
 
     def __repr__(self):
         return "UndoStack(stack=%s, position=%d)" % (self.__stack, self.__position)
     
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    from test_utils import assert_equals
+
+    class TestWorksheet(object):
+        # Just enough of a worksheet to record and apply operations
+        def __init__(self):
+            self.lines = [u""]
+            self.undo_stack = UndoStack(self)
+
+        def begin_user_action(self):
+            self.undo_stack.begin_user_action()
+
+        def end_user_action(self):
+            self.undo_stack.end_user_action()
+
+        def insert(self, line, offset, text):
+            left = self.lines[line][:offset]
+            right = self.lines[line][offset:]
+            new_lines = _NEW_LINE_RE.split(text)
+            new_lines[0] = left + new_lines[0]
+            end = (line + len(new_lines) - 1, len(new_lines[-1]))
+            new_lines[-1] += right
+            self.lines[line:line + 1] = new_lines
+            self.undo_stack.append_op(InsertOp((line, offset), end, text))
+
+        def delete_range(self, start_line, start_offset, end_line, end_offset):
+            text = u"\n".join(self.lines[start_line:end_line + 1])
+            text = text[start_offset:len(text) - len(self.lines[end_line]) + end_offset]
+            self.lines[start_line:end_line + 1] = [self.lines[start_line][:start_offset] +
+                                                   self.lines[end_line][end_offset:]]
+            self.undo_stack.append_op(DeleteOp((start_line, start_offset), (end_line, end_offset), text))
+
+        def place_cursor(self, line, offset):
+            pass
+
+        def get_text(self):
+            return u"\n".join(self.lines)
+
+    assert_equals(_end_position((1, 2), u"abc"), (1, 5))
+    assert_equals(_end_position((1, 2), u"a\nbc\n"), (3, 0))
+
+    # Typing and deleting a run of text in a user action is compacted to one op
+    worksheet = TestWorksheet()
+    worksheet.begin_user_action()
+    for i, c in enumerate(u"hello\n"):
+        worksheet.insert(0, i, c)
+    for i, c in enumerate(u"world"):
+        worksheet.insert(1, i, c)
+    worksheet.end_user_action()
+    assert_equals(repr(worksheet.undo_stack),
+                  "UndoStack(stack=[InsertOp((0, 0), (1, 5), u'hello\\nworld')], position=1)")
+
+    worksheet.begin_user_action()
+    worksheet.delete_range(1, 4, 1, 5) # Backspace
+    worksheet.delete_range(1, 3, 1, 4)
+    worksheet.delete_range(0, 1, 0, 2) # Delete
+    worksheet.delete_range(0, 1, 0, 2)
+    worksheet.delete_range(0, 1, 1, 0)
+    worksheet.end_user_action()
+    assert_equals(worksheet.get_text(), u"hwor")
+    assert_equals(repr(worksheet.undo_stack),
+                  "UndoStack(stack=[InsertOp((0, 0), (1, 5), u'hello\\nworld'), " +
+                  "BeginActionOp(), DeleteOp((1, 3), (1, 5), u'ld'), " +
+                  "DeleteOp((0, 1), (1, 0), u'ello\\n'), EndActionOp()], position=5)")
+    worksheet.undo_stack.undo()
+    assert_equals(worksheet.get_text(), u"hello\nworld")
+    worksheet.undo_stack.redo()
+    assert_equals(worksheet.get_text(), u"hwor")
+
+    # Going over the memory limit spills the oldest ops to disk
+    worksheet = TestWorksheet()
+    worksheet.undo_stack.max_memory = 10
+    texts = [u"abcdef", u"\u00e9\u00e8\u00ea\n", u"ghijkl", u"mnopqr"]
+    for text in texts:
+        worksheet.insert(0, 0, text)
+        worksheet.insert(0, 0, u"\n")
+    stack = worksheet.undo_stack._UndoStack__stack
+    assert_equals([op._get_size() for op in stack], [0, 0, 0, 0, 0, 1, 6, 1])
+    assert_equals(stack[2].text, u"\u00e9\u00e8\u00ea\n")
+    full_text = worksheet.get_text()
+    for i in xrange(0, 8):
+        worksheet.undo_stack.undo()
+    assert_equals(worksheet.get_text(), u"")
+    for i in xrange(0, 8):
+        worksheet.undo_stack.redo()
+    assert_equals(worksheet.get_text(), full_text)
+
+    # Discarding the redo ops keeps the accounting right
+    for i in xrange(0, 4):
+        worksheet.undo_stack.undo()
+    worksheet.insert(0, 0, u"xyz")
+    assert_equals(worksheet.undo_stack._UndoStack__memory, 3)
+
+    worksheet.undo_stack.clear()
+    assert_equals(worksheet.undo_stack._UndoStack__journal, None)
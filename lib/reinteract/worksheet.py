@@ -12,22 +12,34 @@ import gobject
 import logging
 import os
 import re
+import threading
 from StringIO import StringIO
 
 from change_range import ChangeRange
+from chunk_index import ChunkIndex
 from chunks import *
+from edit_journal import EditJournal, get_journal_filename, get_journal_key, read_journal
+from file_writer import FileWriter
+from memo_cache import DEFAULT_IMPURE_NAMES
 from notebook import Notebook, NotebookFile
+from parallel_executor import ParallelExecutor
+from profiler import DeterministicProfiler, SamplingProfiler
 import reunicode
+from scope import LayeredScope
+from snapshot_store import SnapshotStore, get_snapshot_directory, get_snapshot_key
 from statement import Statement
+from subprocess_executor import SubprocessExecutor, SubprocessWorker
 from thread_executor import ThreadExecutor
 from undo_stack import UndoStack, InsertOp, DeleteOp
 
 _debug = logging.getLogger("Worksheet").debug
 
+# __reinteract_current.statement is the statement executing in the current thread;
+# several statements of a worksheet can execute at once. See ParallelExecutor
 _DEFINE_GLOBALS = compile("""
 global reinteract_output
 def reinteract_output(*args):
-   __reinteract_statement.do_output(*args)
+   __reinteract_current.statement.do_output(*args)
 """, __name__, 'exec')
 
 BLANK_RE = re.compile(r'^\s*$')
@@ -40,6 +52,14 @@ CONTINUATION = 3
 
 NEW_LINE_RE = re.compile(r'\n|\r|\r\n')
 
+DEFAULT_CHECKPOINT_INTERVAL = 8
+
+# How many times a second at most the chunks are updated as statements complete
+DEFAULT_MAX_UPDATE_RATE = 20
+
+# Statements that take less time than this to execute aren't worth saving snapshots of
+DEFAULT_SNAPSHOT_MIN_TIME = 5 # seconds
+
 def calc_line_class(text):
     if BLANK_RE.match(text):
         return BLANK
@@ -50,6 +70,68 @@ def calc_line_class(text):
     else:
         return STATEMENT_START
 
+def get_chunk_class(line_class):
+    if line_class == BLANK:
+        return BlankChunk
+    elif line_class == COMMENT:
+        return CommentChunk
+    else:
+        return StatementChunk
+
+def divide_lines(lines, start, end):
+    """Divide a range of lines into chunks
+
+    Each statement becomes a chunk, and the blank lines and comments between
+    statements are divided into chunks of consecutive blank lines and of
+    consecutive comments.
+
+    @param lines: list of the lines of text
+    @param start: the first line of the range
+    @param end: the line after the last line of the range
+    @returns: an iterator over (chunk start, chunk end, line class) for the
+       chunks, in order. The line class of a statement is STATEMENT_START.
+
+    """
+    line_classes = [calc_line_class(lines[i]) for i in xrange(start, end)]
+
+    def divide_group(group_start, group_end, statement_end):
+        # A group is a statement followed by blank lines and comments
+        if statement_end > group_start:
+            yield group_start, statement_end, STATEMENT_START
+
+        run_start = statement_end
+        prev_class = CONTINUATION # Doesn't matter, not blank/continuation
+        for i in xrange(statement_end, group_end):
+            line_class = line_classes[i - start]
+            if line_class != prev_class and i > run_start:
+                yield run_start, i, prev_class
+                run_start = i
+            prev_class = line_class
+
+        if group_end > run_start:
+            yield run_start, group_end, prev_class
+
+    group_start = start
+    statement_end = start
+
+    seen_start = False
+    for line in xrange(start, end):
+        line_class = line_classes[line - start]
+        if line_class == BLANK or line_class == COMMENT:
+            pass
+        elif line_class == CONTINUATION and seen_start:
+            statement_end = line + 1
+        else:
+            seen_start = True
+            if line > group_start:
+                for chunk_range in divide_group(group_start, line, statement_end):
+                    yield chunk_range
+            group_start = line
+            statement_end = line + 1
+
+    for chunk_range in divide_group(group_start, end, statement_end):
+        yield chunk_range
+
 def order_positions(start_line, start_offset, end_line, end_offset):
     if start_line > end_line or (start_line == end_line and start_offset > end_offset):
         t = end_line
@@ -71,6 +153,12 @@ class Worksheet(gobject.GObject):
         'text-deleted': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (int, int, int, int)),
         'lines-inserted': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (int, int)),
         'lines-deleted': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (int, int)),
+        # Emitted when all the text and chunks of the worksheet have been replaced
+        # at once, instead of the other signals, see load()
+        'reset': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
+        # Emitted when save() finishes writing a file. The arguments are the filename
+        # and the exception if writing failed, or None
+        'saved': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (str, gobject.TYPE_PYOBJECT)),
         'chunk-inserted': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
         # Chunk changed is emitted when the text or tokenization of a chunk
         # changes. Note that "changes" here specifically includes being
@@ -88,6 +176,10 @@ class Worksheet(gobject.GObject):
         'chunk-deleted': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
         'chunk-status-changed': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
         'chunk-results-changed': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
+        # Emitted instead of chunk-results-changed when the only change is that more
+        # results were added at the end of chunk.results, typically output from
+        # a statement that is still executing. The second argument is the added results
+        'chunk-results-appended': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT, gobject.TYPE_PYOBJECT)),
         # This is only for the convenience of the undo stack; otherwise we ignore cursor position
         'place-cursor': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (int, int))
     }
@@ -103,10 +195,64 @@ class Worksheet(gobject.GObject):
 
         self.global_scope = {}
         notebook.setup_globals(self.global_scope)
+        self.global_scope['__reinteract_current'] = threading.local()
         exec _DEFINE_GLOBALS in self.global_scope
 
+        #: approximate limit on the memory used by the result scopes of statements,
+        #: in bytes, or None for no limit. See __enforce_scope_budget()
+        self.scope_memory_budget = None
+        #: when evicting result scopes, the scopes of every checkpoint_interval'th
+        #: statement are kept, to bound the amount of work to rebuild a scope
+        self.checkpoint_interval = DEFAULT_CHECKPOINT_INTERVAL
+        #: number of result scopes that have been evicted
+        self.scope_evictions = 0
+        #: number of evicted result scopes that have been rebuilt
+        self.scope_rebuilds = 0
+        #: maximum number of independent statements to execute at once. See ParallelExecutor.
+        #: Ignored when executing in a subprocess
+        self.parallel_statements = 1
+        #: maximum number of times a second to update the chunks as statements
+        #: complete during a calculation, or None for no limit
+        self.max_update_rate = DEFAULT_MAX_UPDATE_RATE
+        #: maximum time that executing a statement may take, in seconds, or None for
+        #: no limit. A '# timeout: <seconds>' comment in a statement overrides this for
+        #: that statement; see StatementChunk.timeout
+        self.statement_timeout = None
+        #: if True, the results of statements that take at least snapshot_min_time
+        #: seconds to execute are saved in a SnapshotStore next to the worksheet file,
+        #: and restored instead of executing the statements when the worksheet is
+        #: reopened. Ignored when executing in a subprocess
+        self.save_snapshots = False
+        self.snapshot_min_time = DEFAULT_SNAPSHOT_MIN_TIME
+        self.__snapshot_store = None
+        #: if True, edits are recorded in an EditJournal next to the worksheet file, and
+        #: recovered by load() if the worksheet wasn't saved or closed after them
+        self.save_journal = False
+        self.__journal = None
+        # The key of the text of the worksheet file, see get_journal_key()
+        self.__journal_key = None
+        #: time taken by the last save, in seconds, and number of bytes written
+        self.last_save_duration = None
+        self.last_save_size = None
+        # The FileWriter for a save that hasn't completed yet
+        self.__writer = None
+        # Incremented on each edit, to find out if there were edits during a save
+        self.__edit_count = 0
+        #: if not None, a MemoCache holding the results of statements executed before,
+        #: to reuse when a statement is executed again with the same values for the
+        #: names it reads. Off by default, since memoizing a statement that has side
+        #: effects not visible in its text changes what the worksheet does
+        self.memo_cache = None
+        #: statements that mention any of these names aren't memoized. A statement can
+        #: also be excluded with an '# impure' comment. See L{memo_cache.is_impure}
+        self.impure_names = set(DEFAULT_IMPURE_NAMES)
+
+        # Statements that we've set a profiler on for the current calculation
+        self.__profiled_statements = []
+
         self.__lines = [""]
-        self.__chunks = [BlankChunk(0,1)]
+        self.__chunks = ChunkIndex()
+        self.__chunks.add(BlankChunk(0,1))
 
         # There's quite a bit of complexity knowing when a change to lines changes
         # adjacent chunks. We use a simple and slightly inefficient algorithm for this
@@ -124,23 +270,22 @@ class Worksheet(gobject.GObject):
 
         self.__undo_stack = UndoStack(self)
 
+        # If not None, statements are executed in this worker process
+        self.__worker = None
+
         notebook._add_worksheet(self)
 
     def do_import(self, name, globals, locals, fromlist, level):
         __import__(self, name, globals, locals, fromlist, level)
 
     def iterate_chunks(self, start_line=0, end_line=None):
-        if end_line is None or end_line > len(self.__chunks):
-            end_line = len(self.__chunks)
-        if start_line >= len(self.__chunks) or end_line <= start_line:
+        if end_line is None or end_line > len(self.__lines):
+            end_line = len(self.__lines)
+        if start_line >= len(self.__lines) or end_line <= start_line:
             return
 
-        prev_chunk = None
-        for i in xrange(start_line, end_line):
-            chunk = self.__chunks[i]
-            if chunk != prev_chunk:
-                yield chunk
-            prev_chunk = chunk
+        for chunk in self.__chunks.iterate(start_line, end_line):
+            yield chunk
 
     def __freeze_changes(self):
         self.__freeze_changes_count += 1
@@ -177,7 +322,12 @@ class Worksheet(gobject.GObject):
                 self.emit('chunk-status-changed', chunk)
             if isinstance(chunk, StatementChunk) and chunk.results_changed:
                 chunk.results_changed = False
+                chunk.results_appended = []
                 self.emit('chunk-results-changed', chunk)
+            elif isinstance(chunk, StatementChunk) and len(chunk.results_appended) > 0:
+                results = chunk.results_appended
+                chunk.results_appended = []
+                self.emit('chunk-results-appended', chunk, results)
 
     def __chunk_changed(self, chunk):
         self.__changed_chunks.add(chunk)
@@ -191,6 +341,10 @@ class Worksheet(gobject.GObject):
         # StatementChunk. The alternative would be to do it when we
         # __thaw_changes(), which would conceivably be more efficient, but
         # it's hard to see how to handle deleted chunks in that case.
+        #
+        # Being marked for execution doesn't mean that a statement will actually
+        # be executed again; when we calculate, statements that don't depend on
+        # anything that changed reuse their old results. See __compute_dependencies()
         for chunk in self.iterate_chunks(start_line):
             if isinstance(chunk, StatementChunk):
                 if chunk.mark_for_execute():
@@ -206,6 +360,7 @@ class Worksheet(gobject.GObject):
         self.__mark_rest_for_execute(chunk.end)
 
     def __remove_chunk(self, chunk):
+        self.__chunks.remove(chunk)
         try:
             self.__changed_chunks.remove(chunk)
         except KeyError:
@@ -216,30 +371,27 @@ class Worksheet(gobject.GObject):
             self.__mark_rest_for_execute(chunk.end)
 
     def __adjust_or_create_chunk(self, start, end, line_class):
-        if line_class == BLANK:
-            klass = BlankChunk
-        elif line_class == COMMENT:
-            klass = CommentChunk
-        else:
-            klass = StatementChunk
+        klass = get_chunk_class(line_class)
+
+        old_chunks = list(self.__chunks.iterate(start, end))
 
-        # Look for an existing chunk of the right type
+        # Look for an existing chunk of the right type. An old statement can only
+        # be turned into *one* new statement; if the chunk extends past end, the
+        # lines after end are left without a chunk until they are assigned.
         chunk = None
-        for i in xrange(start, end):
-            if isinstance(self.__chunks[i], klass):
-                chunk = self.__chunks[i]
+        for c in old_chunks:
+            if isinstance(c, klass):
+                chunk = c
                 break
 
-        if chunk is not None:
-            if chunk.end > end:
-                # An old statement can only be turned into *one* new statement; once
-                # we've used the chunk, we can't use it again
-                self.__chunks[end:chunk.end] = (None for i in xrange(end, chunk.end))
-        else:
+        if chunk is None:
             chunk = klass()
+            is_new = True
+        else:
+            is_new = False
 
         chunk.set_range(start, end)
-        for c in self.iterate_chunks(start, end):
+        for c in old_chunks:
             assert c.start >= start
 
             if c == chunk:
@@ -249,35 +401,11 @@ class Worksheet(gobject.GObject):
             else:
                 c.set_range(end, c.end)
 
-        self.__chunks[start:end] = (chunk for i in xrange(start, end))
+        if is_new:
+            self.__chunks.add(chunk)
 
         return chunk
 
-    def __assign_lines(self, chunk_start, lines, statement_end):
-        if statement_end > chunk_start:
-            chunk_lines = lines[0:statement_end - chunk_start]
-            chunk = self.__adjust_or_create_chunk(chunk_start, statement_end, STATEMENT_START)
-            chunk.set_lines(chunk_lines)
-
-            if not chunk.changes.empty():
-                self.__mark_changed_statement(chunk)
-
-        start = statement_end
-        prev_class = CONTINUATION # Doesn't matter, not blank/continuation
-        for i in xrange(statement_end, chunk_start + len(lines)):
-            line_class = calc_line_class(self.__lines[i])
-            if line_class != prev_class and i > start:
-                chunk = self.__adjust_or_create_chunk(start, i, prev_class)
-                if not chunk.changes.empty():
-                    self.__chunk_changed(chunk)
-                start = i
-            prev_class = line_class
-
-        if chunk_start + len(lines) > start:
-            chunk = self.__adjust_or_create_chunk(start, chunk_start + len(lines), prev_class)
-            if not chunk.changes.empty():
-                self.__chunk_changed(chunk)
-
     def rescan(self):
         """Update the division of the worksheet into chunks based on the current text.
 
@@ -301,13 +429,13 @@ class Worksheet(gobject.GObject):
 
             while rescan_start > 0:
                 rescan_start -= 1
-                chunk = self.__chunks[rescan_start]
+                chunk = self.__chunks.get_chunk(rescan_start)
                 if isinstance(chunk, StatementChunk):
                     rescan_start = chunk.start
                     break
 
             while rescan_end < len(self.__lines):
-                chunk = self.__chunks[rescan_end]
+                chunk = self.__chunks.get_chunk(rescan_end)
                 # The check for continuation line is needed because the first statement
                 # in a buffer can start with a continuation line
                 if isinstance(chunk, StatementChunk) and \
@@ -322,38 +450,26 @@ class Worksheet(gobject.GObject):
         self.__changes.clear()
         self.__scan_adjacent = False
 
-        if self.__chunks[rescan_start] is not None:
-            rescan_start = self.__chunks[rescan_start].start;
-        if self.__chunks[rescan_end - 1] is not None:
-            rescan_end = self.__chunks[rescan_end - 1].end;
+        chunk = self.__chunks.get_chunk(rescan_start)
+        if chunk is not None:
+            rescan_start = chunk.start
+            # Deleting lines at the start of the worksheet leaves an empty range,
+            # but the chunk that now starts there still needs to be rescanned
+            rescan_end = max(rescan_end, chunk.end)
+        chunk = self.__chunks.get_chunk(rescan_end - 1)
+        if chunk is not None:
+            rescan_end = chunk.end
 
         _debug("  Rescanning lines %s-%s", rescan_start, rescan_end)
 
-        chunk_start = rescan_start
-        statement_end = rescan_start
-        chunk_lines = []
-
-        seen_start = False
-        for line in xrange(rescan_start, rescan_end):
-            line_text = self.__lines[line]
-
-            line_class = calc_line_class(line_text)
-            if line_class == BLANK:
-                chunk_lines.append(line_text)
-            elif line_class == COMMENT:
-                chunk_lines.append(line_text)
-            elif line_class == CONTINUATION and seen_start:
-                chunk_lines.append(line_text)
-                statement_end = line + 1
-            else:
-                seen_start = True
-                if len(chunk_lines) > 0:
-                    self.__assign_lines(chunk_start, chunk_lines, statement_end)
-                chunk_start = line
-                statement_end = line + 1
-                chunk_lines = [line_text]
-
-        self.__assign_lines(chunk_start, chunk_lines, statement_end)
+        for chunk_start, chunk_end, line_class in divide_lines(self.__lines, rescan_start, rescan_end):
+            chunk = self.__adjust_or_create_chunk(chunk_start, chunk_end, line_class)
+            if line_class == STATEMENT_START:
+                chunk.set_lines(self.__lines[chunk_start:chunk_end])
+                if not chunk.changes.empty():
+                    self.__mark_changed_statement(chunk)
+            elif not chunk.changes.empty():
+                self.__chunk_changed(chunk)
 
     def __set_line(self, line, text):
         if self.__lines[line] is not None:
@@ -380,16 +496,11 @@ class Worksheet(gobject.GObject):
 
     def __insert_lines(self, line, count, chunk):
         # Insert an integral number of lines into the given chunk at the given position
-        # fixing up the chunk and the __chunks[]/__lines[] arrays
+        # fixing up the chunk, the subsequent chunks and the __lines[] array
 
-        self.__chunks[line:line] = (chunk for i in xrange(count))
         self.__lines[line:line] = (None for i in xrange(count))
         chunk.insert_lines(line, count)
-
-        # Fix up the subsequent chunks
-        for c in self.iterate_chunks(chunk.end):
-            c.start += count
-            c.end += count
+        self.__chunks.shift_after(chunk, count)
 
         self.__changes.insert(line, count)
         self.__scan_adjacent = True
@@ -414,7 +525,7 @@ class Worksheet(gobject.GObject):
             count += 1
             ends_with_new_line = m.end() == len(text)
 
-        chunk = self.__chunks[line]
+        chunk = self.__chunks.get_chunk(line)
         left = self.__lines[line][0:offset]
         right = self.__lines[line][offset:]
 
@@ -430,7 +541,7 @@ class Worksheet(gobject.GObject):
 
                 # At a chunk boundary, extend the chunk before, not the chunk after
                 if line > 0 and chunk.start == line:
-                    chunk = self.__chunks[line - 1]
+                    chunk = self.__chunks.get_chunk(line - 1)
 
                 self.__insert_lines(line, count, chunk)
             else:
@@ -467,23 +578,21 @@ class Worksheet(gobject.GObject):
             end_offset = len(text) - last
 
         self.__thaw_changes()
-        self.__undo_stack.append_op(InsertOp((line, offset), (end_line, end_offset), text))
+        op = InsertOp((line, offset), (end_line, end_offset), text)
+        self.__record_op(op)
 
         if self.__user_action_count > 0 and not self.code_modified:
             self.code_modified = True
 
     def __delete_lines(self, start_line, end_line):
         # Delete an integral number of lines, fixing up the affected chunks
-        # and the __chunks[]/__lines[] arrays
+        # and the __lines[] array
 
         if end_line == start_line: # No lines deleted
             return
 
-        for chunk in self.iterate_chunks(start_line):
-            if chunk.start >= end_line:
-                chunk.start -= (end_line - start_line)
-                chunk.end -= (end_line - start_line)
-            elif chunk.start >= start_line:
+        for chunk in list(self.__chunks.iterate(start_line, end_line)):
+            if chunk.start >= start_line:
                 if chunk.end <= end_line:
                     self.__remove_chunk(chunk)
                 else:
@@ -495,8 +604,8 @@ class Worksheet(gobject.GObject):
                 chunk.delete_lines(start_line, min(chunk.end, end_line))
                 self.__chunk_changed(chunk)
 
+        self.__chunks.shift(end_line, start_line - end_line)
         self.__lines[start_line:end_line] = ()
-        self.__chunks[start_line:end_line] = ()
 
         self.__changes.delete_range(start_line, end_line)
         self.__scan_adjacent = True
@@ -532,12 +641,13 @@ class Worksheet(gobject.GObject):
                 self.__delete_lines(start_line + 1, end_line + 1)
 
             self.__set_line(start_line, left + right)
-            chunk = self.__chunks[start_line]
+            chunk = self.__chunks.get_chunk(start_line)
             chunk.change_line(start_line)
             self.__chunk_changed(chunk)
 
         self.__thaw_changes()
-        self.__undo_stack.append_op(DeleteOp((start_line, start_offset), (end_line, end_offset), deleted_text))
+        op = DeleteOp((start_line, start_offset), (end_line, end_offset), deleted_text)
+        self.__record_op(op)
 
         if self.__user_action_count > 0 and not self.code_modified:
             self.code_modified = True
@@ -546,6 +656,37 @@ class Worksheet(gobject.GObject):
         _debug("Place cursor at %s,%s", line, offset)
         self.emit('place-cursor', line, offset)
 
+    def __record_op(self, op):
+        self.__edit_count += 1
+        self.__undo_stack.append_op(op)
+        self.__journal_op(op)
+
+    def __journal_op(self, op):
+        if not self.save_journal:
+            self.__close_journal()
+            return
+
+        if self.__journal is None:
+            if self.__filename is None or self.__journal_key is None:
+                return
+            self.__journal = EditJournal(get_journal_filename(self.__filename), self.__journal_key)
+
+        self.__journal.append_op(op)
+        if self.__journal.needs_checkpoint():
+            self.__journal.checkpoint(self.get_text())
+
+    def __close_journal(self):
+        # Called when the edits in the journal have been saved or discarded
+        if self.__journal is not None:
+            self.__journal.close(remove=True)
+            self.__journal = None
+
+    def sync_journal(self):
+        """Wait until the edits recorded in the journal have been written to disk"""
+
+        if self.__journal is not None:
+            self.__journal.wait()
+
     def undo(self):
         self.__undo_stack.undo()
 
@@ -567,8 +708,129 @@ class Worksheet(gobject.GObject):
 
             for module, _ in imports:
                 if module == module_name:
+                    chunk.statement.mark_for_execute(allow_reuse=False)
                     self.__mark_rest_for_execute(chunk.start)
 
+        # Memoized results may have been computed with the old module
+        if self.memo_cache is not None:
+            self.memo_cache.clear()
+
+        if self.__worker is not None:
+            self.__worker.module_changed(module_name)
+
+    def __compute_dependencies(self):
+        # Compute the dependencies of each statement: the names whose values at
+        # the start of the statement can affect its results. This is the names
+        # that the statement reads, but also, transitively, the names read by
+        # the statements that bound those names, since, for example, a function
+        # looks up the global names it references when it is called, not when
+        # it is defined. The statements must all have been compiled.
+        #
+        # A statement with unknown bindings (exec, import *) is always executed,
+        # so its own results are never stale, but we can't track dependencies
+        # through the names that it binds; for import * that's fine, since the
+        # bound objects come from a module and don't refer to worksheet names.
+
+        binding_dependencies = {}
+        for chunk in self.iterate_chunks():
+            if not isinstance(chunk, StatementChunk) or chunk.statement is None:
+                continue
+
+            statement = chunk.statement
+            if statement.reads is None:
+                statement.dependencies = None
+                continue
+
+            dependencies = set(statement.reads)
+            for name in statement.reads:
+                dependencies.update(binding_dependencies.get(name, ()))
+            statement.dependencies = dependencies
+
+            if statement.writes is not None:
+                for name in statement.writes:
+                    binding_dependencies[name] = dependencies
+
+    def __is_checkpoint(self, i):
+        # Whether the i'th statement keeps its result scope when evicting scopes
+        return (i + 1) % self.checkpoint_interval == 0
+
+    def __enforce_scope_budget(self):
+        # Evict the result scopes of the oldest statements until the estimated
+        # memory used by result scopes is within the budget. The statements at
+        # checkpoint_interval and the last statement keep their scopes, so an
+        # evicted scope can be rebuilt by executing forward from the preceding
+        # checkpoint. (See Statement.get_result_scope())
+
+        if self.scope_memory_budget is None:
+            return
+
+        statements = [chunk.statement for chunk in self.iterate_chunks()
+                      if isinstance(chunk, StatementChunk) and chunk.statement is not None]
+        sizes = [statement.get_result_scope_size() for statement in statements]
+        total = sum(sizes)
+        if total <= self.scope_memory_budget:
+            return
+
+        for i, statement in enumerate(statements):
+            if total <= self.scope_memory_budget:
+                break
+            if statement.state != Statement.EXECUTE_SUCCESS or statement.result_scope is None:
+                continue
+            if self.__is_checkpoint(i) or i == len(statements) - 1:
+                continue
+
+            statement.evict_result_scope()
+            total -= sizes[i]
+            self.scope_evictions += 1
+
+        # A retained scope is layered on top of the scopes of the statements before
+        # it, so we need to replace the evicted layers in its chain of parents with a
+        # single layer that has only the values that are still visible
+        base = None
+        after_evicted = False
+        for statement in statements:
+            scope = statement.result_scope
+            if scope is None:
+                after_evicted = True
+                continue
+
+            if after_evicted and isinstance(scope, LayeredScope) and isinstance(scope.parent, LayeredScope):
+                shadowed = scope.deleted.union(scope.bindings)
+                scope.rebase(scope.parent.prune(base, shadowed))
+
+            base = scope
+            after_evicted = False
+
+    def __create_executor(self, parent):
+        if self.__worker is not None:
+            return SubprocessExecutor(self.__worker, parent)
+        elif self.parallel_statements > 1 and len(self.__profiled_statements) == 0:
+            # Profiling the whole calculation needs the statements to execute one at a time
+            return ParallelExecutor(parent, self.parallel_statements)
+        else:
+            return ThreadExecutor(parent)
+
+    def __get_snapshot_store(self):
+        # The result scopes of statements executed in a subprocess aren't here to save
+        if not self.save_snapshots or self.__filename is None or self.__worker is not None:
+            return None
+
+        directory = get_snapshot_directory(self.__filename)
+        if self.__snapshot_store is None or self.__snapshot_store.directory != directory:
+            self.__snapshot_store = SnapshotStore(directory)
+
+        return self.__snapshot_store
+
+    def clear_snapshots(self):
+        """Remove the snapshots saved for the worksheet (see save_snapshots), so
+        that statements are executed rather than restored from snapshots the
+        next time they are calculated"""
+
+        if self.__filename is None:
+            return
+
+        SnapshotStore(get_snapshot_directory(self.__filename)).clear()
+
     def calculate(self, wait=False):
         _debug("Calculating")
 
@@ -579,41 +841,87 @@ class Worksheet(gobject.GObject):
 
         executor = None
 
+        snapshot_store = self.__get_snapshot_store()
+        snapshot_keys = []
+        statement_index = 0
+
         for chunk in self.iterate_chunks():
             if isinstance(chunk, StatementChunk):
                 changed = False
 
+                if snapshot_store is not None:
+                    if len(snapshot_keys) > 0:
+                        parent_key = snapshot_keys[-1]
+                    else:
+                        parent_key = None
+                    snapshot_keys.append(get_snapshot_key(parent_key, chunk.tokenized.get_text()))
+
                 if chunk.needs_compile or chunk.needs_execute:
                     if not executor:
-                        executor = ThreadExecutor(parent)
+                        executor = self.__create_executor(parent)
 
                 if executor:
                     statement = chunk.get_statement(self)
+                    if chunk.timeout is not None:
+                        # 0 is no limit, as for global_settings.statement_timeout
+                        statement.timeout = chunk.timeout or None
+                    else:
+                        statement.timeout = self.statement_timeout
+                    if snapshot_store is not None:
+                        statement.snapshot_store = snapshot_store
+                        statement.snapshot_key = snapshot_keys[-1]
+                    else:
+                        statement.snapshot_store = None
+                        statement.snapshot_key = None
                     executor.add_statement(statement)
 
+                if chunk.statement is not None:
+                    chunk.statement.keep_result_scope = (self.scope_memory_budget is None or
+                                                         self.__is_checkpoint(statement_index))
+                statement_index += 1
+
                 parent = chunk.statement
 
         if executor:
             if wait:
                 loop = gobject.MainLoop()
 
-            def on_statement_execution_state_changed(executor, statement):
+            def update_statement(statement):
                 if (statement.state == Statement.COMPILE_ERROR or
                     statement.state == Statement.EXECUTE_ERROR or
                     statement.state == Statement.INTERRUPTED):
                     self.__executor_error = True
 
                 statement.chunk.update_statement()
-
-                if self.__freeze_changes_count == 0:
-                    self.__freeze_changes()
-                    self.__chunk_changed(statement.chunk)
-                    self.__thaw_changes()
-                else:
-                    self.__chunk_changed(statement.chunk)
+                self.__chunk_changed(statement.chunk)
+
+            def on_statement_executing(executor, statement):
+                self.__freeze_changes()
+                update_statement(statement)
+                self.__thaw_changes()
+
+            def on_statements_complete(executor, statements):
+                # Updating all the statements before thawing means that we only
+                # rescan and signal the chunk changes once for the batch
+                self.__freeze_changes()
+                for statement in statements:
+                    update_statement(statement)
+                self.__thaw_changes()
+
+            def on_statement_output(executor, statement):
+                self.__freeze_changes()
+                statement.chunk.update_output()
+                self.__chunk_changed(statement.chunk)
+                self.__thaw_changes()
 
             def on_complete(executor):
                 self.__executor = None
+                self.__add_stopped_profile()
+                self.__clear_profilers()
+                self.__enforce_scope_budget()
+                # Snapshots of statements that have since changed won't be used again
+                if snapshot_store is not None:
+                    snapshot_store.prune(snapshot_keys)
                 self.__set_state(NotebookFile.ERROR if self.__executor_error else NotebookFile.EXECUTE_SUCCESS)
                 if wait:
                     loop.quit()
@@ -621,17 +929,21 @@ class Worksheet(gobject.GObject):
             self.__executor = executor
             self.__executor_error = False
             self.__set_state(NotebookFile.EXECUTING)
-            executor.connect('statement-executing', on_statement_execution_state_changed)
-            executor.connect('statement-complete', on_statement_execution_state_changed)
+            executor.max_update_rate = self.max_update_rate
+            executor.connect('statement-executing', on_statement_executing)
+            executor.connect('statement-output', on_statement_output)
+            executor.connect('statements-complete', on_statements_complete)
             executor.connect('complete', on_complete)
 
             if executor.compile():
+                self.__compute_dependencies()
                 executor.execute()
                 if wait:
                     loop.run()
         else:
             # Nothing to execute, we could have been in a non-success state if statements were deleted
             # at the end of the file.
+            self.__clear_profilers()
             self.__set_state(NotebookFile.EXECUTE_SUCCESS)
 
         self.__thaw_changes()
@@ -640,19 +952,136 @@ class Worksheet(gobject.GObject):
         if self.state == NotebookFile.EXECUTING:
             self.__executor.interrupt()
 
+    def __add_stopped_profile(self):
+        # When profiling the whole calculation, the profile is added to the results
+        # of the last statement when it finishes executing. If execution stopped
+        # before that, because a statement failed or was interrupted, we add the
+        # profile to that statement, or to the last statement that executed
+        if len(self.__profiled_statements) == 0:
+            return
+
+        profiler = self.__profiled_statements[0].profiler
+        if profiler.result_statement is None or profiler.result_statement.state == Statement.EXECUTE_SUCCESS:
+            return
+
+        target = None
+        for statement in self.__profiled_statements:
+            if statement.state == Statement.EXECUTE_SUCCESS:
+                target = statement
+            elif statement.state in (Statement.EXECUTE_ERROR, Statement.INTERRUPTED):
+                target = statement
+                break
+
+        if target is None:
+            return
+
+        if target.results is None:
+            target.results = []
+        target.results.append(profiler.create_result())
+
+        self.__freeze_changes()
+        target.chunk.update_statement()
+        self.__chunk_changed(target.chunk)
+        self.__thaw_changes()
+
+    def __clear_profilers(self):
+        for statement in self.__profiled_statements:
+            statement.profiler = None
+        self.__profiled_statements = []
+
+    def profile(self, line=None, sampling=False, wait=False):
+        """Calculate the worksheet, profiling the execution of statements
+
+        The profiled statements are executed again even if their previous results
+        could be reused. The profile is shown as a L{ProfileResult} in the results
+        of the profiled statement, or when profiling the whole calculation, in the
+        results of the last statement (or of the statement where execution stopped, if a
+        statement fails or execution is interrupted.) Profiling isn't supported when
+        executing in a subprocess; the worksheet is just calculated.
+
+        @param line: if not None, only the statement containing this line is profiled
+        @param sampling: if True, use a L{SamplingProfiler}, which has lower overhead
+           than the default L{DeterministicProfiler} but is less accurate
+        @param wait: see calculate()
+
+        """
+        if self.__worker is None and self.state != NotebookFile.EXECUTING:
+            if sampling:
+                profiler = SamplingProfiler()
+            else:
+                profiler = DeterministicProfiler()
+
+            if line is not None:
+                chunks = [self.__chunks.get_chunk(line)]
+            else:
+                chunks = list(self.iterate_chunks())
+            chunks = [chunk for chunk in chunks if isinstance(chunk, StatementChunk)]
+
+            if len(chunks) > 0:
+                if line is None:
+                    profiler.result_statement = chunks[-1].get_statement(self)
+
+                for chunk in chunks:
+                    statement = chunk.get_statement(self)
+                    statement.profiler = profiler
+                    statement.mark_for_execute(allow_reuse=False)
+                    self.__profiled_statements.append(statement)
+
+                self.__mark_rest_for_execute(chunks[0].start)
+
+        self.calculate(wait=wait)
+
+    def get_slowest_statements(self, sort_by='execute_time', count=None):
+        """Get a summary of the time taken by the statements of the worksheet, slowest first
+
+        @param sort_by: what to sort by: 'execute_time', 'execute_cpu_time', 'compile_time',
+           or 'total_time' (the sum of the compile and execution times)
+        @param count: maximum number of statements to return, or None for all statements
+        @returns: a list of (chunk, compile_time, execute_time, execute_cpu_time), where the
+           times are in seconds and are those of the last compilation and execution. Statements
+           that haven't been compiled are omitted, and missing times are 0.
+
+        """
+        if sort_by == 'compile_time':
+            key = lambda row: row[1]
+        elif sort_by == 'execute_time':
+            key = lambda row: row[2]
+        elif sort_by == 'execute_cpu_time':
+            key = lambda row: row[3]
+        elif sort_by == 'total_time':
+            key = lambda row: row[1] + row[2]
+        else:
+            raise ValueError("Unknown sort_by value %r" % sort_by)
+
+        rows = []
+        for chunk in self.iterate_chunks():
+            if isinstance(chunk, StatementChunk) and chunk.compile_time is not None:
+                if len(chunk.execute_times) > 0:
+                    execute_time, execute_cpu_time, _ = chunk.execute_times[-1]
+                else:
+                    execute_time, execute_cpu_time = 0, 0
+                rows.append((chunk, chunk.compile_time, execute_time, execute_cpu_time))
+
+        rows.sort(key=key, reverse=True)
+        if count is not None:
+            rows = rows[0:count]
+
+        return rows
+
     def __get_last_scope(self, chunk):
         # Get the last result scope we have that precedes the specified chunk
 
         scope = None
         line = chunk.start - 1
         while line >= 0:
-            previous_chunk = self.__chunks[line]
+            previous_chunk = self.__chunks.get_chunk(line)
 
             # We intentionally don't check "needs_execute" ... if there is a result scope,
             # it's fair game for completion/help, even if it's old
-            if isinstance(previous_chunk, StatementChunk) and previous_chunk.statement is not None and previous_chunk.statement.result_scope is not None:
-                return previous_chunk.statement.result_scope
-                break
+            if isinstance(previous_chunk, StatementChunk) and previous_chunk.statement is not None:
+                scope = previous_chunk.statement.get_result_scope()
+                if scope is not None:
+                    return scope
 
             line = previous_chunk.start - 1
 
@@ -672,7 +1101,7 @@ class Worksheet(gobject.GObject):
 
         """
 
-        chunk = self.__chunks[line]
+        chunk = self.__chunks.get_chunk(line)
         if not isinstance(chunk, StatementChunk) and not isinstance(chunk, BlankChunk):
             return []
 
@@ -701,12 +1130,12 @@ class Worksheet(gobject.GObject):
 
         """
 
-        chunk = self.__chunks[line]
+        chunk = self.__chunks.get_chunk(line)
         if not isinstance(chunk, StatementChunk):
             return None, None, None, None, None
 
-        if chunk.statement is not None and chunk.statement.result_scope is not None:
-            result_scope = chunk.statement.result_scope
+        if chunk.statement is not None:
+            result_scope = chunk.statement.get_result_scope()
         else:
             result_scope = None
 
@@ -723,10 +1152,53 @@ class Worksheet(gobject.GObject):
 
         return obj, start_line, start_index, end_line, end_index
 
+    def __reset_text(self, text):
+        # Replace the entire text of the worksheet. This is equivalent to deleting
+        # all the text and inserting the new text, but builds the lines and chunks
+        # directly rather than editing them, and emits ::reset rather than
+        # notifying about each change.
+
+        if self.state == NotebookFile.EXECUTING:
+            return
+
+        had_statements = False
+        for chunk in self.__chunks.iterate():
+            if isinstance(chunk, StatementChunk):
+                had_statements = True
+                break
+
+        lines = NEW_LINE_RE.split(text)
+        chunks = []
+        have_statements = False
+        for start, end, line_class in divide_lines(lines, 0, len(lines)):
+            chunk = get_chunk_class(line_class)(start, end)
+            if line_class == STATEMENT_START:
+                chunk.set_lines(lines[start:end])
+                chunk.status_changed = False
+                have_statements = True
+            chunk.changes.clear()
+            chunk.newly_inserted = False
+            chunks.append(chunk)
+
+        self.__lines = lines
+        self.__chunks = ChunkIndex(chunks)
+        self.__changes.clear()
+        self.__scan_adjacent = False
+        self.__changed_chunks.clear()
+        self.__deleted_chunks.clear()
+
+        if (had_statements or have_statements) and self.state != NotebookFile.NEEDS_EXECUTE:
+            self.__set_state(NotebookFile.NEEDS_EXECUTE)
+
+        self.emit('reset')
+
     def __do_clear(self):
         self.delete_range(0, 0, len(self.__lines) - 1, len(self.__lines[len(self.__lines) - 1]));
 
     def clear(self):
+        self.__finish_save()
+        self.__close_journal()
+        self.__journal_key = None
         self.__do_clear()
         self.__set_filename_and_modified(None, False)
 
@@ -793,7 +1265,7 @@ class Worksheet(gobject.GObject):
         return len(self.__lines)
 
     def get_chunk(self, line):
-        return self.__chunks[line]
+        return self.__chunks.get_chunk(line)
 
     def get_line(self, line):
         return self.__lines[line]
@@ -845,6 +1317,38 @@ class Worksheet(gobject.GObject):
         return self.__code_modified
 
     code_modified = gobject.property(getter=__get_code_modified, setter=__set_code_modified, type=bool, default=False)
+
+    def __set_execute_in_subprocess(self, execute_in_subprocess):
+        if execute_in_subprocess == (self.__worker is not None):
+            return
+
+        if execute_in_subprocess:
+            self.__worker = SubprocessWorker(self.notebook)
+        else:
+            self.__worker.close()
+            self.__worker = None
+
+        # The result scopes of the statements are in the wrong place now
+        for chunk in self.iterate_chunks():
+            if isinstance(chunk, StatementChunk) and chunk.statement is not None:
+                chunk.statement.mark_for_execute(allow_reuse=False)
+        self.__mark_rest_for_execute(0)
+
+    def __get_execute_in_subprocess(self):
+        return self.__worker is not None
+
+    def __get_undo_memory_budget(self):
+        return self.__undo_stack.max_memory
+
+    def __set_undo_memory_budget(self, undo_memory_budget):
+        self.__undo_stack.max_memory = undo_memory_budget
+
+    #: number of characters of text that the undo history keeps in memory before
+    #: moving the oldest edits to disk, or None for no limit. See UndoStack.max_memory
+    undo_memory_budget = property(__get_undo_memory_budget, __set_undo_memory_budget)
+
+    # If True, statements are executed in a separate process; see SubprocessExecutor
+    execute_in_subprocess = gobject.property(getter=__get_execute_in_subprocess, setter=__set_execute_in_subprocess, type=bool, default=False)
     state = gobject.property(type=int, default=NotebookFile.EXECUTE_SUCCESS)
 
     def __set_filename_and_modified(self, filename, modified):
@@ -864,19 +1368,92 @@ class Worksheet(gobject.GObject):
            will be converted into \\x<nn> and \\u<nnnn> escape sequences.
 
         """
+        self.__finish_save()
+
         f = open(filename)
         text = f.read()
         f.close()
 
-        self.__do_clear()
-        self.insert(0, 0, reunicode.decode(text, escape=escape))
+        text = reunicode.decode(text, escape=escape)
+
+        # Any edits to the file we had before are discarded
+        self.__close_journal()
+        self.__journal_key = get_journal_key(text)
+        recovered = None
+        if self.save_journal:
+            recovered = read_journal(get_journal_filename(filename), text)
+
+        if recovered is not None:
+            _debug("Recovered unsaved edits to %s", filename)
+            self.__reset_text(recovered)
+        else:
+            self.__reset_text(text)
         # A bit of a hack - we assume that if escape was passed we *did* escape.
         # this is the way that things work currently - first the GUI loads with
         # escape=False, and if that fails, prompts the user and loads with escape=True
-        self.__set_filename_and_modified(filename, escape)
+        self.__set_filename_and_modified(filename, escape or recovered is not None)
         self.__undo_stack.clear()
 
-    def save(self, filename=None):
+        if recovered is not None:
+            # Keep the recovered edits in the journal until they are saved
+            self.__journal = EditJournal(get_journal_filename(filename), self.__journal_key)
+            self.__journal.checkpoint(recovered)
+
+    def __save_complete(self, writer, edit_count, key):
+        if writer is not self.__writer:
+            return
+        self.__writer = None
+
+        filename = writer.filename
+        self.last_save_duration = writer.duration
+        self.last_save_size = writer.size
+
+        if writer.error is None:
+            _debug("Saved %s, %d bytes in %.3f seconds", filename, writer.size, writer.duration)
+
+            # Need to refresh the notebook before saving so that we find the NotebookFile
+            # properly in __set_filename_and_modified
+            if filename != self.__filename:
+                self.notebook.refresh()
+
+            self.__close_journal()
+            self.__journal_key = key
+            if edit_count == self.__edit_count:
+                self.__set_filename_and_modified(filename, False)
+            else:
+                # There were edits while saving; they are still unsaved, and the
+                # journal for them starts from the file as saved
+                self.__set_filename_and_modified(filename, True)
+                if self.save_journal:
+                    self.__journal = EditJournal(get_journal_filename(filename), key)
+                    self.__journal.checkpoint(self.get_text())
+
+            if self.notebook.info:
+                self.notebook.info.update_last_modified()
+        else:
+            _debug("Failed to save %s: %s", filename, writer.error)
+
+        self.emit('saved', filename, writer.error)
+
+    def __finish_save(self):
+        # Wait for a save in progress, before replacing the text or filename
+        if self.__writer is not None:
+            self.__writer.wait()
+
+    def save(self, filename=None, wait=True):
+        """Save the worksheet to a file.
+
+        The text is encoded and written to the file in a separate thread, from a
+        copy of the lines taken when save() is called. The file is replaced once the
+        text has been written out completely. ::saved is emitted when done, and
+        last_save_duration and last_save_size are set.
+
+        @param filename: the file to save to, or None for the current filename
+        @param wait: if True, wait until the file has been written, and raise an
+           IOError or OSError if that failed. If False, return immediately; the
+           filename and code_modified are updated when the file has been written.
+
+        """
         if filename is None:
             if self.__filename is None:
                 raise ValueError("No current or specified filename")
@@ -886,48 +1463,35 @@ class Worksheet(gobject.GObject):
         if not self.code_modified and filename == self.__filename:
             return
 
-        filename_changed = filename != self.__filename
+        self.__finish_save()
 
-        tmpname = filename + ".tmp"
+        # Strings are immutable, so a copy of the list is a snapshot of the text
+        lines = list(self.__lines)
+        keys = []
 
-        # We use binary mode, since we don't want to munge line endings to the system default
-        # on a load-save cycle
-        f = open(tmpname, "wb")
+        def get_data():
+            text = u"\n".join(lines)
+            keys.append(get_journal_key(text))
+            return text.encode("utf8")
 
-        success = False
-        try:
-            first = True
-            for line in self.__lines:
-                if not first:
-                    f.write("\n")
-                first = False
-                f.write(line.encode("utf8"))
-
-            f.close()
-            # Windows can't save over an existing filename; we might want to check os.name to
-            # see if we have to do this, but it's unlikely that the unlink will succeed and
-            # the rename fail, so I think it's 'atomic' enough this way.
-            if os.path.exists(filename):
-                os.unlink(filename)
-            os.rename(tmpname, filename)
-            success = True
+        edit_count = self.__edit_count
+        def on_complete(writer):
+            self.__save_complete(writer, edit_count, keys and keys[0])
 
-            # Need to refresh the notebook before saving so that we find the NotebookFile
-            # properly in __set_filename_and_modified
-            if filename_changed:
-                self.notebook.refresh()
-            self.__set_filename_and_modified(filename, False)
-            if self.notebook.info:
-                self.notebook.info.update_last_modified()
-        finally:
-            if not success:
-                f.close()
-                try:
-                    os.remove(tmpname)
-                except:
-                    pass
+        writer = self.__writer = FileWriter(filename, get_data, on_complete)
+        if wait:
+            writer.wait()
+            if writer.error is not None:
+                raise writer.error
 
     def close(self):
+        self.__finish_save()
+        self.__close_journal()
+
+        if self.__worker is not None:
+            self.__worker.close()
+            self.__worker = None
+
         if self.__file:
             self.__file.worksheet = None
             self.__file.modified = False
@@ -947,6 +1511,8 @@ if __name__ == '__main__': #pragma: no cover
     import stdout_capture
     stdout_capture.init()
 
+    from test_utils import assert_equals
+
     S = StatementChunk
     B = BlankChunk
     C = CommentChunk
@@ -1071,6 +1637,28 @@ if __name__ == '__main__': #pragma: no cover
         def __repr__(self):
             return "CRC(%s, %s)" % (self.start, self.end)
 
+    class CRA:
+        def __init__(self, start, end, results):
+            self.start = start
+            self.end = end
+            self.results = results
+
+        def __eq__(self, other):
+            if not isinstance(other, CRA):
+                return False
+
+            return self.start == other.start and self.end == other.end and self.results == other.results
+
+        def __repr__(self):
+            return "CRA(%s, %s, %r)" % (self.start, self.end, self.results)
+
+    class R:
+        def __eq__(self, other):
+            return isinstance(other, R)
+
+        def __repr__(self):
+            return "R()"
+
     log = []
 
     def on_chunk_inserted(worksheet, chunk):
@@ -1093,6 +1681,14 @@ if __name__ == '__main__': #pragma: no cover
         _debug("...Chunk %s results changed", chunk_label(chunk))
         log.append(CRC(chunk.start, chunk.end))
 
+    def on_chunk_results_appended(worksheet, chunk, results):
+        _debug("...Chunk %s results appended", chunk_label(chunk))
+        log.append(CRA(chunk.start, chunk.end, results))
+
+    def on_reset(worksheet):
+        _debug("...Reset")
+        log.append(R())
+
     def clear_log():
         global log
         log = []
@@ -1107,6 +1703,8 @@ if __name__ == '__main__': #pragma: no cover
     worksheet.connect('chunk-deleted', on_chunk_deleted)
     worksheet.connect('chunk-status-changed', on_chunk_status_changed)
     worksheet.connect('chunk-results-changed', on_chunk_results_changed)
+    worksheet.connect('chunk-results-appended', on_chunk_results_appended)
+    worksheet.connect('reset', on_reset)
 
     # Insertions
     insert(0, 0, "11\n22\n33")
@@ -1206,6 +1804,175 @@ if __name__ == '__main__': #pragma: no cover
     calculate()
     expect_results([[], [], ['4']])
 
+    # Only statements that depend on a changed statement are executed again
+    executed = []
+    def record_execution(x):
+        executed.append(x)
+        return x
+    worksheet.global_scope['record_execution'] = record_execution
+
+    clear()
+    insert(0, 0, "a = 1\nb = record_execution(2)\nc = record_execution(a + 1)\ndef f(): return a\nd = record_execution(f())\nb + c + d")
+    calculate()
+    expect_results([[], [], [], [], [], ['5']])
+    assert_equals(executed, [2, 2, 1])
+
+    del executed[:]
+    delete(0, 4, 0, 5)
+    insert(0, 4, "3")
+    calculate()
+    expect_results([[], [], [], [], [], ['9']])
+    assert_equals(executed, [4, 3])
+
+    # Deleting a statement that rebinds a name executes the statements reading it
+    del executed[:]
+    clear()
+    insert(0, 0, "a = 1\na = 2\nb = record_execution(a)\nc = record_execution(0)")
+    calculate()
+    del executed[:]
+    delete(1, 0, 2, 0)
+    calculate()
+    assert_equals(executed, [1])
+
+    # Modules and objects that can't be copied are modified in place, so the
+    # statements reading them are executed again after they are modified
+    clear()
+    insert(0, 0, "import random\nrandom.seed(5)\nx = random.random(); x")
+    calculate()
+    first = worksheet.get_chunk(2).results
+    delete(1, 12, 1, 13)
+    insert(1, 12, "6")
+    calculate()
+    assert worksheet.get_chunk(2).results != first
+    delete(1, 12, 1, 13)
+    insert(1, 12, "5")
+    calculate()
+    assert_equals(worksheet.get_chunk(2).results, first)
+
+    clear()
+    insert(0, 0, "class C(object):\n    def __copy__(self): raise TypeError()\nc = C()\nc.v = 1\nc.v")
+    calculate()
+    assert_equals(len(worksheet.get_chunk(3).results), 1)
+    assert_equals(worksheet.get_chunk(4).results, ['1'])
+    delete(3, 6, 3, 7)
+    insert(3, 6, "2")
+    calculate()
+    assert_equals(worksheet.get_chunk(4).results, ['2'])
+
+    # Result scopes are evicted to stay within the memory budget, and rebuilt
+    # when needed
+    del executed[:]
+    clear()
+    worksheet.scope_memory_budget = 0
+    worksheet.checkpoint_interval = 2
+    insert(0, 0, "a = range(100)\nb = a + [record_execution(1)]\na = a + b\nprint 'x'\nc = len(a)")
+    calculate()
+    expect_results([[], [], [], ['x'], []])
+    statements = [chunk.statement for chunk in worksheet.iterate_chunks()]
+    assert_equals([s.result_scope is not None for s in statements], [False, True, False, True, True])
+    assert_equals(worksheet.scope_evictions, 2)
+    assert_equals(statements[3].result_scope['b'][-1], 1)
+
+    # Completion rebuilds from the previous checkpoint
+    del executed[:]
+    obj = worksheet.get_object_at_location(2, 0)[0]
+    assert_equals(len(obj), 201)
+    assert_equals(worksheet.scope_rebuilds, 1)
+    assert_equals(executed, [])
+    expect_results([[], [], [], ['x'], []])
+
+    # Executing a later statement rebuilds the parent scope
+    statements[3].evict_result_scope()
+    delete(4, 0, 4, 10)
+    insert(4, 0, "c = len(b)")
+    calculate()
+    assert_equals(worksheet.get_chunk(4).statement.result_scope['c'], 101)
+    assert_equals(worksheet.scope_rebuilds, 2)
+
+    # An object bound by a statement whose scope isn't kept is modified without
+    # copying it; the scope of the statement that bound it is rebuilt if needed
+    clear()
+    worksheet.scope_memory_budget = 1024 * 1024 * 1024
+    insert(0, 0, "a = [1]\na.append(2)\nc = a\nc.append(3)")
+    calculate()
+    statements = [chunk.statement for chunk in worksheet.iterate_chunks()]
+    assert_equals([s.result_scope is not None for s in statements], [False, True, True, True])
+    assert_equals(statements[1].result_scope['a'], [1, 2])
+    assert_equals(statements[3].result_scope['a'], [1, 2])
+    assert_equals(statements[3].result_scope['c'], [1, 2, 3])
+    delete(1, 0, 1, 11)
+    insert(1, 0, "a.append(5)")
+    calculate()
+    assert_equals(worksheet.get_chunk(1).statement.result_scope['a'], [1, 5])
+    worksheet.scope_memory_budget = None
+
+    # Execution times are recorded for each statement
+    clear()
+    insert(0, 0, "import time\ntime.sleep(0.05)\na = 1")
+    calculate()
+    slowest = worksheet.get_slowest_statements()
+    assert_equals([chunk.start for chunk, _, _, _ in slowest][0], 1)
+    assert slowest[0][2] >= 0.05
+    assert_equals(len(worksheet.get_slowest_statements(sort_by='compile_time', count=2)), 2)
+    chunk = worksheet.get_chunk(1)
+    assert chunk.get_cost() >= 0.05
+    assert chunk.compile_time is not None
+
+    # Reused results don't add to the history
+    worksheet.get_chunk(2).mark_for_execute()
+    calculate()
+    assert_equals(len(worksheet.get_chunk(2).execute_times), 1)
+    chunk.mark_for_execute()
+    chunk.statement.mark_for_execute(allow_reuse=False)
+    calculate()
+    assert_equals(len(chunk.execute_times), 2)
+
+    # Profiling a single statement adds the profile to its results
+    from profiler import ProfileResult
+    clear()
+    insert(0, 0, "def f(x):\n    return x + 1\na = f(1)\nb = f(a)")
+    calculate()
+    worksheet.profile(line=2, wait=True)
+    results = worksheet.get_chunk(2).results
+    assert_equals(len(results), 1)
+    assert isinstance(results[0], ProfileResult)
+    assert "f" in [row[0][row[0].find('(') + 1:-1] for row in results[0].get_rows()]
+    assert_equals(worksheet.get_chunk(3).results, [])
+    assert_equals(worksheet.get_chunk(2).statement.profiler, None)
+
+    # Profiling the whole calculation adds the profile to the last statement
+    worksheet.profile(sampling=True, wait=True)
+    assert_equals(worksheet.get_chunk(2).results, [])
+    assert isinstance(worksheet.get_chunk(3).results[0], ProfileResult)
+    assert worksheet.get_chunk(3).results[0].sampled
+
+    # If a statement fails, the profile is added to that statement
+    insert(3, 0, "c = d\n")
+    worksheet.profile(wait=True)
+    chunk = worksheet.get_chunk(3)
+    assert chunk.error_message is not None
+    assert isinstance(chunk.results[0], ProfileResult)
+    worksheet.calculate(wait=True)
+    assert_equals(worksheet.get_chunk(3).results, None)
+
+    # A comment sets the timeout of a statement
+    clear()
+    insert(0, 0, "a = 1 # timeout: 2.5\nb = 2")
+    assert_equals([chunk.timeout for chunk in worksheet.iterate_chunks()], [2.5, None])
+    delete(0, 5, 0, 20)
+    assert_equals(worksheet.get_chunk(0).timeout, None)
+
+    # But not text in a string, and 0 or 'none' is no limit, even with a
+    # timeout set for the worksheet
+    clear()
+    insert(0, 0, "print '# timeout: 5'\nprint 1 # timeout: 0\nprint 2 # Timeout: None")
+    assert_equals([chunk.timeout for chunk in worksheet.iterate_chunks()], [None, 0, 0])
+    worksheet.statement_timeout = 10
+    calculate()
+    assert_equals([chunk.statement.timeout for chunk in worksheet.iterate_chunks()], [10, None, None])
+    expect_results([['# timeout: 5'], ['1'], ['2']])
+    worksheet.statement_timeout = None
+
     #
     # Test out signals and expect_log()
     #
@@ -1219,6 +1986,21 @@ if __name__ == '__main__': #pragma: no cover
     insert(0, 0, "#")
     expect_log([CD(), CI(0,1)])
 
+    # Output is shown while the statement producing it executes, by adding to
+    # the results rather than replacing them
+    clear()
+    insert(0, 0, "import time\nfor i in xrange(0, 3):\n    print i\n    time.sleep(0.3)")
+    clear_log()
+    # With wait=True, the changes would only be signalled once calculation is done
+    loop = gobject.MainLoop()
+    handler = worksheet.connect('notify::state', lambda *args: worksheet.state != NotebookFile.EXECUTING and loop.quit())
+    worksheet.calculate()
+    loop.run()
+    worksheet.disconnect(handler)
+    assert_equals([e for e in log if isinstance(e, (CRC, CRA)) and e.start == 1],
+                  [CRC(1,4), CRA(1,4,['1']), CRA(1,4,['2'])])
+    expect_results([[], ['0', '1', '2']])
+
     # Deleting a chunk with results
     clear()
     insert(0, 0, "1\n2")
@@ -1380,6 +2162,20 @@ if __name__ == '__main__': #pragma: no cover
     worksheet.redo()
     expect_text("2")
 
+    # With a small undo memory budget, older edits are kept on disk
+    clear()
+    worksheet.undo_memory_budget = 4
+    insert(0, 0, "1234")
+    insert(0, 4, "\n5678")
+    insert(1, 4, "\n9")
+    worksheet.undo()
+    worksheet.undo()
+    expect_text("1234")
+    worksheet.redo()
+    expect_text("1234\n5678")
+    worksheet.undo_memory_budget = None
+    assert_equals(worksheet.undo_memory_budget, None)
+
     #
     # Tests of get_text()
     #
@@ -1444,12 +2240,146 @@ b = 2"""
         if saved != SAVE_TEST:
             raise AssertionError("Got '%s', expected '%s'", saved, SAVE_TEST)
 
+        # Loading replaces the text and chunks all at once
+        clear_log()
         worksheet.load(fname)
+        expect_log([R()])
+        expect([S(0,1), S(1,2), C(2,3), B(3,4), S(4,5)])
+        assert_equals(worksheet.state, NotebookFile.NEEDS_EXECUTE)
         calculate()
 
         expect_text(SAVE_TEST)
         expect([S(0,1), S(1,2), C(2,3), B(3,4), S(4,5)])
         expect_results([[], ['1'], None, None, []])
+
+        # Editing after loading
+        insert(1, 1, "\n")
+        expect([S(0,1), S(1,2), B(2,3), C(3,4), B(4,5), S(5,6)])
+        delete(1, 1, 2, 0)
+        expect([S(0,1), S(1,2), C(2,3), B(3,4), S(4,5)])
+    finally:
+        os.remove(fname)
+
+    # With snapshots, the results of statements are restored when the worksheet is loaded again
+    import shutil
+    from snapshot_store import get_snapshot_directory
+
+    handle, fname = tempfile.mkstemp(".rws", "reinteract_worksheet")
+    os.close(handle)
+
+    try:
+        clear()
+        worksheet.save_snapshots = True
+        worksheet.snapshot_min_time = 0
+        insert(0, 0, "import os\na = [1, 2]\nprint len(a)\ng = (x for x in a)")
+        worksheet.save(fname)
+        calculate()
+        results = worksheet.get_chunk(3).results
+        assert_equals(results[0].message, "Can't save 'g' in a snapshot: can't pickle generator objects")
+
+        worksheet.load(fname)
+        calculate()
+        assert_equals([chunk.results for chunk in worksheet.iterate_chunks()][0:3], [[], [], ['2']])
+        assert_equals([chunk.statement.restored for chunk in worksheet.iterate_chunks()],
+                      [True, True, True, False])
+        assert_equals(worksheet.get_chunk(1).statement.result_scope['a'], [1, 2])
+
+        # Snapshots after a changed statement aren't used, and are removed
+        delete(1, 0, 1, 10)
+        insert(1, 0, "a = [1, 2, 3]")
+        calculate()
+        assert_equals([chunk.results for chunk in worksheet.iterate_chunks()][0:3], [[], [], ['3']])
+        assert_equals([chunk.statement.restored for chunk in worksheet.iterate_chunks()],
+                      [True, False, False, False])
+        assert_equals(len(os.listdir(get_snapshot_directory(fname))), 3)
+
+        worksheet.clear_snapshots()
+        assert not os.path.exists(get_snapshot_directory(fname))
+        worksheet.save_snapshots = False
+    finally:
+        os.remove(fname)
+        shutil.rmtree(get_snapshot_directory(fname), ignore_errors=True)
+
+    # With a journal, edits that weren't saved are recovered when the file is loaded again
+    from edit_journal import get_journal_filename
+
+    handle, fname = tempfile.mkstemp(".rws", "reinteract_worksheet")
+    os.close(handle)
+
+    try:
+        clear()
+        worksheet.save_journal = True
+        insert(0, 0, "a = 1")
+        worksheet.save(fname)
+        insert(0, 5, "\nb = 2")
+        delete(0, 4, 0, 5)
+        insert(0, 4, "3")
+        worksheet.sync_journal()
+
+        other = Worksheet(Notebook())
+        other.save_journal = True
+        other.load(fname)
+        assert_equals(other.get_text(), "a = 3\nb = 2")
+        assert other.code_modified
+
+        # Once the edits are saved, the journal is removed
+        other.save()
+        assert not os.path.exists(get_journal_filename(fname))
+        other.load(fname)
+        assert not other.code_modified
+
+        # Closing the worksheet discards the edits
+        other.insert(0, 0, "c = 1\n")
+        other.sync_journal()
+        assert os.path.exists(get_journal_filename(fname))
+        other.close()
+        assert not os.path.exists(get_journal_filename(fname))
+
+        clear()
+        worksheet.save_journal = False
+    finally:
+        os.remove(fname)
+
+    # Saving in the background
+    handle, fname = tempfile.mkstemp(".rws", "reinteract_worksheet")
+    os.close(handle)
+
+    try:
+        clear()
+        saved = []
+        loop = gobject.MainLoop()
+        def on_saved(worksheet, filename, error):
+            saved.append((filename, error))
+            loop.quit()
+        handler_id = worksheet.connect('saved', on_saved)
+
+        insert(0, 0, "a = 1")
+        worksheet.save(fname, wait=False)
+        # Edits while saving are still unsaved afterwards
+        insert(0, 5, "\nb = 2")
+        loop.run()
+        assert_equals(saved, [(fname, None)])
+        assert_equals(worksheet.filename, fname)
+        assert worksheet.code_modified
+        assert_equals(worksheet.last_save_size, 5)
+        f = open(fname, "r")
+        assert_equals(f.read(), "a = 1")
+        f.close()
+
+        worksheet.save()
+        assert not worksheet.code_modified
+        assert_equals(len(saved), 2)
+
+        # Errors are raised when waiting, and passed to ::saved
+        try:
+            worksheet.save(os.path.join(fname + ".missing", "test.rws"))
+            raise AssertionError("Saving should have failed")
+        except IOError:
+            pass
+        assert isinstance(saved[2][1], IOError)
+        assert_equals(worksheet.filename, fname)
+
+        worksheet.disconnect(handler_id)
     finally:
         os.remove(fname)
 
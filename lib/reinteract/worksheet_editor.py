@@ -15,6 +15,7 @@ import pango
 from application import application
 from editor import Editor
 from global_settings import global_settings
+from memo_cache import MemoCache
 from shell_buffer import ShellBuffer
 from shell_view import ShellView
 
@@ -32,6 +33,25 @@ class WorksheetEditor(Editor):
         self.__font_name_connection = global_settings.connect('notify::editor-font-name', self.__update_font)
         self.__update_font()
 
+        self.__execute_in_subprocess_connection = global_settings.connect('notify::execute-in-subprocess', self.__update_execute_in_subprocess)
+        self.__update_execute_in_subprocess()
+        self.__parallel_statements_connection = global_settings.connect('notify::parallel-statements', self.__update_parallel_statements)
+        self.__update_parallel_statements()
+        self.__max_update_rate_connection = global_settings.connect('notify::max-update-rate', self.__update_max_update_rate)
+        self.__update_max_update_rate()
+        self.__statement_timeout_connection = global_settings.connect('notify::statement-timeout', self.__update_statement_timeout)
+        self.__update_statement_timeout()
+        self.__save_snapshots_connection = global_settings.connect('notify::save-snapshots', self.__update_save_snapshots)
+        self.__update_save_snapshots()
+        self.__save_journal_connection = global_settings.connect('notify::save-journal', self.__update_save_journal)
+        self.__update_save_journal()
+        self.__memoize_statements_connection = global_settings.connect('notify::memoize-statements', self.__update_memoize_statements)
+        self.__update_memoize_statements()
+        self.__undo_memory_budget_connection = global_settings.connect('notify::undo-memory-budget', self.__update_undo_memory_budget)
+        self.__update_undo_memory_budget()
+        self.__show_execution_times_connection = global_settings.connect('notify::show-execution-times', self.__update_show_execution_times)
+        self.__update_show_execution_times()
+
         self.widget = gtk.ScrolledWindow()
         self.widget.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
 
@@ -43,6 +63,7 @@ class WorksheetEditor(Editor):
         self.buf.worksheet.connect('notify::file', lambda *args: self._update_file())
         self.buf.worksheet.connect('notify::code-modified', lambda *args: self._update_modified())
         self.buf.worksheet.connect('notify::state', lambda *args: self._update_state())
+        self.buf.worksheet.connect('saved', self._on_saved)
 
     #######################################################
     # Callbacks
@@ -55,6 +76,46 @@ class WorksheetEditor(Editor):
 
         self.view.modify_font(pango.FontDescription(font_name))
 
+    def __update_execute_in_subprocess(self, *arg):
+        self.buf.worksheet.execute_in_subprocess = global_settings.execute_in_subprocess
+
+    def __update_parallel_statements(self, *arg):
+        self.buf.worksheet.parallel_statements = global_settings.parallel_statements
+
+    def __update_max_update_rate(self, *arg):
+        if global_settings.max_update_rate > 0:
+            self.buf.worksheet.max_update_rate = global_settings.max_update_rate
+        else:
+            self.buf.worksheet.max_update_rate = None
+
+    def __update_statement_timeout(self, *arg):
+        if global_settings.statement_timeout > 0:
+            self.buf.worksheet.statement_timeout = global_settings.statement_timeout
+        else:
+            self.buf.worksheet.statement_timeout = None
+
+    def __update_save_snapshots(self, *arg):
+        self.buf.worksheet.save_snapshots = global_settings.save_snapshots
+
+    def __update_save_journal(self, *arg):
+        self.buf.worksheet.save_journal = global_settings.save_journal
+
+    def __update_memoize_statements(self, *arg):
+        if global_settings.memoize_statements:
+            if self.buf.worksheet.memo_cache is None:
+                self.buf.worksheet.memo_cache = MemoCache()
+        else:
+            self.buf.worksheet.memo_cache = None
+
+    def __update_undo_memory_budget(self, *arg):
+        if global_settings.undo_memory_budget > 0:
+            self.buf.worksheet.undo_memory_budget = global_settings.undo_memory_budget
+        else:
+            self.buf.worksheet.undo_memory_budget = None
+
+    def __update_show_execution_times(self, *arg):
+        self.view.set_show_execution_times(global_settings.show_execution_times)
+
     #######################################################
     # Overrides
     #######################################################
@@ -80,8 +141,8 @@ class WorksheetEditor(Editor):
     def _get_extension(self):
         return "rws"
 
-    def _save(self, filename):
-        self.buf.worksheet.save(filename)
+    def _save(self, filename, wait=True):
+        self.buf.worksheet.save(filename, wait=wait)
 
     #######################################################
     # Public API
@@ -92,6 +153,15 @@ class WorksheetEditor(Editor):
         self.buf.worksheet.close()
         global_settings.disconnect(self.__font_is_custom_connection)
         global_settings.disconnect(self.__font_name_connection)
+        global_settings.disconnect(self.__execute_in_subprocess_connection)
+        global_settings.disconnect(self.__parallel_statements_connection)
+        global_settings.disconnect(self.__max_update_rate_connection)
+        global_settings.disconnect(self.__statement_timeout_connection)
+        global_settings.disconnect(self.__save_snapshots_connection)
+        global_settings.disconnect(self.__save_journal_connection)
+        global_settings.disconnect(self.__memoize_statements_connection)
+        global_settings.disconnect(self.__undo_memory_budget_connection)
+        global_settings.disconnect(self.__show_execution_times_connection)
 
     def load(self, filename, escape=False):
         self.buf.worksheet.load(filename, escape=escape)
@@ -101,6 +171,12 @@ class WorksheetEditor(Editor):
     def calculate(self):
         self.view.calculate()
 
+    def profile(self, whole_calculation=False):
+        self.view.profile(whole_calculation)
+
+    def clear_snapshots(self):
+        self.buf.worksheet.clear_snapshots()
+
     def undo(self):
         self.buf.worksheet.undo()
 
@@ -0,0 +1,227 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import gobject
+import logging
+
+from notebook import NotebookFile
+
+_debug = logging.getLogger("WorksheetScheduler").debug
+
+def get_cpu_count():
+    """Return the number of processors on the system, or 1 if it can't be determined"""
+
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+class WorksheetScheduler(gobject.GObject):
+    """Class to calculate a set of worksheets, several at a time
+
+    Worksheets are calculated in the order they were added, with at most max_jobs
+    worksheets calculating at once. Worksheets are independent of each other, so
+    when the worksheets execute in separate processes (see
+    L{Worksheet.execute_in_subprocess}), calculation scales with the number of
+    processors; the scheduler can switch worksheets to executing in a separate
+    process before they are calculated. The progress of each worksheet is
+    visible in the state of the worksheet and its L{NotebookFile}.
+
+    Signals
+    =======
+     - B{worksheet-started}(scheduler, worksheet): emitted when the scheduler starts calculating a worksheet
+     - B{worksheet-complete}(scheduler, worksheet): emitted when calculation of a worksheet is finished
+     - B{complete}(scheduler): emitted when calculation of all worksheets is finished
+
+    """
+
+    __gsignals__ = {
+        'worksheet-started' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
+        'worksheet-complete' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
+        'complete' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
+    }
+
+    def __init__(self, max_jobs=None, execute_in_subprocess=False):
+        """Initialize the WorksheetScheduler object
+
+        @param max_jobs: maximum number of worksheets to calculate at once. Defaults to the
+           number of processors.
+        @param execute_in_subprocess: if True, set L{Worksheet.execute_in_subprocess} on
+           worksheets before calculating them. Since switching discards the results of
+           the worksheet, worksheets are left executing in a subprocess afterwards, so
+           this is meant for worksheets that are only calculated once, as by
+           reinteract-run. Otherwise the worksheets are calculated as they are set up.
+
+        """
+        gobject.GObject.__init__(self)
+
+        if max_jobs is None:
+            max_jobs = get_cpu_count()
+        self.max_jobs = max(1, max_jobs)
+
+        self.execute_in_subprocess = execute_in_subprocess
+
+        self.started = False
+        self.complete = False
+
+        self.__queue = []
+        self.__running = {}
+        self.__starting = False
+
+    def add_worksheet(self, worksheet, calculate=None):
+        """Add a worksheet to be calculated. Worksheets that have already been added and
+        haven't finished calculating are ignored.
+
+        @param worksheet: the worksheet to calculate
+        @param calculate: function to call to calculate the worksheet. Defaults to worksheet.calculate
+
+        """
+        if worksheet in self.__running:
+            return
+        for w, _ in self.__queue:
+            if w == worksheet:
+                return
+
+        if calculate is None:
+            calculate = worksheet.calculate
+
+        self.__queue.append((worksheet, calculate))
+        self.complete = False
+
+        if self.started:
+            self.__start_more()
+
+    def start(self):
+        """Start calculating worksheets"""
+
+        self.started = True
+        self.__start_more()
+
+    def interrupt(self):
+        """Interrupt the worksheets being calculated, and don't start calculating any more"""
+
+        self.__queue = []
+        for worksheet in self.__running.keys():
+            worksheet.interrupt()
+
+    def __finish(self, worksheet):
+        worksheet.disconnect(self.__running.pop(worksheet))
+        _debug("Finished calculating %s", worksheet.filename)
+        self.emit('worksheet-complete', worksheet)
+
+    def __start_more(self):
+        self.__starting = True
+        try:
+            while len(self.__running) < self.max_jobs and len(self.__queue) > 0:
+                worksheet, calculate = self.__queue.pop(0)
+                # Another caller may have started calculating it
+                if worksheet.state == NotebookFile.EXECUTING:
+                    continue
+
+                if self.execute_in_subprocess:
+                    worksheet.execute_in_subprocess = True
+
+                self.__running[worksheet] = worksheet.connect('notify::state', self.__on_notify_state)
+                _debug("Calculating %s", worksheet.filename)
+                self.emit('worksheet-started', worksheet)
+                calculate()
+
+                # If there was nothing to execute, calculation is already finished
+                if worksheet in self.__running and worksheet.state != NotebookFile.EXECUTING:
+                    self.__finish(worksheet)
+        finally:
+            self.__starting = False
+
+        if len(self.__running) == 0 and len(self.__queue) == 0 and not self.complete:
+            self.complete = True
+            self.emit('complete')
+
+    def __on_notify_state(self, worksheet, pspec):
+        if worksheet.state == NotebookFile.EXECUTING or worksheet not in self.__running:
+            return
+
+        self.__finish(worksheet)
+        if not self.__starting:
+            self.__start_more()
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    gobject.threads_init()
+
+    import stdout_capture
+    stdout_capture.init()
+
+    import time
+
+    from notebook import Notebook
+    from test_utils import assert_equals
+    from worksheet import Worksheet
+
+    notebook = Notebook()
+
+    def create_worksheet(text):
+        worksheet = Worksheet(notebook)
+        worksheet.insert(0, 0, text)
+        return worksheet
+
+    worksheets = [create_worksheet("import time\ntime.sleep(0.1)\n%d" % i) for i in xrange(0, 4)]
+    worksheets.append(create_worksheet("a ="))
+    worksheets.append(create_worksheet(""))
+
+    scheduler = WorksheetScheduler(max_jobs=2, execute_in_subprocess=True)
+    for worksheet in worksheets:
+        scheduler.add_worksheet(worksheet)
+    scheduler.add_worksheet(worksheets[0])
+
+    global running, max_running
+    running = max_running = 0
+    order = []
+    def on_worksheet_started(scheduler, worksheet):
+        global running, max_running
+        running += 1
+        max_running = max(running, max_running)
+    def on_worksheet_complete(scheduler, worksheet):
+        global running
+        running -= 1
+        order.append(worksheets.index(worksheet))
+
+    loop = gobject.MainLoop()
+    scheduler.connect('worksheet-started', on_worksheet_started)
+    scheduler.connect('worksheet-complete', on_worksheet_complete)
+    scheduler.connect('complete', lambda scheduler: loop.quit())
+
+    start = time.time()
+    scheduler.start()
+    loop.run()
+
+    assert_equals(max_running, 2)
+    assert_equals(sorted(order), range(0, 6))
+    assert_equals([w.state for w in worksheets],
+                  [NotebookFile.EXECUTE_SUCCESS] * 4 + [NotebookFile.ERROR, NotebookFile.EXECUTE_SUCCESS])
+    assert_equals(scheduler.complete, True)
+
+    # The worksheets were switched to execute in separate processes
+    assert_equals([w.execute_in_subprocess for w in worksheets], [True] * 6)
+    for worksheet in worksheets:
+        worksheet.close()
+
+    # But otherwise they are left alone, keeping their results
+    worksheet = create_worksheet("1")
+    worksheet.calculate(wait=True)
+    statement = worksheet.get_chunk(0).statement
+    scheduler = WorksheetScheduler(max_jobs=2)
+    scheduler.add_worksheet(worksheet)
+    scheduler.connect('complete', lambda scheduler: loop.quit())
+    scheduler.start()
+    if not scheduler.complete:
+        loop.run()
+    assert_equals(worksheet.execute_in_subprocess, False)
+    assert_equals(worksheet.state, NotebookFile.EXECUTE_SUCCESS)
+    assert worksheet.get_chunk(0).statement is statement
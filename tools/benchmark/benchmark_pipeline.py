@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+#
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+# Benchmarks for compiling and executing statements, comparing each step of
+# the pipeline (rewriting, copying scopes and mutated objects, executing in
+# a thread) against plain compile() and exec. The statements come from the
+# example worksheets and from synthetic worksheets with many global names
+# and with large containers that are modified in place.
+
+import glob
+import logging
+import os
+import StringIO
+import sys
+
+script = os.path.abspath(sys.argv[0])
+scriptdir = os.path.dirname(script)
+toolsdir = os.path.dirname(scriptdir)
+topdir = os.path.dirname(toolsdir)
+
+sys.path[0:0] = (toolsdir,)
+
+from common.benchmark import generate_worksheet_text, main, setup_path
+
+setup_path(topdir)
+
+import gobject
+
+from reinteract.chunks import StatementChunk
+from reinteract.notebook import Notebook
+from reinteract.rewrite import Rewriter
+from reinteract.scope import flatten_scope
+from reinteract.statement import Statement
+import reinteract.stdout_capture as stdout_capture
+from reinteract.thread_executor import ThreadExecutor
+from reinteract.worksheet import Worksheet
+
+_logger = logging.getLogger("Benchmark")
+
+# Pipeline benchmarks are per-statement, and much faster than whole-worksheet operations
+DEFAULT_SIZES = (100, 1000)
+MIN_DIFFERENCE = 5 # microseconds
+
+# Number of elements in each container of the 'containers' worksheet
+CONTAINER_SIZE = 200000
+
+CONTAINERS_TEXT = """\
+l = range(0, %(size)d)
+d = dict((i, str(i)) for i in xrange(0, %(size)d))
+s = set(l)
+l.append(1)
+l[0] = 2
+d[0] = 'zero'
+s.add(-1)
+len(l) + len(d) + len(s)
+""" % { 'size': CONTAINER_SIZE }
+
+def get_statements(notebook, text):
+    # Split the text into statements the same way that a worksheet does
+    worksheet = Worksheet(notebook)
+    worksheet.insert(0, 0, text)
+    statements = [chunk.tokenized.get_text() for chunk in worksheet.iterate_chunks()
+                  if isinstance(chunk, StatementChunk)]
+    worksheet.close()
+
+    return statements
+
+def exec_plain(statements):
+    scope = {}
+    old_stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        for text in statements:
+            exec compile(text, '<statement>', 'exec') in scope, scope
+    finally:
+        sys.stdout = old_stdout
+
+def get_executable_prefix(name, statements):
+    # Statements in the examples may depend on modules that aren't installed
+    # here; keep only the statements before the first one that fails
+    scope = {}
+    old_stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        for i, text in enumerate(statements):
+            try:
+                exec compile(text, '<statement>', 'exec') in scope, scope
+            except Exception, e:
+                _logger.warning("%s: only using the first %d statements: %s", name, i, e)
+                return statements[0:i]
+    finally:
+        sys.stdout = old_stdout
+
+    return statements
+
+def create_statements(worksheet, statements):
+    result = []
+    parent = None
+    for text in statements:
+        statement = Statement(text, worksheet, parent)
+        result.append(statement)
+        parent = statement
+
+    return result
+
+def run_corpus(timer, worksheet, name, statements):
+    count = len(statements)
+    if count == 0:
+        return
+
+    # Compilation
+    timer.measure("compile/%s" % name,
+                  lambda: [compile(text, '<statement>', 'exec') for text in statements],
+                  count=count)
+    def rewrite():
+        for text in statements:
+            Rewriter(text).rewrite_and_compile(output_func_name='reinteract_output',
+                                               copy_func_name="__reinteract_copy")
+    timer.measure("rewrite/%s" % name, rewrite, count=count)
+
+    compiled = []
+    def create():
+        compiled[:] = create_statements(worksheet, statements)
+    def compile_statements():
+        for statement in compiled:
+            statement.compile()
+    timer.measure("statement_compile/%s" % name, compile_statements, setup=create, count=count)
+
+    # Execution; plain exec first, so the memory increase of executing
+    # statements is what they need beyond plain exec
+    timer.measure("exec/%s" % name, lambda: exec_plain(statements), count=count, track_memory=True)
+
+    def execute_statements():
+        for statement in compiled:
+            statement.execute()
+    def release():
+        compiled[:] = []
+    def check():
+        for statement in compiled:
+            if statement.state != Statement.EXECUTE_SUCCESS:
+                raise AssertionError("%s: executing %r failed: %s" %
+                                     (name, statement.get_text(), statement.error_message))
+    timer.measure("execute/%s" % name, execute_statements, setup=lambda: (create(), compile_statements()),
+                  teardown=lambda: (check(), release()), count=count, track_memory=True)
+
+    # Copying the scope that each statement is executed in; this is part of
+    # the execution time above
+    def flatten():
+        for statement in compiled:
+            flatten_scope(statement.get_parent_scope())
+    timer.measure("flatten/%s" % name, flatten, setup=lambda: (create(), compile_statements(), execute_statements()),
+                  teardown=release, count=count)
+
+    # Compiling and executing in a thread, until the executor signals completion
+    loop = gobject.MainLoop()
+    executor = []
+    def create_executor():
+        executor[:] = [ThreadExecutor()]
+        for statement in create_statements(worksheet, statements):
+            executor[0].add_statement(statement)
+        executor[0].connect('complete', lambda executor: loop.quit())
+    def run_executor():
+        if executor[0].compile():
+            executor[0].execute()
+            loop.run()
+    timer.measure("executor/%s" % name, run_executor, setup=create_executor,
+                  teardown=lambda: executor.pop(), count=count)
+
+def run(timer, sizes):
+    notebook = Notebook()
+    worksheet = Worksheet(notebook)
+    # Each statement is executed several times; we want to time executing it,
+    # not finding the results of the last time in the memo cache
+    worksheet.memo_cache = None
+
+    corpus = []
+    for filename in sorted(glob.glob(os.path.join(topdir, 'examples', '*.rws'))):
+        name = os.path.basename(filename)[:-4]
+        f = open(filename)
+        text = f.read().decode("UTF-8")
+        f.close()
+        corpus.append((name, get_executable_prefix(name, get_statements(notebook, text))))
+
+    for size in sizes:
+        corpus.append(("globals%d" % size, get_statements(notebook, generate_worksheet_text(size))))
+
+    corpus.append(("containers", get_statements(notebook, CONTAINERS_TEXT)))
+
+    for name, statements in corpus:
+        run_corpus(timer, worksheet, name, statements)
+
+    worksheet.close()
+
+if __name__ == '__main__':
+    gobject.threads_init()
+    stdout_capture.init()
+
+    sys.exit(main("pipeline", run,
+                  description="Time compiling and executing statements, per statement, "
+                              "compared to plain compile() and exec, and write the results as JSON.",
+                  default_sizes=DEFAULT_SIZES, min_difference=MIN_DIFFERENCE))
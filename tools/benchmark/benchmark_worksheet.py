@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+# Benchmarks for the text and chunk model of a worksheet (lib/reinteract/worksheet.py),
+# simulating typing, pasting, deleting and loading in synthetic worksheets of
+# different sizes. Nothing is calculated.
+
+import os
+import shutil
+import sys
+import tempfile
+
+script = os.path.abspath(sys.argv[0])
+scriptdir = os.path.dirname(script)
+toolsdir = os.path.dirname(scriptdir)
+topdir = os.path.dirname(toolsdir)
+
+sys.path[0:0] = (toolsdir,)
+
+from common.benchmark import generate_worksheet_text, main, setup_path
+
+setup_path(topdir)
+
+from reinteract.notebook import Notebook
+from reinteract.worksheet import Worksheet
+
+# A line typed a character at a time
+TYPED_TEXT = "result = compute(v0, 42) * 2\n"
+
+# Number of lines pasted or deleted at once, if the worksheet has enough lines
+# after the middle
+BLOCK_LINES = 100
+
+# The block must be at least a line, and end before the last line
+MIN_SIZE = 3
+
+def user_action(worksheet, func, *args):
+    # Do an edit the way that the user interface does, so that the chunks are
+    # rescanned at the end
+    worksheet.begin_user_action()
+    try:
+        func(*args)
+    finally:
+        worksheet.end_user_action()
+
+def run_size(timer, notebook, filename, size):
+    worksheet = Worksheet(notebook)
+
+    timer.measure("load/%d" % size, lambda: worksheet.load(filename))
+
+    # Edit in the middle, so that the lines and chunks after the edit need to
+    # be adjusted as well
+    middle = size // 2
+    block_lines = min(BLOCK_LINES, size - middle - 1)
+    block = generate_worksheet_text(block_lines, seed=size) + "\n"
+
+    def type_text():
+        offset = 0
+        for c in TYPED_TEXT:
+            user_action(worksheet, worksheet.insert, middle, offset, c)
+            offset += 1
+    def delete_typed():
+        user_action(worksheet, worksheet.delete_range, middle, 0, middle + 1, 0)
+    timer.measure("typing/%d" % size, type_text, teardown=delete_typed)
+
+    def paste():
+        user_action(worksheet, worksheet.insert, middle, 0, block)
+    def delete_block():
+        user_action(worksheet, worksheet.delete_range, middle, 0, middle + block_lines, 0)
+    timer.measure("paste/%d" % size, paste, teardown=delete_block)
+
+    deleted = []
+    def save_block():
+        deleted[:] = [worksheet.get_text(middle, 0, middle + block_lines, 0)]
+    def restore_block():
+        user_action(worksheet, worksheet.insert, middle, 0, deleted[0])
+    timer.measure("block_delete/%d" % size, delete_block, setup=save_block, teardown=restore_block)
+
+    # Indenting a line changes it into a continuation line, so the statements
+    # around it have to be rescanned
+    def indent():
+        worksheet.begin_user_action()
+        worksheet.insert(middle, 0, "    ")
+    def unindent():
+        worksheet.end_user_action()
+        user_action(worksheet, worksheet.delete_range, middle, 0, middle, 4)
+    timer.measure("rescan/%d" % size, worksheet.rescan, setup=indent, teardown=unindent)
+
+    timer.measure("undo/%d" % size, worksheet.undo, setup=paste)
+    def paste_and_undo():
+        paste()
+        worksheet.undo()
+    timer.measure("redo/%d" % size, worksheet.redo, setup=paste_and_undo, teardown=worksheet.undo)
+
+    timer.measure("get_text/%d" % size, worksheet.get_text)
+
+    assert worksheet.get_line_count() == size
+
+    worksheet.close()
+
+def run(timer, sizes):
+    notebook = Notebook()
+    tmpdir = tempfile.mkdtemp("", "benchmark_worksheet")
+    try:
+        for size in sizes:
+            filename = os.path.join(tmpdir, "benchmark%d.rws" % size)
+            f = open(filename, "w")
+            f.write(generate_worksheet_text(size))
+            f.close()
+
+            run_size(timer, notebook, filename, size)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    sys.exit(main("worksheet", run,
+                  description="Time editing operations on synthetic worksheets of "
+                              "different sizes and write the results as JSON.",
+                  min_size=MIN_SIZE))
@@ -0,0 +1,300 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import logging
+from optparse import OptionParser
+import os
+import platform
+import random
+import sys
+from timeit import default_timer
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; memory isn't measured there
+    resource = None
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+_logger = logging.getLogger("Benchmark")
+
+# Number of lines in the synthetic worksheets used by default
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+# Each operation is timed this many times, and the fastest time is kept
+DEFAULT_REPEAT = 3
+
+# A result more than this many times the baseline result is a regression
+DEFAULT_TOLERANCE = 1.5
+
+# Differences below this are noise, whatever the ratio to the baseline
+DEFAULT_MIN_DIFFERENCE = 2000 # microseconds
+
+def setup_path(topdir):
+    """Make the reinteract package in the source tree importable"""
+
+    sys.path[0:0] = (os.path.join(topdir, 'lib'),)
+
+def generate_worksheet_lines(line_count, seed=0):
+    """
+    Generate the lines of a synthetic worksheet
+
+    The worksheet is a mix of single-line statements, multi-line compound
+    statements, comments and blank lines, in roughly the proportions of a
+    typical worksheet. Statements only use names bound earlier in the
+    worksheet, and each takes negligible time, so the worksheet can also be
+    calculated.
+
+    @param line_count: number of lines to generate
+    @param seed: seed for the random choices, so that the same worksheet is generated each time
+    @returns: a list of lines, without newlines
+
+    """
+    rng = random.Random(seed)
+    lines = []
+    variables = 0
+    functions = 0
+
+    while len(lines) < line_count:
+        remaining = line_count - len(lines)
+        r = rng.random()
+        if r < 0.15:
+            lines.append("")
+        elif r < 0.3:
+            lines.append("# Step %d: combine the previous values" % len(lines))
+        elif r < 0.4 and remaining >= 3:
+            lines.append("def f%d(x):" % functions)
+            lines.append("    y = x + %d" % rng.randint(0, 100))
+            lines.append("    return y * 2")
+            functions += 1
+        elif r < 0.45 and remaining >= 2 and variables > 0:
+            lines.append("for i in xrange(0, 3):")
+            lines.append("    v%d = v%d + i" % (variables, rng.randrange(variables)))
+            variables += 1
+        elif r < 0.55 and functions > 0 and variables > 0:
+            lines.append("f%d(v%d)" % (rng.randrange(functions), rng.randrange(variables)))
+        elif r < 0.6 and variables > 0:
+            lines.append("print \"value:\", v%d" % rng.randrange(variables))
+        elif r < 0.7 and variables > 1:
+            lines.append("v%d + v%d" % (rng.randrange(variables), rng.randrange(variables)))
+        elif variables > 0:
+            lines.append("v%d = v%d * 2 + %d" % (variables, rng.randrange(variables), rng.randint(0, 100)))
+            variables += 1
+        else:
+            lines.append("v%d = %d" % (variables, rng.randint(0, 100)))
+            variables += 1
+
+    return lines
+
+def generate_worksheet_text(line_count, seed=0):
+    """Generate the text of a synthetic worksheet. See generate_worksheet_lines()"""
+
+    return "\n".join(generate_worksheet_lines(line_count, seed))
+
+def get_peak_memory():
+    """Get the peak memory use of the process so far
+
+    @returns: the peak resident set size in kilobytes, or None if it can't be found out
+
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Bytes rather than kilobytes
+        peak //= 1024
+
+    return peak
+
+class Timer(object):
+    """
+    The Timer class times named operations, keeping the fastest of several runs
+    of each operation to reduce noise.
+    """
+
+    def __init__(self, repeat=DEFAULT_REPEAT):
+        self.repeat = repeat
+        #: maps operation name => fastest time in microseconds
+        self.results = {}
+        #: maps operation name => increase in the peak memory use of the process
+        #: in kilobytes during the first run, for operations where it was tracked
+        self.memory = {}
+
+    def measure(self, name, func, setup=None, teardown=None, count=1, track_memory=False):
+        """
+        Time an operation
+
+        @param name: name to store the result under, for example 'insert/1000'
+        @param func: function performing the operation
+        @param setup: function to call before each run, not included in the time
+        @param teardown: function to call after each run, not included in the time
+        @param count: number of operations that func performs. The result is the
+           time for each operation.
+        @param track_memory: if True, also record how much the peak memory use of
+           the process grows during the first run. The peak memory use never goes
+           down, so an operation that needs less memory than earlier operations
+           will show no increase.
+        @returns: the fastest time, in microseconds
+
+        """
+        best = None
+        for i in xrange(0, self.repeat):
+            if setup is not None:
+                setup()
+            if track_memory and i == 0:
+                start_memory = get_peak_memory()
+            start = default_timer()
+            func()
+            elapsed = default_timer() - start
+            if track_memory and i == 0 and start_memory is not None:
+                self.memory[name] = get_peak_memory() - start_memory
+            if teardown is not None:
+                teardown()
+
+            if best is None or elapsed < best:
+                best = elapsed
+
+        best = best * 1000000. / count
+        self.results[name] = best
+        _logger.info("%s: %.1fus", name, best)
+
+        return best
+
+def write_results(benchmark, sizes, timer, f):
+    """Write the results collected by a Timer to a file object as JSON"""
+
+    json.dump({
+        'benchmark': benchmark,
+        'python': platform.python_version(),
+        'platform': sys.platform,
+        'sizes': sizes,
+        'units': 'microseconds',
+        'results': timer.results,
+        'memory_units': 'kilobytes',
+        'memory': timer.memory,
+    }, f, indent=2, sort_keys=True)
+    f.write("\n")
+
+def read_results(filename):
+    """Read the results written by write_results() from a file
+
+    @returns: a tuple of (sizes, results)
+
+    """
+    f = open(filename)
+    try:
+        data = json.load(f)
+    finally:
+        f.close()
+
+    return data['sizes'], data['results']
+
+def compare_results(results, baseline, tolerance=DEFAULT_TOLERANCE, min_difference=DEFAULT_MIN_DIFFERENCE):
+    """
+    Compare benchmark results against a baseline
+
+    Only operations present in both are compared.
+
+    @param results: the results to check
+    @param baseline: previous results
+    @param tolerance: how many times slower than the baseline an operation
+       can be before it is considered a regression
+    @param min_difference: differences smaller than this, in microseconds, are
+       never regressions
+    @returns: a list of (name, baseline time, time) for the regressions
+
+    """
+    regressions = []
+    for name in sorted(results):
+        if not name in baseline:
+            continue
+        old = baseline[name]
+        new = results[name]
+        if new > old * tolerance and new - old > min_difference:
+            regressions.append((name, old, new))
+
+    return regressions
+
+def main(benchmark, run, description=None,
+         default_sizes=DEFAULT_SIZES, min_difference=DEFAULT_MIN_DIFFERENCE, min_size=1):
+    """
+    Command line handling shared by the benchmark scripts
+
+    @param benchmark: name of the benchmark suite
+    @param run: function called as run(timer, sizes) to run the benchmarks,
+       storing the results in timer
+    @param description: description of the suite for --help
+    @param default_sizes: sizes of the synthetic worksheets when not specified
+    @param min_difference: see compare_results()
+    @param min_size: the smallest size of synthetic worksheet that the benchmarks handle
+    @returns: the exit code; 1 if there were regressions compared to the baseline
+
+    """
+    parser = OptionParser(description=description)
+    parser.add_option("-s", "--sizes",
+                      help="comma-separated sizes, in lines, of the synthetic worksheets "
+                           "(defaults to the sizes in the baseline when comparing)")
+    parser.add_option("-r", "--repeat", type="int", default=DEFAULT_REPEAT,
+                      help="number of times to run each operation")
+    parser.add_option("-o", "--output", metavar="FILE",
+                      help="write the results to FILE rather than standard output")
+    parser.add_option("-c", "--compare", metavar="BASELINE",
+                      help="compare the results to the results stored in BASELINE")
+    parser.add_option("-t", "--tolerance", type="float", default=DEFAULT_TOLERANCE,
+                      help="ratio to the baseline above which a result is a regression")
+    parser.add_option("-v", "--verbose", action="store_true",
+                      help="log each result as it is measured")
+    options, args = parser.parse_args()
+
+    if options.verbose:
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+
+    if options.compare is not None:
+        baseline_sizes, baseline = read_results(options.compare)
+
+    if options.sizes is not None:
+        try:
+            sizes = [int(s) for s in options.sizes.split(",")]
+        except ValueError:
+            parser.error("--sizes must be a comma-separated list of numbers")
+    elif options.compare is not None:
+        sizes = baseline_sizes
+    else:
+        sizes = list(default_sizes)
+
+    if min(sizes) < min_size:
+        parser.error("sizes must be at least %d lines" % min_size)
+
+    timer = Timer(options.repeat)
+    run(timer, sizes)
+
+    if options.output is not None:
+        f = open(options.output, "w")
+    else:
+        f = sys.stdout
+    try:
+        write_results(benchmark, sizes, timer, f)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+    if options.compare is not None:
+        regressions = compare_results(timer.results, baseline, options.tolerance, min_difference)
+        for name, old, new in regressions:
+            print >>sys.stderr, "%s: %.1fus, was %.1fus (%.1fx)" % (name, new, old, new / old)
+        if len(regressions) > 0:
+            return 1
+
+    return 0
@@ -16,4 +16,29 @@ for f in *.py ; do
     fi
 done
 
+# If a directory of baseline results is given, the benchmarks are run and
+# compared against them. Timings are machine-specific, so baselines have to
+# be created locally, with, for example:
+#
+#   tools/benchmark/benchmark_worksheet.py --sizes=1000,10000 -o baselines/worksheet.json
+#
+# The comparison uses the same worksheet sizes as the baseline.
+#
+if [ -n "$REINTERACT_BENCHMARK_BASELINES" ] ; then
+    for f in ../../tools/benchmark/benchmark_*.py ; do
+	name=`basename $f .py | sed s/^benchmark_//`
+	baseline=$REINTERACT_BENCHMARK_BASELINES/$name.json
+	if [ -f $baseline ] ; then
+	    echo -n "$name benchmark .. "
+	    python $f --compare=$baseline > /dev/null
+	    if [ $? = 0 ] ; then
+		echo "OK"
+	    else
+		echo "FAIL"
+		status=1
+	    fi
+	fi
+    done
+fi
+
 exit $status